@@ -0,0 +1,419 @@
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque, namedtuple
+
+import numpy as np
+
+import metrics
+from store import FIELDS, VECTOR_FIELDS
+
+#
+# Alert rules evaluated on the live sample stream, read from a JSON file
+# like alerts.example.json:
+#
+#   {
+#     "webhook": "http://127.0.0.1:9000/alerts",
+#     "log": "logs/alerts.log",
+#     "dedup_window": 300,
+#     "rate_limit": 10,
+#     "rules": [
+#       {"name": "shaking", "field": "linear_accel", "op": ">", "value": 3.0, "for": 5},
+#       {"name": "uncalibrated", "field": "cal.sys", "op": "<", "value": 2},
+#       {"name": "weak link", "field": "rssi", "op": "<", "value": -110, "nodes": [2, 3]},
+#       {"name": "silent", "silence": 60, "nodes": [5]}
+#     ]
+#   }
+#
+# field is any store.FIELDS column ("cal.sys" and "cal_sys" both work) or a
+# vector name, which tests the vector's magnitude. A rule fires once its
+# condition has held for `for` seconds (0 by default) and resolves when it
+# stops holding. A silence rule fires when a node has sent nothing for
+# `silence` seconds; without nodes it watches every node heard so far.
+#
+# Without a config file there are no rules and nothing is evaluated.
+#
+
+# Values a rule can test: the sample row, then the vector magnitudes
+NAMES = list(FIELDS) + list(VECTOR_FIELDS)
+NAME_INDEX = {name: i for i, name in enumerate(NAMES)}
+OPS = ('>', '>=', '<', '<=', '==', '!=')
+RULE_KEYS = {'name', 'field', 'op', 'value', 'for', 'nodes', 'severity', 'silence'}
+SEVERITIES = ('info', 'warning', 'critical')
+
+Rule = namedtuple('Rule', 'name field op value duration nodes severity silence')
+
+# Same rule, node and state within this many seconds is sent once
+DEDUP_WINDOW = 300.0
+# Notifications per minute over all rules, bursts up to the same number
+RATE_LIMIT = 10
+
+def parse_rule(entry, i=0):
+    unknown = set(entry) - RULE_KEYS
+    if unknown:
+        raise ValueError(f"rule {i}: unknown keys {sorted(unknown)}")
+    name = entry.get('name', f"rule{i}")
+    severity = entry.get('severity', 'warning')
+    if severity not in SEVERITIES:
+        raise ValueError(f"rule {name}: severity must be one of {', '.join(SEVERITIES)}")
+    nodes = entry.get('nodes')
+    if nodes is not None:
+        nodes = frozenset(int(n, 0) if isinstance(n, str) else int(n) for n in nodes)
+    if 'silence' in entry:
+        if set(entry) & {'field', 'op', 'value', 'for'}:
+            raise ValueError(f"rule {name}: a silence rule has no field, op, value or for")
+        return Rule(name, None, None, None, 0.0, nodes, severity, float(entry['silence']))
+    field = str(entry.get('field', '')).replace('.', '_')
+    if field not in NAME_INDEX:
+        raise ValueError(f"rule {name}: unknown field {entry.get('field')!r}")
+    op = entry.get('op')
+    if op not in OPS:
+        raise ValueError(f"rule {name}: op must be one of {' '.join(OPS)}")
+    if 'value' not in entry:
+        raise ValueError(f"rule {name}: no value to compare with")
+    return Rule(name, field, op, float(entry['value']), float(entry.get('for', 0)),
+                nodes, severity, None)
+
+def load_config(path=None):
+    #
+    # (rules, settings). `path` defaults to ALERTS_CONFIG, then alerts.json
+    # in the working directory.
+    #
+    if path is None:
+        path = os.environ.get('ALERTS_CONFIG')
+        if path is None and os.path.exists('alerts.json'):
+            path = 'alerts.json'
+    if path is None:
+        return [], {}
+    with open(path) as f:
+        config = json.load(f)
+    rules = [parse_rule(entry, i) for i, entry in enumerate(config.get('rules', ()))]
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+        raise ValueError("rules must not share a name")
+    settings = {key: config[key] for key in ('webhook', 'log', 'dedup_window', 'rate_limit')
+                if key in config}
+    return rules, settings
+
+def extend(values, magnitudes=True):
+    # Sample row -> row of NAMES, the vector magnitudes appended
+    row = np.array(values, dtype=np.float64)
+    if not magnitudes:
+        return row
+    vectors = row[:3 * len(VECTOR_FIELDS)].reshape(-1, 3)
+    return np.concatenate((row, np.sqrt(np.einsum('ij,ij->i', vectors, vectors))))
+
+class RuleSet:
+    #
+    # Threshold rules compiled into arrays: the column each one reads, its
+    # threshold and duration. Rules testing < or <= have value and threshold
+    # negated, so all ordering rules come down to one > and one >= over
+    # every rule. evaluate() is then a handful of NumPy operations per
+    # sample however many rules there are. NaN (a value the sample doesn't
+    # carry) never matches.
+    #
+    def __init__(self, rules):
+        self.rules = list(rules)
+        ops = [r.op for r in self.rules]
+        self.index = np.array([NAME_INDEX[r.field] for r in self.rules], dtype=np.intp)
+        self.sign = np.array([-1.0 if op in ('<', '<=') else 1.0 for op in ops])
+        self.threshold = np.array([r.value for r in self.rules], dtype=np.float64) * self.sign
+        self.inclusive = np.array([op in ('>=', '<=') for op in ops], dtype=bool)
+        self.equal = np.flatnonzero([op == '==' for op in ops])
+        self.unequal = np.flatnonzero([op == '!=' for op in ops])
+        self.duration = np.array([r.duration for r in self.rules], dtype=np.float64)
+        self.everywhere = np.array([r.nodes is None for r in self.rules], dtype=bool)
+        # vector magnitudes are only worked out when a rule reads one
+        self.magnitudes = bool(len(self.index)) and int(self.index.max()) >= len(FIELDS)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def applies(self, node):
+        # Rules that watch `node`
+        mask = self.everywhere.copy()
+        for i, rule in enumerate(self.rules):
+            if rule.nodes is not None and node in rule.nodes:
+                mask[i] = True
+        return mask
+
+    def evaluate(self, values):
+        # (which rules hold, the value each one read) for one sample row
+        values = extend(values, self.magnitudes)[self.index]
+        signed = values * self.sign
+        out = signed > self.threshold
+        out |= (signed == self.threshold) & self.inclusive
+        if len(self.equal):
+            out[self.equal] = values[self.equal] == self.threshold[self.equal]
+        if len(self.unequal):
+            v = values[self.unequal]
+            out[self.unequal] = (v != self.threshold[self.unequal]) & (v == v)
+        return out, values
+
+class NodeState:
+    #
+    # Per node: which rules apply, since when each condition holds, which
+    # fire. holding is False while no condition holds and nothing fires,
+    # samples that change nothing then skip the bookkeeping.
+    #
+    def __init__(self, mask):
+        self.mask = mask
+        self.since = np.full(len(mask), np.nan)
+        self.active = np.zeros(len(mask), dtype=bool)
+        self.holding = False
+
+class LogAlertSink:
+    # One JSON line per notification, also printed on the console
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', buffering=1)
+
+    def send(self, event):
+        print(f"ALERT {event['state']}: {event['message']}")
+        self._file.write(json.dumps(event) + '\n')
+
+    def close(self):
+        self._file.close()
+
+class WebhookSink:
+    #
+    # POSTs each notification as JSON to `url` from a background thread, so
+    # a slow or dead receiver never holds up evaluation. At most `maxsize`
+    # notifications wait, further ones are dropped and counted.
+    #
+    def __init__(self, url, timeout=5.0, maxsize=100):
+        self.url = url
+        self.timeout = timeout
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name="alert-webhook", daemon=True)
+        self._thread.start()
+
+    def send(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(self.timeout)
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                return
+            request = urllib.request.Request(
+                self.url, data=json.dumps(event).encode(), method='POST',
+                headers={'Content-Type': 'application/json'})
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout):
+                    pass
+                self.sent += 1
+            except OSError as e:
+                self.failed += 1
+                print(f"Alert webhook {self.url} failed: {e}")
+
+class Notifier:
+    #
+    # Hands notifications to the sinks. The same (rule, node, state) within
+    # `dedup_window` seconds goes out once, so a flapping condition can't
+    # flood anyone, and a token bucket keeps everything together under
+    # `rate_limit` per minute.
+    #
+    def __init__(self, sinks=(), dedup_window=DEDUP_WINDOW, rate_limit=RATE_LIMIT):
+        self.sinks = list(sinks)
+        self.dedup_window = dedup_window
+        self.rate = rate_limit / 60.0
+        self.burst = float(rate_limit)
+        self.recent = deque(maxlen=100)
+        self.notified = 0
+        self.deduplicated = 0
+        self.rate_limited = 0
+        self._last = {}
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+
+    def notify(self, event):
+        now = time.monotonic()
+        key = (event['rule'], event['node'], event['state'])
+        last = self._last.get(key)
+        if last is not None and now - last < self.dedup_window:
+            self.deduplicated += 1
+            return False
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens < 1:
+            self.rate_limited += 1
+            return False
+        self._tokens -= 1
+        self._last[key] = now
+        self.notified += 1
+        self.recent.append(event)
+        for sink in self.sinks:
+            try:
+                sink.send(event)
+            except Exception as e:
+                print(f"Alert sink {type(sink).__name__} failed: {e}")
+        return True
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+class AlertEngine:
+    #
+    # add() is the pipeline sink. Threshold rules are evaluated per sample
+    # through the RuleSet, with a `since` time and an active flag per rule
+    # and node as the only window state. Silence rules are checked every
+    # `check_interval` seconds by the task start() runs.
+    #
+    # start()/stop() match the service hooks in web_server.
+    #
+    def __init__(self, rules=(), notifier=None, check_interval=1.0):
+        rules = list(rules)
+        self.rules = RuleSet([r for r in rules if r.silence is None])
+        self.silence = [r for r in rules if r.silence is not None]
+        self.notifier = notifier or Notifier()
+        self.check_interval = check_interval
+        self.nodes = {}
+        self.last_seen = {}
+        self.samples = 0
+        self.fired = 0
+        self._silent = set()
+        self._started = time.time()
+        self._task = None
+
+    @classmethod
+    def from_config(cls, path=None):
+        rules, settings = load_config(path)
+        sinks = []
+        if 'log' in settings:
+            sinks.append(LogAlertSink(settings['log']))
+        if 'webhook' in settings:
+            sinks.append(WebhookSink(settings['webhook']))
+        notifier = Notifier(sinks, settings.get('dedup_window', DEDUP_WINDOW),
+                            settings.get('rate_limit', RATE_LIMIT))
+        return cls(rules, notifier)
+
+    def start(self):
+        self._started = time.time()
+        if self.silence:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.notifier.close()
+
+    def add(self, sample):
+        node = sample.node
+        t = sample.t
+        self.samples += 1
+        self.last_seen[node] = t
+        if self._silent:
+            for rule in self.silence:
+                if (rule.name, node) in self._silent:
+                    self._silent.discard((rule.name, node))
+                    self._emit(rule, node, 'resolved', t, None)
+        rules = self.rules
+        if not len(rules):
+            return
+        state = self.nodes.get(node)
+        if state is None:
+            state = self.nodes[node] = NodeState(rules.applies(node))
+        holds, values = rules.evaluate(sample.values)
+        holds &= state.mask
+        if not holds.any():
+            if not state.holding:
+                return
+            state.holding = False
+        else:
+            state.holding = True
+        # start of each condition that holds (kept while it goes on holding)
+        state.since = since = np.where(holds, np.fmin(state.since, t), np.nan)
+        firing = t - since >= rules.duration
+        changed = firing != state.active
+        if changed.any():
+            for i in np.flatnonzero(changed):
+                rule = rules.rules[i]
+                self._emit(rule, node, 'firing' if firing[i] else 'resolved', t,
+                           float(values[i]))
+            state.active = firing
+
+    def check_silence(self, now=None):
+        now = time.time() if now is None else now
+        for rule in self.silence:
+            nodes = rule.nodes if rule.nodes is not None else self.last_seen
+            for node in nodes:
+                if (rule.name, node) in self._silent:
+                    continue
+                seen = self.last_seen.get(node, self._started)
+                if now - seen >= rule.silence:
+                    self._silent.add((rule.name, node))
+                    self._emit(rule, node, 'firing', now, now - seen)
+
+    def active(self):
+        out = []
+        for node, state in sorted(self.nodes.items()):
+            for i in np.flatnonzero(state.active):
+                rule = self.rules.rules[i]
+                out.append({'rule': rule.name, 'node': node, 'severity': rule.severity,
+                            'since': float(state.since[i])})
+        for name, node in sorted(self._silent):
+            rule = next(r for r in self.silence if r.name == name)
+            out.append({'rule': name, 'node': node, 'severity': rule.severity,
+                        'since': self.last_seen.get(node, self._started)})
+        return out
+
+    def stats(self):
+        return {'rules': len(self.rules) + len(self.silence), 'samples': self.samples,
+                'fired': self.fired, 'notified': self.notifier.notified,
+                'deduplicated': self.notifier.deduplicated,
+                'rate_limited': self.notifier.rate_limited}
+
+    def register_metrics(self, registry=metrics.registry):
+        registry.register_collector('alerts_fired', "Alert rule transitions to firing",
+                                    'counter', lambda: self.fired)
+        registry.register_collector(
+            'alerts_suppressed', "Alert notifications held back", 'counter',
+            lambda: {('dedup',): self.notifier.deduplicated,
+                     ('rate_limit',): self.notifier.rate_limited},
+            ('reason',))
+        registry.register_collector('alerts_active', "Alerts currently firing", 'gauge',
+                                    lambda: len(self.active()))
+
+    def _emit(self, rule, node, state, t, value):
+        if state == 'firing':
+            self.fired += 1
+        if rule.silence is not None:
+            detail = (f"nothing for {value:.0f} s" if state == 'firing'
+                      else "heard again")
+        else:
+            detail = (f"{rule.field} {value:.4g} {rule.op} {rule.value:g}" if state == 'firing'
+                      else f"{rule.field} back to {value:.4g}")
+        self.notifier.notify({
+            'rule': rule.name,
+            'node': node,
+            'state': state,
+            'severity': rule.severity,
+            'value': None if value is None or value != value else value,
+            'timestamp': t,
+            'message': f"{rule.name}: node 0x{node:04X} {detail}",
+        })
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            self.check_silence()
@@ -0,0 +1,192 @@
+import math
+from collections import deque
+
+import numpy as np
+
+from store import FIELD_INDEX, ring_order
+
+#
+# Motion and vibration figures derived from each node's samples as they
+# arrive, kept as a series next to the raw history:
+#
+#   accel_rms    RMS of |linear_accel| over the window, m/s^2
+#   accel_p2p    peak to peak of |linear_accel| over the window, m/s^2
+#   gyro_rms     RMS of |gyro| over the window, dps
+#   dominant_hz  strongest frequency in |linear_accel|, from the last FFT
+#   tilt_deg     angle between the gravity vector and the sensor's z axis
+#
+# A window is the last `window` samples of a node. Sums of squares and the
+# min/max deques are updated per sample, so a sample costs the same however
+# long the window is. The FFT runs once every `hop` samples over the whole
+# window, the sample rate taken from the window's timestamps.
+#
+SERIES = ('accel_rms', 'accel_p2p', 'gyro_rms', 'dominant_hz', 'tilt_deg')
+SERIES_INDEX = {name: i for i, name in enumerate(SERIES)}
+
+_LINEAR = [FIELD_INDEX[f"linear_accel_{axis}"] for axis in 'xyz']
+_GYRO = [FIELD_INDEX[f"gyro_{axis}"] for axis in 'xyz']
+_GRAVITY = [FIELD_INDEX[f"gravity_{axis}"] for axis in 'xyz']
+
+def _magnitude(values, index):
+    x, y, z = values[index[0]], values[index[1]], values[index[2]]
+    return math.sqrt(x * x + y * y + z * z)
+
+def tilt(gx, gy, gz):
+    # Degrees between gravity and the z axis, NaN without a gravity reading
+    g = math.sqrt(gx * gx + gy * gy + gz * gz)
+    if not g > 0:
+        return float('nan')
+    return math.degrees(math.acos(max(-1.0, min(1.0, gz / g))))
+
+class NodeAnalytics:
+    def __init__(self, node, window=128, hop=64, capacity=3600):
+        self.node = node
+        self.window = window
+        self.hop = hop
+        self.capacity = capacity
+        # the window, as rings indexed by sample number % window
+        self.t = np.zeros(window, dtype=np.float64)
+        self.accel = np.zeros(window, dtype=np.float64)
+        self.gyro_sq = np.zeros(window, dtype=np.float64)
+        self.samples = 0
+        self._accel_sq = 0.0
+        self._gyro_sq = 0.0
+        # (sample number, value), decreasing for max and increasing for min
+        self._max = deque()
+        self._min = deque()
+        self._taper = np.hanning(window)
+        self.dominant_hz = float('nan')
+        self.ffts = 0
+        # derived series, one row per sample
+        self.series_t = np.zeros(capacity, dtype=np.float64)
+        self.series = np.zeros((capacity, len(SERIES)), dtype=np.float32)
+        self.count = 0
+
+    def add(self, t, values):
+        accel = _magnitude(values, _LINEAR)
+        gyro = _magnitude(values, _GYRO)
+        window = self.window
+        if accel == accel and gyro == gyro:
+            n = self.samples
+            i = n % window
+            if n >= window:
+                self._accel_sq -= self.accel[i] ** 2
+                self._gyro_sq -= self.gyro_sq[i]
+            self.t[i] = t
+            self.accel[i] = accel
+            self.gyro_sq[i] = gyro * gyro
+            self._accel_sq += accel * accel
+            self._gyro_sq += gyro * gyro
+            self._slide(n, accel)
+            self.samples = n = n + 1
+            if n % self.hop == 0:
+                self._resync()
+                if n >= window:
+                    self._fft()
+        n = min(self.samples, window)
+        if n:
+            accel_rms = math.sqrt(max(self._accel_sq, 0.0) / n)
+            accel_p2p = self._max[0][1] - self._min[0][1]
+            gyro_rms = math.sqrt(max(self._gyro_sq, 0.0) / n)
+        else:
+            accel_rms = accel_p2p = gyro_rms = float('nan')
+        i = self.count % self.capacity
+        self.series[i] = (accel_rms, accel_p2p, gyro_rms, self.dominant_hz,
+                          tilt(*(values[j] for j in _GRAVITY)))
+        self.series_t[i] = t
+        self.count += 1
+
+    def _slide(self, n, value):
+        # Monotonic deques, each sample goes in and out once
+        low = n - self.window
+        top = self._max
+        while top and top[-1][1] <= value:
+            top.pop()
+        top.append((n, value))
+        if top[0][0] <= low:
+            top.popleft()
+        bottom = self._min
+        while bottom and bottom[-1][1] >= value:
+            bottom.pop()
+        bottom.append((n, value))
+        if bottom[0][0] <= low:
+            bottom.popleft()
+
+    def _resync(self):
+        # Recompute the running sums so float error can't build up
+        n = min(self.samples, self.window)
+        self._accel_sq = float(np.dot(self.accel[:n], self.accel[:n]))
+        self._gyro_sq = float(self.gyro_sq[:n].sum())
+
+    def _fft(self):
+        t, accel = ring_order((self.t, self.accel), self.samples, self.window)
+        span = t[-1] - t[0]
+        if not span > 0:
+            return
+        rate = (len(t) - 1) / span
+        power = np.abs(np.fft.rfft((accel - accel.mean()) * self._taper)) ** 2
+        # bin 0 is what is left of the mean
+        k = int(power[1:].argmax()) + 1
+        # a still sensor has no dominant frequency
+        self.dominant_hz = k * rate / len(t) if power[k] > 1e-12 else float('nan')
+        self.ffts += 1
+
+    def latest(self):
+        if not self.count:
+            return None
+        row = self.series[(self.count - 1) % self.capacity]
+        out = {'timestamp': float(self.series_t[(self.count - 1) % self.capacity])}
+        for name, v in zip(SERIES, row.tolist()):
+            out[name] = None if v != v else round(v, 4)
+        return out
+
+    def history(self, since=None, until=None, limit=None):
+        # (t, series) of [since, until) oldest first, the range the archive
+        # and export endpoints use
+        t, values = ring_order((self.series_t, self.series), self.count, self.capacity)
+        if since is not None or until is not None:
+            keep = np.ones(len(t), dtype=bool)
+            if since is not None:
+                keep &= t >= since
+            if until is not None:
+                keep &= t < until
+            t, values = t[keep], values[keep]
+        if limit is not None and len(t) > limit:
+            t, values = t[-limit:], values[-limit:]
+        return t, values
+
+class Analytics:
+    #
+    # NodeAnalytics for up to `max_nodes` nodes. add() is the pipeline sink,
+    # web_server serves the series under /nodes/{node}/analytics.
+    #
+    def __init__(self, window=128, hop=64, capacity=3600, max_nodes=32):
+        if not 0 < hop <= window:
+            raise ValueError("hop must be between 1 and the window length")
+        self.window = window
+        self.hop = hop
+        self.capacity = capacity
+        self.max_nodes = max_nodes
+        self.nodes = {}
+        self.rejected = 0
+
+    def add(self, sample):
+        node = self.nodes.get(sample.node)
+        if node is None:
+            if len(self.nodes) >= self.max_nodes:
+                self.rejected += 1
+                return
+            node = self.nodes[sample.node] = NodeAnalytics(sample.node, self.window,
+                                                           self.hop, self.capacity)
+        node.add(sample.t, sample.values)
+
+    def get(self, node):
+        return self.nodes.get(node)
+
+    def summary(self):
+        return [dict(node=node, **(analytics.latest() or {}))
+                for node, analytics in sorted(self.nodes.items())]
+
+    def stats(self):
+        return {'nodes': len(self.nodes), 'rejected': self.rejected,
+                'ffts': sum(a.ffts for a in self.nodes.values())}
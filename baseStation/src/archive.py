@@ -0,0 +1,494 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#
+# Append-only columnar archive of sensor samples.
+#
+#   history/node_0002/000000.col
+#   history/node_0002/000001.col
+#   ...
+#
+# Every node has its own directory of fixed size chunk files. A chunk holds
+# `capacity` rows stored column by column: a float64 timestamp column, then
+# one column per store.FIELDS entry, float32 for measurements and int16 for
+# the integer ones (temperature, calibration, RSSI; INT_NAN marks missing).
+# In front of the columns sits a sparse index, the timestamp of every
+# `index_every`th row.
+#
+# Chunks are memory mapped. Appends write straight into the mapping (the
+# kernel writes dirty pages back, flush() forces it), and reads return
+# NumPy views of the mapped columns, so nothing is parsed or copied for a
+# range that falls in one chunk. A time range query bisects the chunks'
+# first timestamps, then the sparse index of the first and last chunk, and
+# only touches the pages of the rows it returns, whatever the archive size.
+#
+# Live rows must come in time order per node, rows not newer than the
+# last one are counted in out_of_order and skipped. Older data (imported
+# logs) goes in with insert(): rows that fall in a gap before or between
+# the existing chunks are written to chunks of their own, rows within a
+# chunk's time span are skipped (a re-import skips everything). Chunks are
+# kept in time order, whatever their file names.
+#
+# Import the CSV logs of earlier base station versions with
+#
+#   python archive.py import logs/sensor_data_*.csv [--node 2] [--directory history]
+#
+
+import argparse
+import bisect
+import csv
+import glob
+import os
+
+import numpy as np
+
+from store import FIELDS, FIELD_INDEX, parse_time
+
+MAGIC = b'PNCS'
+VERSION = 1
+HEADER_SIZE = 64
+INT_NAN = -32768
+
+INT_FIELDS = {'temp', 'cal_sys', 'cal_gyro', 'cal_accel', 'cal_mag', 'rssi'}
+FIELD_DTYPES = [np.dtype(np.int16) if f in INT_FIELDS else np.dtype(np.float32) for f in FIELDS]
+INT_COLUMNS = [j for j, f in enumerate(FIELDS) if f in INT_FIELDS]
+
+# header: magic, version, field count, capacity, index_every, row count
+HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', '<u2'), ('nfields', '<u2'),
+                         ('capacity', '<u4'), ('index_every', '<u4'), ('count', '<u4')])
+
+def chunk_layout(capacity, index_every):
+    # Byte offsets of the sparse index, the timestamp column and each field
+    offset = HEADER_SIZE
+    index = offset
+    offset += -(-capacity // index_every) * 8
+    t = offset
+    offset += capacity * 8
+    fields = []
+    for dtype in FIELD_DTYPES:
+        fields.append(offset)
+        offset += capacity * dtype.itemsize
+    return index, t, fields, offset
+
+def to_stored(column, dtype):
+    # float column -> stored dtype, NaN becomes INT_NAN for int16
+    if dtype.kind == 'f':
+        return column
+    out = np.where(np.isnan(column), INT_NAN, np.round(column))
+    return out.astype(np.int16)
+
+def from_stored(column):
+    # stored column -> float32, INT_NAN back to NaN (views for float columns)
+    if column.dtype.kind == 'f':
+        return column
+    out = column.astype(np.float32)
+    out[column == INT_NAN] = np.nan
+    return out
+
+class Chunk:
+    def __init__(self, path, capacity=None, index_every=None, mode='r+'):
+        self.path = path
+        if capacity is not None and not os.path.exists(path):
+            size = chunk_layout(capacity, index_every)[3]
+            with open(path, 'wb') as f:
+                f.truncate(size)
+            mm = np.memmap(path, dtype=np.uint8, mode='r+')
+            header = mm[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+            header[0] = (MAGIC, VERSION, len(FIELDS), capacity, index_every, 0)
+            mm.flush()
+            del mm
+        self.mm = np.memmap(path, dtype=np.uint8, mode=mode)
+        self.header = self.mm[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+        magic, version, nfields, capacity, index_every, _ = self.header[0]
+        if magic != MAGIC or version != VERSION or nfields != len(FIELDS):
+            raise ValueError(f"{path} is not a version {VERSION} chunk with {len(FIELDS)} fields")
+        self.capacity = int(capacity)
+        self.index_every = int(index_every)
+        index, t, fields, _ = chunk_layout(self.capacity, self.index_every)
+        self.index = np.ndarray(-(-self.capacity // self.index_every), np.float64, self.mm, index)
+        self.t = np.ndarray(self.capacity, np.float64, self.mm, t)
+        self.columns = [np.ndarray(self.capacity, dtype, self.mm, offset)
+                        for dtype, offset in zip(FIELD_DTYPES, fields)]
+
+    @property
+    def count(self):
+        return int(self.header['count'][0])
+
+    def first_time(self):
+        return self.t[0] if self.count else None
+
+    def last_time(self):
+        count = self.count
+        return self.t[count - 1] if count else None
+
+    def append(self, t, values):
+        # Write as many rows of (t, values) as fit, returns how many did
+        count = self.count
+        n = min(len(t), self.capacity - count)
+        if n <= 0:
+            return 0
+        end = count + n
+        self.t[count:end] = t[:n]
+        # int16 fields converted in one go, columns filled from rows of the
+        # transposed block
+        block = values[:n]
+        ints = to_stored(block[:, INT_COLUMNS], np.dtype(np.int16)).T
+        floats = block.T
+        k = 0
+        for j, column in enumerate(self.columns):
+            if column.dtype.kind == 'f':
+                column[count:end] = floats[j]
+            else:
+                column[count:end] = ints[k]
+                k += 1
+        # sparse index entries for rows that are multiples of index_every
+        every = self.index_every
+        first = -(-count // every)
+        last = (end - 1) // every
+        if first <= last:
+            self.index[first:last + 1] = self.t[first * every:(last + 1) * every:every]
+        self.header['count'] = end
+        return n
+
+    def span(self, start, end):
+        # Row range [lo, hi) with start <= t < end, bisecting the sparse
+        # index first so only one index block of t is searched per bound
+        count = self.count
+        t = self.t
+        def locate(value):
+            blocks = (count + self.index_every - 1) // self.index_every
+            b = int(np.searchsorted(self.index[:blocks], value, side='left'))
+            lo = max(b - 1, 0) * self.index_every
+            hi = min(b * self.index_every + 1, count)
+            return lo + int(np.searchsorted(t[lo:hi], value, side='left'))
+        lo = 0 if start is None else locate(start)
+        hi = count if end is None else locate(end)
+        return lo, hi
+
+    def flush(self):
+        self.mm.flush()
+
+class NodeArchive:
+    def __init__(self, directory, capacity, index_every, mode):
+        self.directory = directory
+        self.capacity = capacity
+        self.index_every = index_every
+        self.mode = mode
+        self.chunks = []
+        self.starts = []
+        if mode != 'r':
+            os.makedirs(directory, exist_ok=True)
+        self._next_name = 0
+        empty = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.col'):
+                self._next_name = max(self._next_name, int(name[:-4]) + 1)
+                chunk = Chunk(os.path.join(directory, name), mode=mode)
+                if chunk.count:
+                    self.chunks.append(chunk)
+                elif mode != 'r':
+                    # left behind empty, reuse it
+                    empty.append(chunk)
+        # imported chunks can have later names than newer ones
+        self.chunks.sort(key=lambda chunk: chunk.first_time())
+        self.starts = [chunk.first_time() for chunk in self.chunks]
+        for chunk in empty[:1]:
+            self.chunks.append(chunk)
+            self.starts.append(None)
+
+    def last_time(self):
+        for chunk in reversed(self.chunks):
+            if chunk.count:
+                return chunk.last_time()
+        return None
+
+    def _writable(self):
+        chunk = self.chunks[-1] if self.chunks else None
+        if chunk is None or chunk.count >= chunk.capacity:
+            if chunk is not None:
+                chunk.flush()
+            chunk = Chunk(self._new_path(), self.capacity, self.index_every)
+            self.chunks.append(chunk)
+            self.starts.append(None)
+        return chunk
+
+    def _new_path(self):
+        path = os.path.join(self.directory, f"{self._next_name:06d}.col")
+        self._next_name += 1
+        return path
+
+    def append(self, t, values):
+        done = 0
+        while done < len(t):
+            chunk = self._writable()
+            if not chunk.count:
+                self.starts[-1] = t[done]
+            done += chunk.append(t[done:], values[done:])
+
+    def insert(self, t, values):
+        #
+        # Rows older than the newest one, t sorted. Each run of rows in a gap
+        # before or between chunks goes into chunks sized to fit it, rows
+        # within a chunk's time span are skipped. Returns rows written.
+        #
+        spans = [(chunk.first_time(), chunk.last_time()) for chunk in self.chunks if chunk.count]
+        gaps = []
+        prev_last = -np.inf
+        for first, last in spans + [(np.inf, np.inf)]:
+            lo = int(np.searchsorted(t, prev_last, side='right'))
+            hi = int(np.searchsorted(t, first, side='left'))
+            gaps.extend((a, min(a + self.capacity, hi)) for a in range(lo, hi, self.capacity))
+            prev_last = last
+        for a, b in gaps:
+            chunk = Chunk(self._new_path(), b - a, self.index_every)
+            chunk.append(t[a:b], values[a:b])
+            chunk.flush()
+            at = self._position(t[a])
+            self.chunks.insert(at, chunk)
+            self.starts.insert(at, t[a])
+        return sum(b - a for a, b in gaps)
+
+    def _position(self, first):
+        # index for a new chunk starting at `first`, before an empty live chunk
+        starts = self.starts
+        n = len(starts) - 1 if starts and starts[-1] is None else len(starts)
+        return bisect.bisect_left(starts, first, 0, n)
+
+    def query(self, start=None, end=None):
+        # [(chunk, lo, hi)] for the rows with start <= t < end
+        starts = self.starts
+        if starts and starts[-1] is None:
+            # the newest chunk is still empty
+            starts = starts[:-1]
+        if not starts:
+            return []
+        first = 0 if start is None else max(bisect.bisect_right(starts, start) - 1, 0)
+        last = len(starts) if end is None else bisect.bisect_left(starts, end)
+        out = []
+        for chunk in self.chunks[first:last]:
+            lo, hi = chunk.span(start, end)
+            if hi > lo:
+                out.append((chunk, lo, hi))
+        return out
+
+    def flush(self):
+        if self.chunks:
+            self.chunks[-1].flush()
+
+class ColumnStore:
+    #
+    # The archive of all nodes. mode='r' opens it read only, for a process
+    # other than the one appending.
+    #
+    def __init__(self, directory='history', capacity=65536, index_every=256, mode='r+'):
+        self.directory = directory
+        self.capacity = capacity
+        self.index_every = index_every
+        self.mode = mode
+        self.rows = 0
+        self.out_of_order = 0
+        self.nodes = {}
+        if mode != 'r':
+            os.makedirs(directory, exist_ok=True)
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.startswith('node_'):
+                    node = int(name[5:], 16)
+                    self.nodes[node] = self._open(node)
+
+    def _open(self, node):
+        return NodeArchive(os.path.join(self.directory, f"node_{node:04x}"),
+                           self.capacity, self.index_every, self.mode)
+
+    def node(self, node, create=False):
+        archive = self.nodes.get(node)
+        if archive is None and create:
+            archive = self.nodes[node] = self._open(node)
+        return archive
+
+    def append(self, node, t, values):
+        #
+        # Append rows for one node, t a sequence of epoch seconds and values
+        # an (n, len(FIELDS)) float array in FIELDS order, NaN for missing.
+        #
+        archive = self.node(node, create=True)
+        t = np.asarray(t, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float32).reshape(len(t), len(FIELDS))
+        last = archive.last_time()
+        if last is not None:
+            keep = t > last
+            if not keep.all():
+                self.out_of_order += int((~keep).sum())
+                t, values = t[keep], values[keep]
+        if len(t) > 1 and (np.diff(t) < 0).any():
+            order = np.argsort(t, kind='stable')
+            t, values = t[order], values[order]
+        archive.append(t, values)
+        self.rows += len(t)
+
+    def insert(self, node, t, values):
+        #
+        # Add rows for one node in any time order: rows newer than the
+        # archive's last go through append(), older ones fill the gaps
+        # between chunks (NodeArchive.insert). Returns (rows written, rows
+        # skipped as within the span of already archived data).
+        #
+        archive = self.node(node, create=True)
+        t = np.asarray(t, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float32).reshape(len(t), len(FIELDS))
+        order = np.argsort(t, kind='stable')
+        t, values = t[order], values[order]
+        last = archive.last_time()
+        split = 0 if last is None else int(np.searchsorted(t, last, side='right'))
+        written = archive.insert(t[:split], values[:split])
+        self.rows += written
+        before = self.rows
+        self.append(node, t[split:], values[split:])
+        written += self.rows - before
+        return written, len(t) - written
+
+    def append_sample(self, sample):
+        # Pipeline sink: one sample.Sample
+        self.append(sample.node, (sample.t,), (sample.values,))
+
+    def query(self, node, start=None, end=None, fields=None, limit=None):
+        #
+        # (t, {field: column}) for start <= t < end, at most the last
+        # `limit` rows. Within one chunk t and float32 columns are views of
+        # the mapped file.
+        #
+        archive = self.node(node)
+        fields = list(fields or FIELDS)
+        parts = archive.query(start, end) if archive is not None else []
+        if limit is not None:
+            kept, total = [], 0
+            for chunk, lo, hi in reversed(parts):
+                if total >= limit:
+                    break
+                lo = max(lo, hi - (limit - total))
+                kept.append((chunk, lo, hi))
+                total += hi - lo
+            parts = kept[::-1]
+
+        def gather(get):
+            pieces = [get(chunk)[lo:hi] for chunk, lo, hi in parts]
+            if len(pieces) == 1:
+                return pieces[0]
+            return np.concatenate(pieces) if pieces else None
+
+        t = gather(lambda c: c.t)
+        if t is None:
+            return np.empty(0), {f: np.empty(0, dtype=np.float32) for f in fields}
+        columns = {}
+        for field in fields:
+            j = FIELD_INDEX[field]
+            columns[field] = from_stored(gather(lambda c: c.columns[j]))
+        return t, columns
+
+    def scan(self, node, start=None, end=None, fields=None, batch=4096):
+        #
+        # (t, {field: column}) batches of at most `batch` rows for
+        # start <= t < end, oldest first. Only one batch is materialised at
+        # a time, so memory stays flat however long the range is.
+        #
+        archive = self.node(node)
+        if archive is None:
+            return
+        columns = [(f, FIELD_INDEX[f]) for f in (fields or FIELDS)]
+        for chunk, lo, hi in archive.query(start, end):
+            for i in range(lo, hi, batch):
+                j = min(i + batch, hi)
+                yield chunk.t[i:j], {f: from_stored(chunk.columns[k][i:j]) for f, k in columns}
+
+    def summary(self):
+        out = []
+        for node, archive in sorted(self.nodes.items()):
+            rows = sum(chunk.count for chunk in archive.chunks)
+            out.append({'node': node, 'rows': rows, 'chunks': len(archive.chunks),
+                        'first': float(archive.starts[0]) if rows else None,
+                        'last': float(archive.last_time()) if rows else None})
+        return out
+
+    def flush(self):
+        for archive in self.nodes.values():
+            archive.flush()
+
+    # start()/stop() match the service hooks in web_server
+    def start(self):
+        pass
+
+    def stop(self):
+        self.flush()
+
+    close = flush
+
+# CSV log column -> archive field, columns the logs don't have stay NaN
+CSV_FIELDS = {
+    'Orient_X': 'orientation_x', 'Orient_Y': 'orientation_y', 'Orient_Z': 'orientation_z',
+    'Gyro_X': 'gyro_x', 'Gyro_Y': 'gyro_y', 'Gyro_Z': 'gyro_z',
+    'Accel_X': 'accel_x', 'Accel_Y': 'accel_y', 'Accel_Z': 'accel_z',
+    'Mag_X': 'mag_x', 'Mag_Y': 'mag_y', 'Mag_Z': 'mag_z',
+    'Cal_Sys': 'cal_sys', 'Cal_Gyro': 'cal_gyro', 'Cal_Accel': 'cal_accel', 'Cal_Mag': 'cal_mag',
+}
+
+def read_csv_log(path):
+    # (t, values) of one base station CSV log, rows that don't parse are skipped
+    times, rows = [], []
+    with open(path, newline='') as f:
+        for record in csv.DictReader(f):
+            try:
+                t = parse_time(record['Timestamp'])
+                row = [float('nan')] * len(FIELDS)
+                for column, field in CSV_FIELDS.items():
+                    row[FIELD_INDEX[field]] = float(record[column])
+                rssi = record.get('RSSI', '')
+                if rssi.endswith('dBm'):
+                    row[FIELD_INDEX['rssi']] = float(rssi[:-3])
+            except (KeyError, TypeError, ValueError):
+                continue
+            times.append(t)
+            rows.append(row)
+    return np.array(times, dtype=np.float64), np.array(rows, dtype=np.float32).reshape(-1, len(FIELDS))
+
+def import_csv(store, paths, node):
+    #
+    # Import CSV logs into the archive, before, after or between what it
+    # already holds. Returns (rows imported, rows skipped because they fall
+    # within the time span of an archived chunk).
+    #
+    parts = [read_csv_log(path) for path in paths]
+    parts = [p for p in parts if len(p[0])]
+    if not parts:
+        return 0, 0
+    t = np.concatenate([p[0] for p in parts])
+    values = np.concatenate([p[1] for p in parts])
+    written, skipped = store.insert(node, t, values)
+    store.flush()
+    return written, skipped
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar sensor archive")
+    commands = parser.add_subparsers(dest='command', required=True)
+    importer = commands.add_parser('import', help="import base station CSV logs")
+    importer.add_argument('paths', nargs='+', help="CSV files or glob patterns")
+    # the CSV logs carry no sender address, earlier versions only listened to 0x02
+    importer.add_argument('--node', type=lambda v: int(v, 0), default=2)
+    importer.add_argument('--directory', default='history')
+    info = commands.add_parser('info', help="rows and time span per node")
+    info.add_argument('--directory', default='history')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        paths = sorted(p for pattern in args.paths for p in (glob.glob(pattern) or [pattern]))
+        store = ColumnStore(args.directory)
+        rows, skipped = import_csv(store, paths, args.node)
+        print(f"Imported {rows} rows from {len(paths)} files into {args.directory} "
+              f"for node 0x{args.node:04X} ({skipped} rows skipped, within the time span of "
+              f"archived chunks)")
+    else:
+        store = ColumnStore(args.directory, mode='r')
+        for entry in store.summary():
+            print(entry)
+
+if __name__ == '__main__':
+    main()
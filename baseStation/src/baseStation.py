@@ -1,176 +1,354 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
 
-import sx126x
-import json
-import time
-import sys
-import datetime
-import csv
+import asyncio
 import os
-import requests
-from threading import Thread
-
-# Initialize data buffer and CSV logging
-log_filename = f"sensor_data_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-os.makedirs('logs', exist_ok=True)
-log_path = os.path.join('logs', log_filename)
-
-# Create CSV file with headers
-with open(log_path, 'w', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow([
-        'Timestamp',
-        'Orient_X', 'Orient_Y', 'Orient_Z',
-        'Gyro_X', 'Gyro_Y', 'Gyro_Z',
-        'Accel_X', 'Accel_Y', 'Accel_Z',
-        'Mag_X', 'Mag_Y', 'Mag_Z',
-        'Cal_Sys', 'Cal_Gyro', 'Cal_Accel', 'Cal_Mag',
-        'RSSI'
-    ])
-
-# Initialize LoRa module with error handling
-try:
-    node = sx126x.sx126x(
-        serial_num="/dev/ttyACM0",
-        freq=433,
-        addr=0,
-        power=22,
-        rssi=True,
-        air_speed=2400,
-        relay=False
-    )
-    
-    print(f"Base station initialized with address: 0x00")
-    print(f"Listening for messages from node ID: 0x02")
-    
-    # Verify the serial connection
-    if not node.ser.is_open:
-        raise Exception("Failed to open serial port")
-        
-    # Try to write test data
-    node.ser.write(bytes([0xC1, 0x00, 0x09]))
-    time.sleep(0.1)
-    
-    if node.ser.in_waiting > 0:
-        response = node.ser.read(node.ser.in_waiting)
-        print("Module response:", [hex(x) for x in response])
-    else:
-        print("Warning: No response from module")
-
-except Exception as e:
-    print(f"Failed to initialize LoRa module: {e}")
-    print("Please check:")
-    print("1. Serial port permissions (run 'ls -l /dev/ttyACM0')")
-    print("2. Hardware connections (M0, M1, TX, RX)")
-    print("3. UART configuration in /boot/firmware/config.txt")
-    sys.exit(1)
-
-def parse_sensor_data(data):
+import sys
+import time
+
+import codec
+import metrics
+import radios
+from alerts import AlertEngine
+from analytics import Analytics
+from archive import ColumnStore
+from bus import bus
+from log_sink import CsvLogSink
+from pipeline import Pipeline, Stage
+from receiver import monotonic_to_wall
+from sample import Sample
+from timeline import Timeline
+
+#
+# Start up in the order that gets the web API serving soonest: the modules
+# the server needs, the sinks, the server itself; the radios are configured
+# in a worker thread once the server's event loop runs and join the
+# pipeline one by one as they become ready. Nothing touches hardware at
+# import time, web_server (FastAPI) is imported by main() and sx126x (with
+# the GPIO backend) only by that worker, so the base station also runs off
+# the Pi.
+#
+# Every step is printed with its time since start and served under /stats
+# as 'startup'. STARTUP_BUDGET is the number of seconds the web API should
+# be listening within (2 by default), a slower start is reported.
+#
+STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET', '2.0'))
+
+# Set up by main(), used by the pipeline stages below
+log_sink = None
+radio_group = None
+duplicates = None
+
+# Pipeline stages after framing
+
+def decode(item):
+    #
+    # (radio name, frame) -> (radio name, frame, values, error). Only the
+    # payload is looked at, no radio state, counters or output, so the stage
+    # can run on a process pool; what the result means for the radio is
+    # settled in enrich_sample. Module responses pass through undecoded.
+    #
+    name, frame = item
+    if frame.addr is None:
+        return name, frame, None, None
     try:
-        # Check for command packets (usually start with 0xC1)
-        if data[0] == 0xC1:
+        return name, frame, codec.decode_row(frame.payload), None
+    except ValueError as e:
+        return name, frame, None, str(e)
+
+def enrich_sample(item):
+    name, frame, values, error = item
+    radio = radio_group.by_name[name]
+    if frame.addr is None:
+        # answers to the noise sampler's requests share the stream
+        if not radio.noise.handle(frame):
             print("Received command/config packet from LoRa module")
-            return
-            
-        # Skip the first 3 bytes (sender, recipient, length)
-        payload = data
-        
-        try:
-            # Try to decode as JSON
-            data_str = payload.decode('utf-8')
-            json_start = data_str.find('{')
-            if json_start != -1:
-                json_str = data_str[json_start:]
-                print(f"Received JSON data: {json_str}")
-                sensor_data = json.loads(json_str)
-                
-                # Add timestamp and RSSI
-                sensor_data['timestamp'] = datetime.datetime.now().isoformat()
-                sensor_data['rssi'] = f"-{256-data[-1:][0]}dBm" if node.rssi else "N/A"
-                
-                # Log to CSV
-                csv_data = [
-                    sensor_data['timestamp'],
-                    # Orientation
-                    sensor_data['orientation']['x'],
-                    sensor_data['orientation']['y'],
-                    sensor_data['orientation']['z'],
-                    # Gyroscope
-                    sensor_data['gyro']['x'],
-                    sensor_data['gyro']['y'],
-                    sensor_data['gyro']['z'],
-                    # Accelerometer
-                    sensor_data['accel']['x'],
-                    sensor_data['accel']['y'],
-                    sensor_data['accel']['z'],
-                    # Magnetometer
-                    sensor_data['mag']['x'],
-                    sensor_data['mag']['y'],
-                    sensor_data['mag']['z'],
-                    # Calibration
-                    sensor_data['cal']['sys'],
-                    sensor_data['cal']['gyro'],
-                    sensor_data['cal']['accel'],
-                    sensor_data['cal']['mag'],
-                    # RSSI
-                    sensor_data['rssi']
-                ]
-                
-                with open(log_path, 'a', newline='') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(csv_data)
-                
-                # Send to web server
-                try:
-                    requests.post('http://localhost:8000/update', json=sensor_data, timeout=0.1)
-                except requests.exceptions.RequestException:
-                    pass
-                
-            else:
-                print("Received non-JSON data:", data_str)
-                
-        except UnicodeDecodeError:
-            print("Received binary data:", [hex(x) for x in payload])
-            
+            metrics.config_packets.inc()
+        return None
+    if values is None:
+        print(f"Received undecodable data from node 0x{frame.addr:04X}: {error}")
+        print("Payload:", [hex(x) for x in frame.payload])
+        radio.decode_errors += 1
+        kind = 'binary' if codec.is_binary(frame.payload) else 'json'
+        metrics.decode_errors.labels(kind).inc()
+        return None
+    # the same packet heard by more than one radio only goes on once
+    if duplicates.seen((frame.addr, frame.payload), frame.arrived or time.monotonic(),
+                       radio.name):
+        radio.duplicates += 1
+        return None
+    radio.decoded += 1
+    radio.rate.add()
+    radio_group.heard[frame.addr] = radio.name
+    # Add timestamp and RSSI, the timestamp is when the first
+    # byte of the packet reached the serial port
+    arrived = frame.arrived if frame.arrived is not None else time.monotonic()
+    if frame.rssi is not None:
+        values[-1] = frame.rssi - 256
+        metrics.node_rssi.labels(frame.addr).observe(frame.rssi - 256)
+    metrics.node_packets.labels(frame.addr).inc()
+    return Sample(frame.addr, monotonic_to_wall(arrived).timestamp(), values, radio.name)
+
+def log_csv(sample):
+    log_sink.write(sample.csv_row())
+
+def publish(sample):
+    bus.publish(sample)
+    metrics.publish_seconds.observe(time.time() - sample.t)
+
+def log_console(sample):
+    print(f"Received data from node 0x{sample.node:04X} "
+          f"at {sample.timestamp} ({sample.rssi_text})")
+
+class LogSinkService:
+    # Flushes and closes the CSV log when the server shuts down, after the
+    # pipeline (added later, so stopped earlier) has drained into it
+    def start(self):
+        pass
+
+    def stop(self):
+        log_sink.close()
+
+def open_module(cfg, gpio):
+    # sx126x for one radio, configured and verified; runs in a worker thread
+    import sx126x
+    serial_port = cfg['port']
+    try:
+        node = sx126x.sx126x(
+            serial_num=serial_port,
+            freq=cfg['freq'],
+            addr=cfg['addr'],
+            power=cfg['power'],
+            rssi=cfg['rssi'],
+            air_speed=cfg['air_speed'],
+            net_id=cfg['net_id'],
+            buffer_size=cfg['buffer_size'],
+            relay=False,
+            m0=cfg['m0'],
+            m1=cfg['m1'],
+            gpio=gpio,
+        )
+
+        # Verify the serial connection
+        if not node.ser.is_open:
+            raise Exception("Failed to open serial port")
+
+    except sx126x.ConfigError as e:
+        print(f"LoRa module {cfg['name']} rejected the configuration: {e}")
+        print(f"Check that M0/M1 are wired to GPIO {cfg['m0']}/{cfg['m1']} and the module is powered")
+        return None
     except Exception as e:
-        print(f"Error processing data: {e}")
-        print("Data dump for debugging:")
-        print(f"Full packet: {[hex(x) for x in data]}")
+        print(f"Failed to initialize LoRa module {cfg['name']}: {e}")
+        print("Please check:")
+        print(f"1. Serial port permissions (run 'ls -l {serial_port}')")
+        print("2. Hardware connections (M0, M1, TX, RX)")
+        print("3. UART configuration in /boot/firmware/config.txt")
+        return None
+
+    # set() has read the registers back, or verified what it wrote
+    config = node.config
+    print(f"Radio {cfg['name']} on {serial_port} "
+          f"{'configured' if node.config_written else 'already configured'}: "
+          f"address 0x{config.addr:04X}, net {config.net_id}, {config.freq}.125MHz, "
+          f"air speed {config.air_speed} bps, {config.power} dBm, "
+          f"packet RSSI {'on' if config.packet_rssi else 'off'}")
+    return node
+
+class RadioStartup:
+    #
+    # Configures the radios off the event loop (register read-back and the
+    # mode switch delays take a while per module) while the web API is
+    # already serving. Each radio that comes up is attached to the pipeline,
+    # its services (serial reader, transmit queue, noise sampler) are
+    # started and it joins the RadioGroup, which web_server gets as
+    # transmitter and noise with the first one. A radio that fails is
+    # reported and left out, the rest of the base station keeps running.
+    #
+    def __init__(self, configs, group, submit, timeline):
+        self.configs = configs
+        self.group = group
+        self.submit = submit
+        self.timeline = timeline
+        self.failed = []
+        self._services = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for service in reversed(self._services):
+            service.stop()
+        self._services = []
+
+    async def _run(self):
+        import gpio
+        import web_server
+        loop = asyncio.get_running_loop()
+        try:
+            backend = await loop.run_in_executor(None, gpio.backend)
+        except (OSError, ValueError) as e:
+            print(f"No GPIO for the radios: {e}")
+            self.failed = [cfg['name'] for cfg in self.configs]
+            return
+        self.timeline.mark(f"GPIO backend: {backend.name}")
+        for cfg in self.configs:
+            node = await loop.run_in_executor(None, open_module, cfg, backend)
+            if node is None:
+                self.failed.append(cfg['name'])
+                continue
+            radio = radios.Radio(cfg['name'], node, duty_cycle=cfg['duty_cycle'],
+                                 noise_interval=cfg['noise_interval'])
+            # Per radio: the serial reader, a transmit queue for commands
+            # and acks (held back while a packet is coming in, within the
+            # duty cycle) and the noise floor sampler (runs only while the
+            # line is idle)
+            radio.attach(self.submit)
+            for service in radio.services():
+                service.start()
+                self._services.append(service)
+            self.group.add(radio)
+            web_server.transmitter = self.group
+            web_server.noise = self.group
+            self.timeline.mark(f"radio {radio.name} listening on {node.serial_n}")
+        if self.failed:
+            print(f"Radios not running: {', '.join(self.failed)}")
+
+class StartupWatch:
+    # Marks when uvicorn is accepting connections, against the budget
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        import web_server
+        while web_server.server is None or not web_server.server.started:
+            await asyncio.sleep(0.005)
+        ms = self.timeline.mark("web API listening")
+        budget = self.timeline.budget
+        if budget is not None and ms > budget * 1000:
+            print(f"Startup took {ms / 1000:.2f} s, over the {budget:g} s budget")
+
+def main():
+    global log_sink, radio_group, duplicates
+    timeline = Timeline(STARTUP_BUDGET)
 
-# Start web server in a separate thread
-def run_web_server():
     import web_server
-    web_server.run()
-
-Thread(target=run_web_server, daemon=True).start()
-
-# Main loop
-try:
-    print("\nLoRa Receiver Started")
-    print(f"Listening on /dev/ttyACM0 at 9600 baud")
-    print(f"Base Station ID: 0x00")
-    print(f"Expected Sender ID: 0x02")
-    print("Press Ctrl+C to exit\n")
-    
-    while True:
-        if node.ser.inWaiting() > 0:
-            time.sleep(0.1)  # Wait for complete message
-            r_buff = node.ser.read(node.ser.inWaiting())
-            
-            try:
-                parse_sensor_data(r_buff)
-            except Exception as e:
-                print(f"Error parsing data: {e}")
-        
-        time.sleep(0.1)
-
-except KeyboardInterrupt:
-    print("\nExiting...")
-except Exception as e:
-    print(f"An error occurred: {e}")
-    import traceback
-    traceback.print_exc()
-finally:
-    # Clean up GPIO (if needed)
-    node.ser.close()
\ No newline at end of file
+    timeline.mark("web server imported")
+
+    # Alert rules from alerts.json (or ALERTS_CONFIG), none without a file
+    try:
+        alerts = AlertEngine.from_config()
+    except (OSError, ValueError) as e:
+        print(f"Bad alert configuration: {e}")
+        return 1
+
+    # Radio modules from radios.json (or LORA_CONFIG), one on LORA_PORT or
+    # /dev/ttyACM0 without a config file
+    try:
+        radio_configs, duplicate_window = radios.load_config()
+    except (OSError, ValueError) as e:
+        print(f"Bad radio configuration: {e}")
+        return 1
+
+    # CSV logging, rows are written in batches by a background thread and
+    # the file is rotated hourly under logs/
+    log_sink = CsvLogSink('logs', rotate='hour', flush_interval=1.0, fsync_interval=10.0)
+
+    # Columnar history of every sample under history/, served by
+    # /nodes/{node}/archive
+    archive = ColumnStore('history')
+
+    # Rolling RMS, peak to peak, dominant frequency and tilt per node,
+    # served by /analytics and /nodes/{node}/analytics
+    analytics = Analytics(window=128, hop=64)
+
+    radio_group = radios.RadioGroup()
+    duplicates = radios.DuplicateFilter(duplicate_window)
+    timeline.mark("sinks ready")
+
+    # Everything runs in uvicorn's event loop: the serial fds are watched
+    # by the loop, chunks from every radio go through one shared pipeline,
+    # and the web server's tasks pick the samples up from the bus on the
+    # same loop
+    try:
+        print("\nLoRa Receiver Started")
+        print("Press Ctrl+C to exit\n")
+
+        # receive -> frame -> decode -> enrich -> CSV / archive / analytics /
+        # alerts / dashboard / console.
+        # Packets can reach us merged or split across reads, each radio's
+        # framer cuts its byte stream back into frames. Sinks drop rather
+        # than push back, a slow SD card or terminal must not slow down
+        # reception.
+        pipeline = Pipeline(
+            stages=[
+                Stage('frame', lambda chunk: chunk[0].feed(chunk[1], chunk[2]),
+                      maxsize=1024, many=True),
+                Stage('decode', decode),
+                Stage('enrich', enrich_sample),
+            ],
+            sinks=[
+                Stage('csv', log_csv, maxsize=1024, policy='drop_new'),
+                Stage('archive', archive.append_sample, maxsize=1024, policy='drop_new'),
+                Stage('analytics', analytics.add, maxsize=1024, policy='drop_new'),
+                Stage('alerts', alerts.add, maxsize=1024, policy='drop_new'),
+                Stage('dashboard', publish, policy='drop_oldest'),
+                Stage('console', log_console, maxsize=64, policy='drop_new'),
+            ],
+        )
+
+        startup = RadioStartup(radio_configs, radio_group, pipeline.submit_nowait, timeline)
+        web_server.services.append(StartupWatch(timeline))
+        web_server.services.append(LogSinkService())
+        web_server.services.append(archive)
+        web_server.archive = archive
+        web_server.analytics = analytics
+        web_server.services.append(alerts)
+        web_server.alerts = alerts
+        web_server.services.append(pipeline)
+        web_server.services.append(startup)
+        web_server.stats['startup'] = lambda: dict(timeline.stats(), failed_radios=startup.failed)
+        web_server.stats['pipeline'] = pipeline.stats
+        web_server.stats['radios'] = radio_group.stats
+        web_server.stats['analytics'] = analytics.stats
+        web_server.stats['alerts'] = alerts.stats
+
+        # Counters the receive path keeps anyway, read on each /metrics scrape
+        pipeline.register_metrics()
+        radio_group.register_metrics()
+        alerts.register_metrics()
+        for name, help, collect in (
+                ('csv_rows', "Rows written to the CSV log", lambda: log_sink.rows),
+                ('csv_dropped_rows', "Rows dropped because the CSV writer fell behind",
+                 lambda: log_sink.dropped)):
+            metrics.registry.register_collector(name, help, 'counter', collect)
+        # Returns after Ctrl+C once the services have been stopped
+        web_server.run()
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+    finally:
+        # Clean up GPIO (if needed)
+        for radio in radio_group.radios:
+            radio.node.ser.close()
+        log_sink.close()
+        archive.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,551 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#
+# Benchmarks for the base station, one per path a packet takes:
+#
+#   decode      payload -> reading (JSON, binary, row, NumPy batch)
+#   framing     merged serial chunks -> frames (FrameReader)
+#   csv         CsvLogSink.write() and the writer thread behind it
+#   web         /update and /data under concurrent HTTP clients, and the
+#               /ws fan-out of posted samples to dashboard sockets
+#   end_to_end  virtual sx126x -> receiver -> pipeline -> bus, the same
+#               path a sample takes to the dashboard
+#   alerts      AlertEngine.add() with growing numbers of rules
+#
+#   python benchmark.py [--only decode,web] [--output results.json]
+#   python benchmark.py --compare old.json new.json
+#
+# Inputs are synthetic and seeded, so numbers are comparable between runs.
+# Every benchmark reports throughput, and where there is a per item latency
+# its p50/p99. peak_rss_kb is the process peak after that benchmark ran
+# (getrusage, it only grows), run one benchmark with --only to see its own.
+# Results are written as JSON along with the commit they were taken at.
+#
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import codec
+from replay import synthetic_readings, json_payload
+
+def timed(fn, repeat=5):
+    # Best of `repeat` runs, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def latency_stats(seconds):
+    # p50/p99/max of a list of latencies in seconds, reported in ms
+    if not len(seconds):
+        return {'p50_ms': None, 'p99_ms': None, 'max_ms': None}
+    ms = np.asarray(seconds) * 1e3
+    p50, p99 = np.percentile(ms, (50, 99))
+    return {'p50_ms': round(float(p50), 4), 'p99_ms': round(float(p99), 4),
+            'max_ms': round(float(ms.max()), 4)}
+
+def peak_rss_kb():
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if platform.system() == 'Darwin' else peak
+
+def frame_bytes(addr, payload, channel=0x17, rssi=0xB0):
+    # One received packet as the module puts it on the UART
+    return bytes((addr >> 8 & 0xFF, addr & 0xFF, channel)) + payload + bytes((rssi,))
+
+def bench_decode(n):
+    readings = synthetic_readings(n)
+    json_payloads = [json_payload(r) for r in readings]
+    binary_payloads = [codec.encode_v1(r) for r in readings]
+    binary_blob = b''.join(binary_payloads)
+
+    def decode_all(payloads):
+        decode = codec.decode_payload
+        for p in payloads:
+            decode(p)
+
+    def decode_rows(payloads):
+        decode = codec.decode_row
+        for p in payloads:
+            decode(p)
+
+    json_time = timed(lambda: decode_all(json_payloads))
+    binary_time = timed(lambda: decode_all(binary_payloads))
+    row_time = timed(lambda: decode_rows(binary_payloads))
+    batch_time = timed(lambda: codec.decode_records(binary_blob))
+    return {
+        'json_bytes_per_packet': sum(map(len, json_payloads)) / n,
+        'binary_bytes_per_packet': len(binary_payloads[0]),
+        'json_us_per_packet': json_time / n * 1e6,
+        'binary_us_per_packet': binary_time / n * 1e6,
+        'binary_row_us_per_packet': row_time / n * 1e6,
+        'binary_batch_us_per_packet': batch_time / n * 1e6,
+        'json_packets_per_s': round(n / json_time),
+        'binary_packets_per_s': round(n / binary_time),
+        'binary_batch_packets_per_s': round(n / batch_time),
+    }
+
+def bench_framing(n, merge=4, fmt='binary'):
+    #
+    # Frames glued `merge` at a time into one read, the way they come out
+    # of the serial port when the base station falls behind. Every third
+    # chunk is split in two so frames also straddle reads.
+    #
+    from framer import FrameReader
+
+    readings = synthetic_readings(256)
+    payloads = [codec.encode_v1(r) if fmt == 'binary' else json_payload(r) for r in readings]
+    frames = [frame_bytes(i % 65536, payloads[i % len(payloads)]) for i in range(n)]
+    chunks = []
+    for i in range(0, n, merge):
+        chunk = b''.join(frames[i:i + merge])
+        if len(chunks) % 3 == 2:
+            half = len(chunk) // 2
+            chunks += [chunk[:half], chunk[half:]]
+        else:
+            chunks.append(chunk)
+    total_bytes = sum(map(len, chunks))
+
+    def run(latencies=None):
+        framer = FrameReader(rssi=True, channel=0x17)
+        count = 0
+        clock = time.perf_counter
+        for chunk in chunks:
+            start = clock()
+            for _ in framer.feed(chunk, 0.0):
+                count += 1
+            if latencies is not None:
+                latencies.append(clock() - start)
+        return count
+
+    elapsed = timed(run)
+    latencies = []
+    frames_out = run(latencies)
+    return {
+        'format': fmt,
+        'frames': frames_out,
+        'chunks': len(chunks),
+        'frames_per_s': round(n / elapsed),
+        'mb_per_s': round(total_bytes / elapsed / 1e6, 3),
+        'chunk': latency_stats(latencies),
+    }
+
+def bench_csv(n):
+    #
+    # Time spent in write() is what the receive path pays per row. The
+    # writer thread's throughput is rows over the time until close() has
+    # drained the queue and flushed the file.
+    #
+    from log_sink import CsvLogSink
+
+    rows = []
+    for i, r in enumerate(synthetic_readings(256)):
+        rows.append([datetime.datetime.fromtimestamp(1.7e9 + i).isoformat()]
+                    + [r[v][axis] for v in ('orientation', 'gyro', 'accel', 'mag') for axis in 'xyz']
+                    + [r['cal'][k] for k in ('sys', 'gyro', 'accel', 'mag')]
+                    + [f"-{80 + i % 40}dBm"])
+
+    with tempfile.TemporaryDirectory() as directory:
+        sink = CsvLogSink(directory, rotate=None, max_pending=n)
+        latencies = []
+        clock = time.perf_counter
+        start = clock()
+        for i in range(n):
+            t = clock()
+            sink.write(rows[i % len(rows)])
+            latencies.append(clock() - t)
+        queued = clock() - start
+        sink.close()
+        elapsed = clock() - start
+        size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+    return {
+        'rows': sink.rows,
+        'dropped': sink.dropped,
+        'bytes': size,
+        'write_calls_per_s': round(n / queued),
+        'rows_per_s': round(sink.rows / elapsed),
+        'write': latency_stats(latencies),
+    }
+
+async def http_request(reader, writer, request):
+    # One request on a keep-alive connection, returns the status code
+    writer.write(request)
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    if length:
+        await reader.readexactly(length)
+    return status
+
+def bench_web(clients, requests, ws_clients=16, ws_samples=500):
+    #
+    # A real uvicorn server on a free port in a thread of its own, and
+    # `clients` keep-alive connections from this thread's loop, each sending
+    # `requests` requests back to back. /update is hit first so /data has a
+    # sample to return.
+    #
+    # Then `ws_clients` sockets on /ws while `ws_samples` samples are posted
+    # to /update one after the other. Every socket should get every sample
+    # (the Broadcaster batches them), latency runs from the POST going out
+    # to the batch holding that sample arriving on a socket.
+    #
+    import uvicorn
+    import websockets
+    import web_server
+
+    config = uvicorn.Config(web_server.app, host="127.0.0.1", port=0,
+                            log_level="warning", access_log=False)
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, name="bench-uvicorn", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    readings = synthetic_readings(256)
+    bodies = []
+    for i, reading in enumerate(readings):
+        sample = dict(reading, timestamp=1.7e9 + i, rssi=f"-{80 + i % 40}dBm", node=i % 4)
+        body = json.dumps(sample).encode()
+        bodies.append(b"POST /update HTTP/1.1\r\nHost: bench\r\n"
+                      b"Content-Type: application/json\r\n"
+                      b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+    get_data = b"GET /data HTTP/1.1\r\nHost: bench\r\n\r\n"
+
+    async def client(make_request, latencies, failures):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        clock = time.perf_counter
+        try:
+            for i in range(requests):
+                start = clock()
+                if await http_request(reader, writer, make_request(i)) != 200:
+                    failures.append(i)
+                latencies.append(clock() - start)
+        finally:
+            writer.close()
+
+    async def load(make_request):
+        latencies, failures = [], []
+        start = time.perf_counter()
+        await asyncio.gather(*(client(make_request, latencies, failures)
+                               for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+        return {
+            'requests': len(latencies),
+            'failures': len(failures),
+            'requests_per_s': round(len(latencies) / elapsed),
+            'latency': latency_stats(latencies),
+        }
+
+    async def fanout():
+        clock = time.perf_counter
+        sockets = [await websockets.connect(f"ws://127.0.0.1:{port}/ws")
+                   for _ in range(ws_clients)]
+        arrivals = [{} for _ in sockets]
+        messages = [0] * len(sockets)
+
+        async def listen(i, socket):
+            async for message in socket:
+                now = clock()
+                messages[i] += 1
+                for sample in json.loads(message):
+                    arrivals[i].setdefault(sample.get('seq'), now)
+
+        listeners = [asyncio.create_task(listen(i, s)) for i, s in enumerate(sockets)]
+        # the samples are numbered in the order they are posted on this one
+        # connection, nothing else posts meanwhile
+        first = web_server.feed.seq + 1
+        posted = {}
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        start = clock()
+        failures = 0
+        for i in range(ws_samples):
+            posted[first + i] = clock()
+            if await http_request(reader, writer, bodies[i % len(bodies)]) != 200:
+                failures += 1
+        writer.close()
+        last = first + ws_samples - 1
+        deadline = clock() + 2.0
+        while clock() < deadline and not all(last in a for a in arrivals):
+            await asyncio.sleep(0.01)
+        elapsed = clock() - start
+        for socket in sockets:
+            await socket.close()
+        for listener in listeners:
+            listener.cancel()
+        latencies = [a[seq] - t for a in arrivals for seq, t in posted.items() if seq in a]
+        return {
+            'clients': ws_clients,
+            'samples': ws_samples,
+            'failures': failures,
+            'delivered': round(len(latencies) / (ws_samples * ws_clients), 4),
+            'messages_per_client': round(sum(messages) / max(ws_clients, 1), 1),
+            'samples_per_s': round(len(latencies) / elapsed),
+            'dropped_batches': web_server.broadcaster.dropped,
+            'latency': latency_stats(latencies),
+        }
+
+    try:
+        update = asyncio.run(load(lambda i: bodies[i % len(bodies)]))
+        data = asyncio.run(load(lambda i: get_data))
+        ws = asyncio.run(fanout()) if ws_clients else None
+    finally:
+        server.should_exit = True
+        thread.join()
+    return {'clients': clients, 'update': update, 'data': data, 'ws': ws}
+
+def bench_end_to_end(packets, rate, fmt='binary'):
+    #
+    # Packets go out on a VirtualSX126x paced at 9600 baud and come back
+    # through AsyncReceiver, FrameReader, decode and the bus, in the same
+    # Pipeline shape baseStation.py builds. Latency runs from the moment a
+    # packet's last byte is written to the pty until its sample reaches a bus
+    # subscriber, which is where the dashboard picks it up. The sender
+    # address carries the packet number.
+    #
+    import serial
+    from bus import Bus
+    from framer import FrameReader
+    from pipeline import Pipeline, Stage
+    from receiver import AsyncReceiver
+    from sample import Sample
+    from virtual_sx126x import VirtualSX126x
+
+    device = VirtualSX126x(baudrate=9600, pace=True, seed=1)
+    readings = synthetic_readings(256)
+    payloads = [codec.encode_v1(r) if fmt == 'binary' else json_payload(r) for r in readings]
+    sent = {}
+    received = {}
+
+    def enrich(item):
+        frame, values = item
+        return Sample(frame.addr, time.time(), values)
+
+    def produce():
+        start = time.monotonic()
+        for i in range(packets):
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            device.emit(i, payloads[i % len(payloads)], -80)
+            sent[i] = time.monotonic()
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        bus = Bus()
+        wake = asyncio.Event()
+        samples = bus.subscribe(maxlen=1024, notify=lambda: loop.call_soon_threadsafe(wake.set))
+        ser = serial.Serial(device.port, 9600)
+        framer = FrameReader(rssi=device.rssi_enabled, channel=device.channel)
+        pipeline = Pipeline(
+            stages=[
+                Stage('frame', lambda chunk: framer.feed(*chunk), maxsize=1024, many=True),
+                Stage('decode', lambda frame: codec.decode_frame(frame, codec.decode_row)),
+                Stage('enrich', enrich),
+            ],
+            sinks=[Stage('dashboard', bus.publish, policy='drop_oldest')],
+        )
+        pipeline.start()
+        receiver = AsyncReceiver(ser, lambda data, arrived: pipeline.submit_nowait((data, arrived)))
+        receiver.start()
+        producer = threading.Thread(target=produce, name="bench-producer")
+        producer.start()
+        deadline = None
+        try:
+            while len(received) < packets:
+                if deadline is None and not producer.is_alive():
+                    # whatever has not arrived a second after the last send is lost
+                    deadline = time.monotonic() + 1.0
+                timeout = 0.1 if deadline is None else deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    continue
+                wake.clear()
+                now = time.monotonic()
+                for sample in samples.drain():
+                    received[sample.node] = now
+        finally:
+            producer.join()
+            receiver.stop()
+            pipeline.stop()
+            ser.close()
+        return pipeline.stats()
+
+    start = time.monotonic()
+    try:
+        stages = asyncio.run(main())
+    finally:
+        device.close()
+    elapsed = time.monotonic() - start
+    latencies = [received[i] - sent[i] for i in received if i in sent]
+    return {
+        'format': fmt,
+        'sent': packets,
+        'received': len(received),
+        'offered_rate': rate,
+        'packets_per_s': round(len(received) / elapsed, 2),
+        'latency': latency_stats(latencies),
+        'stages': {name: {k: s[k] for k in ('processed', 'dropped', 'errors', 'busy_seconds')}
+                   for name, s in stages.items()},
+    }
+
+def bench_alerts(n, rule_counts=(10, 100, 500), nodes=8):
+    #
+    # Samples from `nodes` nodes through AlertEngine.add() with random
+    # threshold rules over every field and magnitude. Thresholds sit in the
+    # tails of the data (the 2nd/98th percentile), so like real rules they
+    # fire now and then rather than on every sample. quiet_us_per_sample is
+    # the same rules with thresholds beyond anything in the data, the cost
+    # of evaluation alone. Notifications go to a Notifier without sinks.
+    #
+    from alerts import NAMES, OPS, AlertEngine, Notifier, Rule, extend
+    from sample import Sample
+
+    rng = np.random.default_rng(1)
+    readings = synthetic_readings(256)
+    rows = [codec.decode_row(codec.encode_v1(r)) for r in readings]
+    for row in rows:
+        row[-1] = float(rng.integers(-120, -60))
+    samples = [Sample(i % nodes, 1000.0 + i * 0.05, rows[i % len(rows)]) for i in range(n)]
+    observed = np.array([extend(row) for row in rows])
+    out = {'samples': n, 'nodes': nodes}
+    def run(rules):
+        engine = AlertEngine(rules, Notifier(rate_limit=1e9, dedup_window=0))
+        add = engine.add
+        return timed(lambda: [add(sample) for sample in samples]), engine
+
+    for count in rule_counts:
+        rules = []
+        quiet = []
+        for i in range(count):
+            column = int(rng.integers(len(NAMES)))
+            op = str(rng.choice(OPS[:4]))
+            value = float(np.percentile(observed[:, column], 98 if op[0] == '>' else 2))
+            duration = float(rng.choice((0.0, 0.5, 5.0)))
+            rules.append(Rule(f"rule{i}", NAMES[column], op, value, duration,
+                              None, 'warning', None))
+            beyond = 1e9 if op[0] == '>' else -1e9
+            quiet.append(rules[-1]._replace(value=beyond))
+        quiet_elapsed, _ = run(quiet)
+        elapsed, engine = run(rules)
+        out[f"rules_{count}"] = {
+            'quiet_us_per_sample': quiet_elapsed / n * 1e6,
+            'us_per_sample': elapsed / n * 1e6,
+            'ns_per_rule': elapsed / n / count * 1e9,
+            'samples_per_s': round(n / elapsed),
+            'fired': engine.fired,
+        }
+    return out
+
+BENCHMARKS = ('decode', 'framing', 'csv', 'web', 'end_to_end', 'alerts')
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                             text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+def flat(results, prefix=''):
+    # {'a': {'b': 1}} -> {'a.b': 1}, numbers only
+    out = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            out.update(flat(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[prefix + key] = value
+    return out
+
+def compare(old_path, new_path):
+    # Side by side of every number the two result files have in common
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    a, b = flat(old['results']), flat(new['results'])
+    for key in sorted(a.keys() & b.keys()):
+        change = f"{(b[key] - a[key]) / a[key]:+.1%}" if a[key] else ""
+        print(f"{key:60} {a[key]:>14.6g} {b[key]:>14.6g} {change:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Base station benchmarks")
+    parser.add_argument('--only', help="comma separated subset of " + ", ".join(BENCHMARKS))
+    parser.add_argument('--packets', type=int, default=20000,
+                        help="packets for decode, framing and csv")
+    parser.add_argument('--clients', type=int, default=16, help="concurrent HTTP clients")
+    parser.add_argument('--requests', type=int, default=200, help="requests per client")
+    parser.add_argument('--ws-clients', type=int, default=16, help="dashboard sockets on /ws")
+    parser.add_argument('--ws-samples', type=int, default=500,
+                        help="samples posted while the sockets listen")
+    parser.add_argument('--e2e-packets', type=int, default=200)
+    parser.add_argument('--e2e-rate', type=float, default=15.0, help="packets per second")
+    parser.add_argument('--format', choices=('binary', 'json'), default='binary',
+                        help="payload format for framing and end_to_end")
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    selected = args.only.split(',') if args.only else BENCHMARKS
+    unknown = set(selected) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    runs = {
+        'decode': lambda: bench_decode(args.packets),
+        'framing': lambda: bench_framing(args.packets, fmt=args.format),
+        'csv': lambda: bench_csv(args.packets),
+        'web': lambda: bench_web(args.clients, args.requests, args.ws_clients, args.ws_samples),
+        'end_to_end': lambda: bench_end_to_end(args.e2e_packets, args.e2e_rate, args.format),
+        'alerts': lambda: bench_alerts(args.packets),
+    }
+    results = {}
+    for name in BENCHMARKS:
+        if name in selected:
+            result = runs[name]()
+            result['peak_rss_kb'] = peak_rss_kb()
+            results[name] = result
+
+    report = {
+        'commit': git_commit(),
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'args': vars(args),
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import threading
+from collections import deque
+
+class Subscription:
+    #
+    # One subscriber's view of the bus: a bounded queue that drops the oldest
+    # sample when it is full, so a slow subscriber loses history instead of
+    # holding up the publisher.
+    #
+    # `notify` is called from the publishing thread when the queue goes from
+    # drained to non-empty, once per batch rather than once per sample. An
+    # asyncio subscriber uses it to wake its loop with call_soon_threadsafe,
+    # a thread can just block in get().
+    #
+    def __init__(self, bus, maxlen, notify=None):
+        self._bus = bus
+        self._queue = deque(maxlen=maxlen)
+        self._pending = False
+        self._ready = threading.Event()
+        self.notify = notify
+        self.received = 0
+        self.dropped = 0
+
+    def _put(self, sample):
+        queue = self._queue
+        if len(queue) == queue.maxlen:
+            self.dropped += 1
+        queue.append(sample)
+        self.received += 1
+        # the flag is checked after the append: either the consumer has not
+        # reset it yet and will see this sample when it drains, or it has and
+        # we wake it
+        if not self._pending:
+            self._pending = True
+            self._ready.set()
+            if self.notify is not None:
+                self.notify()
+
+    def drain(self):
+        # Take everything queued so far, oldest first
+        self._ready.clear()
+        self._pending = False
+        queue = self._queue
+        out = []
+        while True:
+            try:
+                out.append(queue.popleft())
+            except IndexError:
+                return out
+
+    def get(self, timeout=None):
+        # Block until at least one sample is queued, then drain
+        self._ready.wait(timeout)
+        return self.drain()
+
+    def close(self):
+        self._bus.unsubscribe(self)
+
+class Bus:
+    #
+    # In-process publish/subscribe channel for decoded samples. publish() is
+    # called on the receive thread and only appends to each subscriber's
+    # queue, it never blocks and never does I/O.
+    #
+    def __init__(self):
+        self._subscribers = ()
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, maxlen=256, notify=None):
+        sub = Subscription(self, maxlen, notify)
+        with self._lock:
+            self._subscribers = self._subscribers + (sub,)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not sub)
+
+    def subscribers(self):
+        return self._subscribers
+
+    def publish(self, sample):
+        self.published += 1
+        # subscribers is swapped, never mutated, so no lock is needed here
+        for sub in self._subscribers:
+            sub._put(sample)
+
+# The bus shared by the receiver and the web server
+bus = Bus()
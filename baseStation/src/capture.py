@@ -0,0 +1,146 @@
+import os
+import struct
+import time
+from collections import namedtuple
+
+#
+# Raw serial capture files: every chunk read from the module UART, as read,
+# with the time it was read. Append only, so a capture that is cut short
+# (power loss, Ctrl+C) is still readable up to its last complete record.
+#
+#   header  32 bytes, once
+#     4s   magic b'PNCP'
+#     u16  version
+#     u8   flags, bit 0: the module appends an RSSI byte to every packet
+#     u8   channel of the module, 0xFF when unknown
+#     u32  UART baudrate
+#     i64  wall clock at open, ns since the epoch
+#     i64  monotonic clock at open, ns
+#     4x   reserved
+#
+#   record  18 bytes + data, per chunk
+#     i64  monotonic ns when the read returned
+#     i64  wall clock ns at the same moment
+#     u16  data length (chunks over 65535 bytes are split)
+#     data
+#
+# Little endian throughout. Both clocks are kept since the wall clock can
+# jump (NTP) while the monotonic one gives true spacing between chunks.
+#
+# testRead.py --capture writes these, redecode.py runs them through the
+# framer and decoder again.
+#
+
+MAGIC = b'PNCP'
+VERSION = 1
+FLAG_RSSI = 0x01
+NO_CHANNEL = 0xFF
+
+HEADER = struct.Struct('<4sHBBIqq4x')
+RECORD = struct.Struct('<qqH')
+MAX_CHUNK = 0xFFFF
+
+CaptureInfo = namedtuple('CaptureInfo', 'version rssi channel baudrate wall_ns mono_ns')
+Chunk = namedtuple('Chunk', 'mono_ns wall_ns data')
+
+class CaptureWriter:
+    #
+    # Appends chunks to `path`. Records go through a `buffer_size` byte
+    # buffer and reach the OS at least every `flush_interval` seconds, so
+    # the cost per chunk is one struct pack and a buffered write. An
+    # existing capture is appended to, after checking it was made with the
+    # same module settings.
+    #
+    def __init__(self, path, rssi=True, channel=None, baudrate=9600,
+                 buffer_size=65536, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.chunks = 0
+        self.bytes = 0
+        info = CaptureInfo(VERSION, rssi, channel, baudrate, time.time_ns(), time.monotonic_ns())
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                existing = read_header(f)
+            if (existing.rssi, existing.channel) != (rssi, channel):
+                raise ValueError(f"{path} was captured with rssi={existing.rssi} "
+                                 f"channel={existing.channel}")
+            self._file = open(path, 'ab', buffering=buffer_size)
+        else:
+            self._file = open(path, 'wb', buffering=buffer_size)
+            self._file.write(pack_header(info))
+        self._flushed = time.monotonic()
+
+    def write(self, data, mono_ns=None, wall_ns=None):
+        if mono_ns is None:
+            mono_ns = time.monotonic_ns()
+        if wall_ns is None:
+            wall_ns = time.time_ns()
+        write = self._file.write
+        for i in range(0, len(data), MAX_CHUNK):
+            part = data[i:i + MAX_CHUNK]
+            write(RECORD.pack(mono_ns, wall_ns, len(part)))
+            write(part)
+        self.chunks += 1
+        self.bytes += len(data)
+        now = time.monotonic()
+        if now - self._flushed >= self.flush_interval:
+            self._file.flush()
+            self._flushed = now
+
+    def close(self):
+        self._file.close()
+
+def pack_header(info):
+    flags = FLAG_RSSI if info.rssi else 0
+    channel = NO_CHANNEL if info.channel is None else info.channel
+    return HEADER.pack(MAGIC, info.version, flags, channel, info.baudrate,
+                       info.wall_ns, info.mono_ns)
+
+def read_header(f):
+    raw = f.read(HEADER.size)
+    if len(raw) < HEADER.size:
+        raise ValueError("not a capture file: too short")
+    magic, version, flags, channel, baudrate, wall_ns, mono_ns = HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise ValueError("not a capture file: bad magic")
+    if version != VERSION:
+        raise ValueError(f"capture version {version} is not supported")
+    return CaptureInfo(version, bool(flags & FLAG_RSSI),
+                       None if channel == NO_CHANNEL else channel, baudrate, wall_ns, mono_ns)
+
+class CaptureReader:
+    #
+    # Iterates the chunks of a capture. The file is read in large blocks and
+    # chunks are memoryview slices of the block, so reading costs little
+    # next to whatever is done with the data. truncated is set when the file
+    # ends inside a record.
+    #
+    def __init__(self, path, block_size=1 << 20):
+        self.path = path
+        self.block_size = block_size
+        self.truncated = False
+        with open(path, 'rb') as f:
+            self.info = read_header(f)
+
+    def __iter__(self):
+        unpack = RECORD.unpack_from
+        head = RECORD.size
+        with open(self.path, 'rb') as f:
+            f.seek(HEADER.size)
+            pending = b''
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    break
+                buf = pending + block if pending else block
+                view = memoryview(buf)
+                pos = 0
+                end = len(buf)
+                while pos + head <= end:
+                    mono_ns, wall_ns, length = unpack(buf, pos)
+                    if pos + head + length > end:
+                        break
+                    yield Chunk(mono_ns, wall_ns, view[pos + head:pos + head + length])
+                    pos += head + length
+                pending = bytes(buf[pos:])
+            self.truncated = bool(pending)
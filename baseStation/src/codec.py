@@ -0,0 +1,158 @@
+import json
+import struct
+
+import numpy as np
+
+from store import flatten
+
+#
+# Sensor payload formats.
+#
+# Legacy nodes send a JSON object (first byte '{'). Binary nodes send a
+# fixed layout record whose first byte is the record type/version:
+#
+#   RECORD_V1 (0xB1), 39 bytes, little endian
+#     u8     type/version
+#     i16x3  orientation   deg     * 16
+#     i16x3  gyro          dps     * 16
+#     i16x3  accel         m/s^2   * 100
+#     i16x3  linear_accel  m/s^2   * 100
+#     i16x3  gravity       m/s^2   * 100
+#     i16x3  mag           uT      * 16
+#     i8     temp          degC
+#     u8     cal           sys<<6 | gyro<<4 | accel<<2 | mag
+#
+# The scales are the BNO055's own LSB sizes, so nothing is lost compared to
+# reading the chip registers. The layout must match the PAYLOAD_BINARY
+# record built in loop() in sensor/src/main.cpp.
+#
+
+RECORD_V1 = 0xB1
+
+VECTORS = ('orientation', 'gyro', 'accel', 'linear_accel', 'gravity', 'mag')
+SCALES = {
+    'orientation': 16.0,
+    'gyro': 16.0,
+    'accel': 100.0,
+    'linear_accel': 100.0,
+    'gravity': 100.0,
+    'mag': 16.0,
+}
+
+_V1 = struct.Struct('<B18hbB')
+
+# payload size for every binary record type, used by the framer
+RECORD_SIZES = {
+    RECORD_V1: _V1.size,
+}
+
+V1_DTYPE = np.dtype([('type', 'u1')]
+                    + [(name, '<i2', (3,)) for name in VECTORS]
+                    + [('temp', 'i1'), ('cal', 'u1')])
+
+# Raw counts are divided by the scale, which gives the nearest double to the
+# decimal value (870 / 100 is 8.7, 870 * 0.01 is 8.700000000000001)
+_V1_SCALES = [SCALES[name] for name in VECTORS for _ in range(3)]
+
+def is_binary(payload):
+    return len(payload) > 0 and payload[0] in RECORD_SIZES
+
+def encode_v1(reading):
+    # Pack a reading dict (same shape as the JSON payload) into a record
+    values = []
+    for name in VECTORS:
+        scale = SCALES[name]
+        vec = reading[name]
+        for axis in 'xyz':
+            v = int(round(vec[axis] * scale))
+            values.append(max(-32768, min(32767, v)))
+    cal = reading['cal']
+    packed_cal = ((cal['sys'] & 3) << 6 | (cal['gyro'] & 3) << 4
+                  | (cal['accel'] & 3) << 2 | (cal['mag'] & 3))
+    return _V1.pack(RECORD_V1, *values, int(reading['temp']), packed_cal)
+
+def decode_v1(payload):
+    fields = _V1.unpack_from(payload)
+    reading = {}
+    i = 1
+    for name in VECTORS:
+        reading[name] = {
+            'x': fields[i] / _V1_SCALES[i - 1],
+            'y': fields[i + 1] / _V1_SCALES[i],
+            'z': fields[i + 2] / _V1_SCALES[i + 1],
+        }
+        i += 3
+    reading['temp'] = fields[19]
+    cal = fields[20]
+    reading['cal'] = {
+        'sys': cal >> 6,
+        'gyro': (cal >> 4) & 3,
+        'accel': (cal >> 2) & 3,
+        'mag': cal & 3,
+    }
+    return reading
+
+def decode_payload(payload):
+    # Decode one payload, binary or legacy JSON, into a reading dict
+    if not payload:
+        raise ValueError("empty payload")
+    kind = payload[0]
+    if kind == RECORD_V1:
+        if len(payload) != _V1.size:
+            raise ValueError(f"record v1 is {_V1.size} bytes, got {len(payload)}")
+        return decode_v1(payload)
+    if kind == 0x7B:
+        return json.loads(payload)
+    raise ValueError(f"unknown payload type 0x{kind:02X}")
+
+def decode_row(payload):
+    #
+    # Like decode_payload, but straight to a row of floats in store.FIELDS
+    # order (rssi left NaN), without the nested dict for binary records
+    #
+    if payload and payload[0] == RECORD_V1:
+        if len(payload) != _V1.size:
+            raise ValueError(f"record v1 is {_V1.size} bytes, got {len(payload)}")
+        fields = _V1.unpack_from(payload)
+        row = [v / s for v, s in zip(fields[1:19], _V1_SCALES)]
+        cal = fields[20]
+        row += (float(fields[19]), cal >> 6, (cal >> 4) & 3, (cal >> 2) & 3, cal & 3,
+                float('nan'))
+        return row
+    return flatten(decode_payload(payload))
+
+def decode_records(data):
+    #
+    # Decode many back to back v1 records at once (replay, bulk import).
+    # Returns a dict of float32 arrays: one (n, 3) array per vector plus
+    # temp and the four calibration levels, each of length n.
+    #
+    records = np.frombuffer(data, dtype=V1_DTYPE)
+    if records.size and not (records['type'] == RECORD_V1).all():
+        raise ValueError("not a stream of v1 records")
+    out = {}
+    for name in VECTORS:
+        out[name] = records[name].astype(np.float32) * np.float32(1.0 / SCALES[name])
+    out['temp'] = records['temp'].astype(np.float32)
+    cal = records['cal']
+    out['cal_sys'] = cal >> 6
+    out['cal_gyro'] = (cal >> 4) & 3
+    out['cal_accel'] = (cal >> 2) & 3
+    out['cal_mag'] = cal & 3
+    return out
+
+def decode_frame(frame, decode=decode_payload):
+    #
+    # Pipeline decode stage: framer.Frame -> (frame, decode(payload)), None
+    # for module responses and payloads that don't decode. Module level and
+    # free of shared state so it can run on a process pool.
+    #
+    if frame.addr is None:
+        print("Received command/config packet from LoRa module")
+        return None
+    try:
+        return frame, decode(frame.payload)
+    except ValueError as e:
+        print(f"Received undecodable data from node 0x{frame.addr:04X}: {e}")
+        print("Payload:", [hex(x) for x in frame.payload])
+        return None
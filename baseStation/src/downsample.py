@@ -0,0 +1,146 @@
+import numpy as np
+
+from store import FIELD_INDEX, json_floats
+
+# A source is only used when the range holds at most this many times the
+# requested points, otherwise the next coarser rollup is tried
+OVERSAMPLE = 8
+
+def lttb(t, y, points):
+    #
+    # Largest-Triangle-Three-Buckets. Returns the indices of the points to
+    # keep. Bucket averages come from a cumulative sum in one pass, the only
+    # Python level loop is one step per output point.
+    #
+    size = len(t)
+    if points >= size or points < 3:
+        return np.arange(size)
+    every = (size - 2) / (points - 2)
+    # bucket k (k = 0 .. points-3) covers [edges[k], edges[k+1])
+    edges = (np.arange(points - 1) * every).astype(np.int64) + 1
+    edges[-1] = size - 1
+    ct = np.concatenate(([0.0], np.cumsum(t)))
+    cy = np.concatenate(([0.0], np.cumsum(y)))
+    # average of the bucket after each one, the last bucket looks at the
+    # final point
+    nlo = edges[1:]
+    nhi = np.append(edges[2:], size)
+    avg_t = (ct[nhi] - ct[nlo]) / (nhi - nlo)
+    avg_y = (cy[nhi] - cy[nlo]) / (nhi - nlo)
+
+    keep = np.empty(points, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = size - 1
+    a = 0
+    for k in range(points - 2):
+        lo, hi = edges[k], edges[k + 1]
+        ta, ya = t[a], y[a]
+        area = np.abs((ta - avg_t[k]) * (y[lo:hi] - ya) - (ta - t[lo:hi]) * (avg_y[k] - ya))
+        a = lo + int(area.argmax())
+        keep[k + 1] = a
+    return keep
+
+def bucket_starts(t, start, end, points):
+    # Index of the first element of every non-empty time bucket when
+    # [start, end) is cut into `points` equal buckets. t must be sorted.
+    edges = np.searchsorted(t, np.linspace(start, end, points + 1))
+    lo, hi = edges[:-1], edges[1:]
+    return lo[lo < hi]
+
+def _sources(history):
+    # Raw samples first, then rollups from fine to coarse, all as
+    # (name, t, n, sum, min, max) with n and sum per field. Raw samples are
+    # buckets of one (n None, sum the values with NaN where missing).
+    t, values = history.ordered()
+    yield 'raw', t, None, values, values, values
+    for rollup in history.rollups:
+        yield (rollup.name,) + tuple(rollup.ordered())
+
+def pick_source(history, start, end, points):
+    #
+    # The finest source with at most OVERSAMPLE * points entries in range,
+    # whether or not it reaches back to start. A finer source is only passed
+    # over for being too dense, or when a coarser one holds older data in
+    # the range (the raw ring has wrapped, rollups keep longer): its first
+    # entry must be within one bucket of the oldest any source has.
+    #
+    widths = [0] + [rollup.resolution for rollup in history.rollups]
+    candidates = []
+    last = None
+    for width, source in zip(widths, _sources(history)):
+        t = source[1]
+        if not len(t):
+            continue
+        lo, hi = np.searchsorted(t, (start, end))
+        last = source + (lo, hi)
+        if hi > lo:
+            candidates.append((width, last))
+    if not candidates:
+        return last
+    oldest, reach = min((chosen[1][chosen[-2]], width) for width, chosen in candidates)
+    for width, chosen in candidates:
+        lo, hi = chosen[-2:]
+        if hi - lo <= points * OVERSAMPLE and chosen[1][lo] < oldest + max(reach, 1):
+            return chosen
+    return candidates[-1][1]
+
+def series(history, fields, start, end, points, method='minmax'):
+    #
+    # At most `points` points per field over [start, end), taken from the
+    # finest source that covers the range without holding more than
+    # OVERSAMPLE * points entries, so the work and the response size follow
+    # the requested point count rather than the number of raw samples.
+    #
+    # minmax: per time bucket min, max and mean, shared timestamps
+    # lttb:   Largest-Triangle-Three-Buckets of the (bucket mean) series,
+    #         each field keeps its own timestamps
+    #
+    if method not in ('minmax', 'lttb'):
+        raise ValueError(f"unknown method: {method}")
+    out = {'source': None, 'method': method, 'series': {}}
+    chosen = pick_source(history, start, end, points)
+    if chosen is None:
+        return out
+    name, t, n, total, low, high, lo, hi = chosen
+    out['source'] = name
+    cols = [FIELD_INDEX[f] for f in fields]
+    t = t[lo:hi]
+    total, low, high = total[lo:hi][:, cols], low[lo:hi][:, cols], high[lo:hi][:, cols]
+    if n is None:
+        # means count only the values that are there
+        n = ~np.isnan(total)
+        total = np.nan_to_num(total, nan=0.0)
+    else:
+        n = n[lo:hi][:, cols]
+
+    if method == 'minmax':
+        starts = bucket_starts(t, start, end, points)
+        if len(starts):
+            count = np.add.reduceat(n, starts, dtype=np.int64)
+            with np.errstate(invalid='ignore'):
+                mean = np.add.reduceat(total, starts) / count
+            bmin = np.fmin.reduceat(low, starts)
+            bmax = np.fmax.reduceat(high, starts)
+        else:
+            mean = bmin = bmax = np.empty((0, len(cols)))
+        stamps = t[starts].tolist()
+        for j, field in enumerate(fields):
+            out['series'][field] = {
+                'timestamp': stamps,
+                'min': json_floats(bmin[:, j]),
+                'max': json_floats(bmax[:, j]),
+                'mean': json_floats(mean[:, j]),
+            }
+    else:
+        with np.errstate(invalid='ignore'):
+            mean = total / n
+        for j, field in enumerate(fields):
+            y = mean[:, j].astype(np.float64)
+            ok = ~np.isnan(y)
+            tj, yj = t[ok], y[ok]
+            keep = lttb(tj, yj, points)
+            out['series'][field] = {
+                'timestamp': tj[keep].tolist(),
+                'value': json_floats(yj[keep]),
+            }
+    return out
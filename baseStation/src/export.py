@@ -0,0 +1,149 @@
+import csv
+import io
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from store import json_floats
+
+#
+# Streaming export of the archive (archive.ColumnStore) as CSV, NDJSON or a
+# columnar binary format. Everything here is a generator over scan()
+# batches, so a response for weeks of data holds one batch at a time.
+#
+# Rows go out node by node (ascending address), oldest first within a node.
+# Every row carries its node and timestamp, which is all a client needs to
+# resume an interrupted download: pass cursor=<node>:<timestamp> of the last
+# row it received completely and the export continues right after it.
+# A resumed CSV export has no header row, so the parts concatenate into one
+# file.
+#
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'binary': 'application/octet-stream',
+}
+
+# Binary stream: header, then one block per batch, then a zero row count
+#
+#   header  b'PNEX' <u16 version> <u16 field count> {<u8 length> <name>}...
+#   block   <u32 rows> <u16 node> <f64 t>[rows] {<f32 value>[rows]}...
+#
+# All little endian, NaN where a value is missing.
+BINARY_MAGIC = b'PNEX'
+BINARY_VERSION = 1
+
+def accepts_gzip(accept_encoding):
+    #
+    # Whether an Accept-Encoding header allows gzip: listed (or covered by
+    # *) with a q-value above 0. An explicit gzip;q=0 refuses it even when
+    # * allows everything.
+    #
+    star = None
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding in ('gzip', 'x-gzip'):
+            return q > 0
+        if coding == '*':
+            star = q > 0
+    return bool(star)
+
+def parse_cursor(cursor):
+    # "node:timestamp" -> (node, timestamp)
+    try:
+        node, t = cursor.split(':', 1)
+        return int(node), float(t)
+    except ValueError:
+        raise ValueError(f"bad cursor {cursor!r}, expected <node>:<timestamp>")
+
+def batches(store, nodes, start, end, fields, cursor=None, batch=4096):
+    # (node, t, columns) for every batch of the selection, after the cursor
+    after = parse_cursor(cursor) if cursor else None
+    for node in sorted(nodes):
+        begin = start
+        if after is not None:
+            if node < after[0]:
+                continue
+            if node == after[0]:
+                # strictly after the cursor row
+                resume = float(np.nextafter(after[1], np.inf))
+                begin = resume if begin is None else max(begin, resume)
+        for t, columns in store.scan(node, begin, end, fields, batch):
+            yield node, t, columns
+
+def csv_stream(parts, fields, header=True):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    if header:
+        writer.writerow(['node', 'timestamp'] + list(fields))
+        yield out.getvalue()
+    for node, t, columns in parts:
+        out.seek(0)
+        out.truncate()
+        values = [json_floats(columns[f]) for f in fields]
+        writer.writerows(zip([node] * len(t), t.tolist(),
+                             *[['' if v is None else v for v in col] for col in values]))
+        yield out.getvalue()
+
+def ndjson_stream(parts, fields):
+    for node, t, columns in parts:
+        values = [json_floats(columns[f]) for f in fields]
+        lines = []
+        for i, stamp in enumerate(t.tolist()):
+            row = {'node': node, 'timestamp': stamp}
+            for field, col in zip(fields, values):
+                row[field] = col[i]
+            lines.append(json.dumps(row, separators=(',', ':')))
+        lines.append('')
+        yield '\n'.join(lines)
+
+def binary_stream(parts, fields):
+    header = bytearray(BINARY_MAGIC + struct.pack('<HH', BINARY_VERSION, len(fields)))
+    for field in fields:
+        name = field.encode()
+        header += struct.pack('<B', len(name)) + name
+    yield bytes(header)
+    for node, t, columns in parts:
+        yield struct.pack('<IH', len(t), node)
+        yield np.ascontiguousarray(t, dtype='<f8').tobytes()
+        for field in fields:
+            yield np.ascontiguousarray(columns[field], dtype='<f4').tobytes()
+    yield struct.pack('<I', 0)
+
+def gzip_stream(chunks, level=6):
+    # gzip framing around a stream of str/bytes, flushed every chunk so the
+    # client sees data as it is produced
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export(store, nodes, start, end, fields, fmt='csv', cursor=None, gzip=False):
+    parts = batches(store, nodes, start, end, fields, cursor)
+    if fmt == 'csv':
+        stream = csv_stream(parts, fields, header=not cursor)
+    elif fmt == 'ndjson':
+        stream = ndjson_stream(parts, fields)
+    elif fmt == 'binary':
+        stream = binary_stream(parts, fields)
+    else:
+        raise ValueError(f"unknown format: {fmt}")
+    if gzip:
+        return gzip_stream(stream)
+    return (chunk.encode() if isinstance(chunk, str) else chunk for chunk in stream)
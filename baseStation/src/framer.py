@@ -0,0 +1,226 @@
+import re
+from collections import namedtuple
+
+from codec import RECORD_SIZES
+
+#
+# What a packet looks like when it comes out of the module UART.
+#
+# The sensor node writes
+#   [dest_hi][dest_lo][dest_freq][own_hi][own_lo][own_freq][payload]
+# (see sendMessage in sensor/src/main.cpp). In fixed transmission mode the
+# sending module eats the destination triple, so the base station gets
+#   [addr_hi][addr_lo][freq_offset][payload ...][rssi]
+# with the trailing rssi byte only there when packet RSSI output is enabled.
+#
+# The UART stream has no length field or delimiter, so the end of the
+# payload is found from the payload itself: a binary record has a fixed size
+# given by its type byte (see codec.py), a JSON object ends on the brace that
+# closes the first one.
+#
+# Module responses to register commands (0xC1 ...) share the stream and are
+# returned as frames with addr None and the whole response as payload. They
+# are checked for before anything else, a register value inside one could
+# otherwise pass for a payload start.
+#
+# After garbage the framer resynchronises on the next byte that can start a
+# payload. To avoid locking on to a stray '{' or type byte inside binary
+# data, a JSON payload must open with '{"' (as the firmware writes it) and,
+# when the reader knows its channel, the header's channel byte must match.
+#
+Frame = namedtuple("Frame", "addr freq_offset payload rssi arrived")
+
+HEADER_SIZE = 3
+JSON_START = 0x7B       # '{'
+JSON_QUOTE = 0x22       # '"', always follows the opening brace
+RESPONSE_HEAD = 0xC1
+# registers 0x00..0x08 plus the 3 byte response header
+RESPONSE_MAX_LEN = 9
+
+# what _classify() makes of a possible frame start
+_NOT_A_FRAME, _NEED_MORE, _RECORD, _JSON = range(4)
+
+_BRACES = re.compile(rb"[{}]")
+_PAYLOAD_START = re.compile(b"[" + b"".join(re.escape(bytes([k])) for k in
+                                           sorted(RECORD_SIZES) + [JSON_START]) + b"]")
+
+class FrameReader:
+    #
+    # Incremental framer. Feed it whatever the serial port returned, in any
+    # chunk size, and iterate the result for the frames that are complete.
+    # Bytes of a frame that is not complete yet stay in the buffer until the
+    # next feed().
+    #
+    # Data is copied once into a reusable bytearray, scanning resumes where
+    # the previous feed stopped and never decodes, so the cost per byte does
+    # not depend on how the stream was chunked.
+    #
+    def __init__(self, rssi=True, capacity=4096, max_payload=1024, channel=None):
+        self.rssi = rssi
+        self.channel = channel
+        self.max_payload = max_payload
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0         # first byte of the frame being assembled
+        self._end = 0           # one past the last buffered byte
+        self._scan = -1         # brace scan position, -1 before the payload
+        self._depth = 0
+        self._arrived = None
+        self.frames = 0
+        self.responses = 0
+        self.dropped = 0        # bytes thrown away while resynchronising
+
+    def feed(self, chunk, arrived=None):
+        n = len(chunk)
+        if n:
+            if self._end + n > len(self._buf):
+                self._make_room(n)
+            self._view[self._end:self._end + n] = chunk
+            if self._start == self._end:
+                self._arrived = arrived
+            self._end += n
+        return self._frames()
+
+    def pending(self):
+        return self._end - self._start
+
+    def reset(self):
+        self._start = self._end = 0
+        self._scan = -1
+        self._depth = 0
+        self._arrived = None
+
+    def _make_room(self, n):
+        live = self._end - self._start
+        size = len(self._buf)
+        if live + n > size:
+            while live + n > size:
+                size *= 2
+            buf = bytearray(size)
+            buf[:live] = self._view[self._start:self._end]
+            self._view.release()
+            self._buf = buf
+            self._view = memoryview(buf)
+        else:
+            # slide the unfinished frame to the front, copying through bytes
+            # because the regions may overlap
+            self._view[:live] = bytes(self._view[self._start:self._end])
+        if self._scan >= 0:
+            self._scan -= self._start
+        self._start = 0
+        self._end = live
+
+    def _frames(self):
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def _next_frame(self):
+        buf = self._buf
+        while True:
+            start, end = self._start, self._end
+            if self._scan < 0:
+                if end - start <= HEADER_SIZE:
+                    return None
+                # a module response first: its value bytes (a dBm reading
+                # of 0xB1, say) can look like the start of a payload
+                if (buf[start] == RESPONSE_HEAD
+                        and buf[start + 1] + buf[start + 2] <= RESPONSE_MAX_LEN):
+                    length = HEADER_SIZE + buf[start + 2]
+                    if end - start < length:
+                        return None
+                    self.responses += 1
+                    return self._emit(None, None, start, start + length, None,
+                                      start + length)
+                kind = self._classify(start, end)
+                if kind == _RECORD:
+                    self._scan = start + HEADER_SIZE + RECORD_SIZES[buf[start + HEADER_SIZE]]
+                    if self._scan > end:
+                        self._scan = -1
+                        return None
+                elif kind == _JSON:
+                    self._scan = start + HEADER_SIZE + 1
+                    self._depth = 1
+                elif kind == _NEED_MORE:
+                    return None
+                else:
+                    self._resync(start + 1)
+                    continue
+
+            # walk brace to brace until the opening one is closed
+            while self._depth:
+                m = _BRACES.search(buf, self._scan, end)
+                if m is None:
+                    self._scan = end
+                    if end - start > HEADER_SIZE + self.max_payload:
+                        # never closed, treat the opening byte as garbage
+                        self._resync(start + 1)
+                        break
+                    return None
+                self._depth += 1 if buf[m.start()] == JSON_START else -1
+                self._scan = m.end()
+            if self._scan < 0:
+                continue
+
+            payload_end = self._scan
+            if self.rssi:
+                if payload_end >= end:
+                    return None
+                rssi = buf[payload_end]
+                frame_end = payload_end + 1
+            else:
+                rssi = None
+                frame_end = payload_end
+            self.frames += 1
+            return self._emit((buf[start] << 8) | buf[start + 1], buf[start + 2],
+                              start + HEADER_SIZE, payload_end, rssi, frame_end)
+
+    def _emit(self, addr, freq_offset, payload_start, payload_end, rssi, frame_end):
+        frame = Frame(addr, freq_offset,
+                      bytes(self._view[payload_start:payload_end]),
+                      rssi, self._arrived)
+        self._scan = -1
+        self._depth = 0
+        if frame_end == self._end:
+            self._start = self._end = 0
+            self._arrived = None
+        else:
+            self._start = frame_end
+        return frame
+
+    def _classify(self, start, end):
+        # Could a frame start at `start`? Needs the header and first payload
+        # byte to be buffered.
+        buf = self._buf
+        if self.channel is not None and buf[start + 2] != self.channel:
+            return _NOT_A_FRAME
+        kind = buf[start + HEADER_SIZE]
+        if kind in RECORD_SIZES:
+            return _RECORD
+        if kind == JSON_START:
+            if start + HEADER_SIZE + 1 >= end:
+                return _NEED_MORE
+            if buf[start + HEADER_SIZE + 1] == JSON_QUOTE:
+                return _JSON
+        return _NOT_A_FRAME
+
+    def _resync(self, pos):
+        # Skip ahead to the next place a frame could start
+        self._scan = -1
+        self._depth = 0
+        end = self._end
+        new_start = max(pos, end - HEADER_SIZE)
+        search = pos + HEADER_SIZE
+        while True:
+            m = _PAYLOAD_START.search(self._buf, search, end)
+            if m is None:
+                break
+            candidate = m.start() - HEADER_SIZE
+            if self._classify(candidate, end) != _NOT_A_FRAME:
+                new_start = candidate
+                break
+            search = m.start() + 1
+        self.dropped += new_start - self._start
+        self._start = new_start
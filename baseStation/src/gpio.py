@@ -0,0 +1,113 @@
+import glob
+import os
+
+#
+# GPIO backends for the M0/M1 mode pins of the LoRa modules. sx126x only
+# needs two calls, setup(pin) to make a pin an output and output(pin, high),
+# so any way of driving a pin will do:
+#
+#   rpi    RPi.GPIO, imported only when this backend is picked
+#   sysfs  /sys/class/gpio, no Python package needed
+#   none   remembers the levels and does nothing, for hardware with M0/M1
+#          strapped, virtual devices and running off the Pi
+#
+# LORA_GPIO picks one; by default it is rpi when RPi.GPIO imports, sysfs
+# when the kernel has it and none otherwise.
+#
+
+class NullGPIO:
+    name = 'none'
+
+    def __init__(self):
+        self.levels = {}
+
+    def setup(self, pin):
+        self.levels.setdefault(pin, False)
+
+    def output(self, pin, high):
+        self.levels[pin] = bool(high)
+
+    def close(self):
+        pass
+
+class RPiGPIO:
+    name = 'rpi'
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+
+    def setup(self, pin):
+        self.GPIO.setup(pin, self.GPIO.OUT)
+
+    def output(self, pin, high):
+        self.GPIO.output(pin, self.GPIO.HIGH if high else self.GPIO.LOW)
+
+    def close(self):
+        pass
+
+class SysfsGPIO:
+    #
+    # Pins are BCM numbers. Newer kernels number sysfs GPIOs from the base
+    # of the SoC's gpiochip (512 and up) instead of 0, `base` is that offset
+    # and by default read from the chip whose label starts with "pinctrl".
+    #
+    name = 'sysfs'
+
+    def __init__(self, root='/sys/class/gpio', base=None):
+        self.root = root
+        self.base = self.find_base(root) if base is None else base
+        self._files = {}
+
+    @staticmethod
+    def find_base(root='/sys/class/gpio'):
+        for chip in sorted(glob.glob(os.path.join(root, 'gpiochip*'))):
+            try:
+                with open(os.path.join(chip, 'label')) as f:
+                    label = f.read().strip()
+                if label.startswith('pinctrl'):
+                    with open(os.path.join(chip, 'base')) as f:
+                        return int(f.read())
+            except (OSError, ValueError):
+                continue
+        return 0
+
+    def setup(self, pin):
+        number = self.base + pin
+        path = os.path.join(self.root, f"gpio{number}")
+        if not os.path.exists(path):
+            with open(os.path.join(self.root, 'export'), 'w') as f:
+                f.write(str(number))
+        with open(os.path.join(path, 'direction'), 'w') as f:
+            f.write('out')
+        # kept open, a level change is then one write
+        self._files[pin] = open(os.path.join(path, 'value'), 'w', buffering=1)
+
+    def output(self, pin, high):
+        f = self._files[pin]
+        f.seek(0)
+        f.write('1' if high else '0')
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+BACKENDS = {'rpi': RPiGPIO, 'sysfs': SysfsGPIO, 'none': NullGPIO}
+
+def backend(name=None):
+    name = name or os.environ.get('LORA_GPIO')
+    if name is not None:
+        if name not in BACKENDS:
+            raise ValueError(f"unknown GPIO backend {name!r}, expected one of "
+                             f"{', '.join(BACKENDS)}")
+        return BACKENDS[name]()
+    try:
+        return RPiGPIO()
+    except (ImportError, RuntimeError):
+        pass
+    if os.path.isdir('/sys/class/gpio'):
+        return SysfsGPIO()
+    return NullGPIO()
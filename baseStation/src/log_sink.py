@@ -0,0 +1,165 @@
+import csv
+import datetime
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+CSV_HEADER = [
+    'Timestamp',
+    'Orient_X', 'Orient_Y', 'Orient_Z',
+    'Gyro_X', 'Gyro_Y', 'Gyro_Z',
+    'Accel_X', 'Accel_Y', 'Accel_Z',
+    'Mag_X', 'Mag_Y', 'Mag_Z',
+    'Cal_Sys', 'Cal_Gyro', 'Cal_Accel', 'Cal_Mag',
+    'RSSI'
+]
+
+class CsvLogSink:
+    #
+    # Long lived CSV log writer.
+    #
+    # write() only puts the row on a queue, a background thread owns the file
+    # and writes rows in batches, so a slow SD card never holds up the serial
+    # receiver. If the writer falls behind by more than `max_pending` rows new
+    # rows are dropped (and counted) instead of blocking.
+    #
+    # Buffered rows reach the OS after `flush_rows` rows or `flush_interval`
+    # seconds, whichever comes first, and always on close(). With
+    # `fsync_interval` set the file is also fsync'ed at most that many seconds
+    # apart, trading some throughput for a bounded loss window on power cut.
+    #
+    # Files are named <prefix>_YYYYmmdd_HHMMSS.csv under `directory`. With
+    # rotate='hour' a new file starts on every hour (named for the hour), with
+    # rotate='size' when the current one passes `max_bytes`.
+    #
+    def __init__(self, directory='logs', prefix='sensor_data', header=CSV_HEADER,
+                 rotate='size', max_bytes=64 * 1024 * 1024,
+                 flush_rows=100, flush_interval=1.0, fsync_interval=None,
+                 max_pending=10000):
+        if rotate not in ('size', 'hour', None):
+            raise ValueError(f"unknown rotate mode: {rotate}")
+        self.directory = directory
+        self.prefix = prefix
+        self.header = header
+        self.rotate = rotate
+        self.max_bytes = max_bytes
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.rows = 0
+        self.dropped = 0
+        self.files = 0
+        self.path = None
+        self._queue = queue.Queue(max_pending)
+        self._file = None
+        self._writer = None
+        self._hour = None
+        self._closed = False
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="csv-log", daemon=True)
+        self._thread.start()
+
+    def write(self, row):
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _open(self, now):
+        if self.rotate == 'hour':
+            stamp = now.replace(minute=0, second=0, microsecond=0)
+        else:
+            stamp = now
+        name = f"{self.prefix}_{stamp.strftime('%Y%m%d_%H%M%S')}"
+        path = os.path.join(self.directory, name + '.csv')
+        n = 1
+        while os.path.exists(path) and self.rotate != 'hour':
+            path = os.path.join(self.directory, f"{name}_{n}.csv")
+            n += 1
+        new_file = not os.path.exists(path)
+        self._file = open(path, 'a', newline='', buffering=64 * 1024)
+        self._writer = csv.writer(self._file)
+        if new_file:
+            self._writer.writerow(self.header)
+        self._hour = now.hour
+        self.path = path
+        self.files += 1
+
+    def _close_file(self, sync):
+        if self._file is None:
+            return
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def _needs_rotation(self, now):
+        if self._file is None:
+            return True
+        if self.rotate == 'hour':
+            return now.hour != self._hour
+        if self.rotate == 'size':
+            return self._file.tell() >= self.max_bytes
+        return False
+
+    def _run(self):
+        unflushed = 0
+        unsynced = False
+        last_flush = last_sync = time.monotonic()
+        done = False
+        while not done:
+            # sleep until the next row, or until a flush/fsync falls due
+            if unflushed:
+                timeout = max(0.0, last_flush + self.flush_interval - time.monotonic())
+            elif unsynced:
+                timeout = max(0.0, last_sync + self.fsync_interval - time.monotonic())
+            else:
+                timeout = None
+            batch = []
+            try:
+                row = self._queue.get(timeout=timeout)
+                while row is not None:
+                    batch.append(row)
+                    if len(batch) >= self.flush_rows:
+                        break
+                    row = self._queue.get_nowait()
+                done = row is None
+            except queue.Empty:
+                pass
+
+            started = time.perf_counter()
+            if batch:
+                now = datetime.datetime.now()
+                if self._needs_rotation(now):
+                    self._close_file(self.fsync_interval is not None)
+                    self._open(now)
+                self._writer.writerows(batch)
+                self.rows += len(batch)
+                unflushed += len(batch)
+
+            mono = time.monotonic()
+            if unflushed and (done or unflushed >= self.flush_rows
+                              or mono - last_flush >= self.flush_interval):
+                self._file.flush()
+                unflushed = 0
+                last_flush = mono
+                unsynced = self.fsync_interval is not None
+            if unsynced and (done or mono - last_sync >= self.fsync_interval):
+                os.fsync(self._file.fileno())
+                unsynced = False
+                last_sync = mono
+            if batch:
+                metrics.csv_write_seconds.observe(time.perf_counter() - started)
+                metrics.csv_batch_rows.observe(len(batch))
+        self._close_file(self.fsync_interval is not None)
@@ -0,0 +1,235 @@
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+
+#
+# Counters and histograms in the Prometheus text exposition format, without
+# the client library.
+#
+# Metrics are created once at import time and their children (one per label
+# value) on first use, so the per-packet cost is an attribute increment or a
+# bisect into a preallocated bucket list, no allocation. Updates are not
+# locked: every hot path update happens on the event loop thread or a single
+# writer thread, and a scrape reading a value mid-update only sees it one
+# sample early or late.
+#
+# Values that already exist as counters somewhere (receiver bytes, framer
+# frames, pipeline queue depths, ...) are not duplicated, register_collector()
+# reads them when /metrics is scraped.
+#
+
+# Upper bounds in seconds for latency histograms, 100 µs .. 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RSSI_BUCKETS = (-120, -110, -100, -90, -80, -70, -60, -50, -40, -30)
+
+# Time every Nth item per pipeline stage into stage_seconds, 0 turns it off.
+# METRICS_STAGE_SAMPLE=1 times every item.
+STAGE_SAMPLE = int(os.environ.get('METRICS_STAGE_SAMPLE', '0'))
+
+# Children beyond this many label sets share one 'other' child, so a
+# misbehaving sender can't grow the registry without bound
+MAX_CHILDREN = 64
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for k, v in pairs) + '}'
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # one slot per bound plus +Inf, not cumulative until rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class RateMeter:
+    #
+    # Events per second over the last `window` whole seconds, counted into
+    # one second buckets as they happen, so the rate reads the same however
+    # often (or rarely) something asks for it. The second in progress is
+    # left out, it is still filling.
+    #
+    __slots__ = ('window', '_counts', '_seconds')
+
+    def __init__(self, window=10):
+        self.window = window
+        self._counts = [0] * (window + 1)
+        self._seconds = [-1] * (window + 1)
+
+    def add(self, amount=1):
+        second = int(time.monotonic())
+        i = second % len(self._counts)
+        if self._seconds[i] != second:
+            self._seconds[i] = second
+            self._counts[i] = 0
+        self._counts[i] += amount
+
+    def rate(self):
+        second = int(time.monotonic())
+        total = sum(count for s, count in zip(self._seconds, self._counts)
+                    if second - self.window <= s < second)
+        return total / self.window
+
+class Metric:
+    #
+    # A metric with zero or more label names. Without labels the metric
+    # itself forwards inc()/observe() to its single child.
+    #
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    if len(self._children) >= MAX_CHILDREN:
+                        values = ('other',) * len(self.labelnames)
+                        child = self._children.get(values)
+                    if child is None:
+                        child = self._children[values] = self._new_child()
+        return child
+
+    def samples(self):
+        # (suffix, label text, value) lines for the exposition format
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield '_total', _format_labels(self.labelnames, values), child.value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                yield '_bucket', _format_labels(self.labelnames, values,
+                                                (('le', _format_value(float(bound))),)), cumulative
+            yield '_sum', _format_labels(self.labelnames, values), child.sum
+            yield '_count', _format_labels(self.labelnames, values), child.count
+
+class Registry:
+    def __init__(self, prefix='polar_'):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self.prefix + name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, name, help, kind, collect, labels=()):
+        #
+        # A metric read at scrape time: collect() returns a number, or with
+        # label names a dict of label value tuples to numbers. kind is
+        # 'counter' or 'gauge'.
+        #
+        self._collectors.append((self.prefix + name, help, kind, collect, tuple(labels)))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{labels} {_format_value(value)}")
+        for name, help, kind, collect, labelnames in self._collectors:
+            try:
+                result = collect()
+            except Exception as e:
+                lines.append(f"# collector {name} failed: {e}")
+                continue
+            suffix = '_total' if kind == 'counter' else ''
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            items = result.items() if labelnames else (((), result),)
+            for values, value in items:
+                lines.append(f"{name}{suffix}{_format_labels(labelnames, values)} "
+                             f"{_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+# The registry shared by the receive path and the web server
+registry = Registry()
+
+# Receive path metrics updated per packet
+decode_errors = registry.counter(
+    'decode_errors', "Frames from a node whose payload did not decode", ('format',))
+config_packets = registry.counter(
+    'config_packets', "Responses from the LoRa module itself (0xC1 ...)")
+node_packets = registry.counter(
+    'node_packets', "Decoded packets per sender address", ('node',))
+node_rssi = registry.histogram(
+    'node_rssi_dbm', "RSSI of decoded packets per sender address", ('node',), RSSI_BUCKETS)
+csv_write_seconds = registry.histogram(
+    'csv_write_seconds', "Time to write one batch of rows to the CSV log, flush and fsync included")
+csv_batch_rows = registry.histogram(
+    'csv_batch_rows', "Rows per CSV write batch", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+publish_seconds = registry.histogram(
+    'dashboard_publish_seconds', "Time from the first byte of a packet to its sample on the bus")
+stage_seconds = registry.histogram(
+    'stage_seconds', "Sampled processing time of one item per pipeline stage", ('stage',))
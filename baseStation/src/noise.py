@@ -0,0 +1,165 @@
+import asyncio
+import time
+
+import numpy as np
+
+from store import json_floats
+
+# C0 C1 C2 C3 <start> <length>: read the noise floor (register 0) and the
+# last packet RSSI (register 1) in normal mode
+NOISE_CMD = bytes([0xC0, 0xC1, 0xC2, 0xC3, 0x00, 0x02])
+NOISE_RESPONSE = bytes([0xC1, 0x00, 0x02])
+
+class NoiseHistory:
+    #
+    # Ring buffer of noise floor readings for one channel, plus running
+    # count/min/max/sum over everything seen since start.
+    #
+    def __init__(self, channel, capacity):
+        self.channel = channel
+        self.capacity = capacity
+        self.t = np.zeros(capacity, dtype=np.float64)
+        self.dbm = np.zeros(capacity, dtype=np.float32)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def append(self, t, dbm):
+        i = self.count % self.capacity
+        self.t[i] = t
+        self.dbm[i] = dbm
+        self.count += 1
+        self.total += dbm
+        self.min = dbm if self.min is None else min(self.min, dbm)
+        self.max = dbm if self.max is None else max(self.max, dbm)
+        self.last = dbm
+
+    def ordered(self):
+        if self.count <= self.capacity:
+            return self.t[:self.count], self.dbm[:self.count]
+        i = self.count % self.capacity
+        return (np.concatenate((self.t[i:], self.t[:i])),
+                np.concatenate((self.dbm[i:], self.dbm[:i])))
+
+    def floor(self):
+        # Median of the readings still in the buffer, the noise floor used
+        # for link margins (a median so a burst of interference doesn't move it)
+        _, dbm = self.ordered()
+        return float(np.median(dbm)) if len(dbm) else None
+
+    def summary(self):
+        _, dbm = self.ordered()
+        out = {
+            'channel': self.channel,
+            'samples': self.count,
+            'last_dbm': self.last,
+            'min_dbm': self.min,
+            'max_dbm': self.max,
+            'mean_dbm': round(self.total / self.count, 2) if self.count else None,
+        }
+        if len(dbm):
+            p10, p50, p90 = np.percentile(dbm, (10, 50, 90))
+            out.update(p10_dbm=float(p10), p50_dbm=float(p50), p90_dbm=float(p90))
+        return out
+
+class NoiseSampler:
+    #
+    # Samples the channel noise floor through the module's RSSI command
+    # while the line is idle.
+    #
+    # Every `interval` seconds, once idle() is true (nothing arriving, no
+    # partial frame, nothing being sent), the command is written and the
+    # task goes back to sleep. The module's answer comes in through the
+    # normal receive path like any other frame; the decode stage hands
+    # module responses to handle(), which records them. Nothing is flushed
+    # and nothing waits on the serial port, so a packet arriving around the
+    # request is framed as usual.
+    #
+    # start()/stop() match the service hooks in web_server.
+    #
+    def __init__(self, node, idle=None, interval=5.0, capacity=720, timeout=1.0,
+                 poll=0.05):
+        self.node = node
+        self.idle = idle or (lambda: True)
+        self.interval = interval
+        self.capacity = capacity
+        self.timeout = timeout
+        self.poll = poll
+        self.channels = {}
+        self.requests = 0
+        self.responses = 0
+        self.missed = 0
+        self._outstanding = None
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def handle(self, frame):
+        # True when the frame was the answer to a noise request
+        payload = frame.payload
+        if len(payload) < 5 or payload[:3] != NOISE_RESPONSE:
+            return False
+        if self._outstanding is None:
+            # late answer after a timeout, or someone else asked
+            return True
+        channel, _ = self._outstanding
+        self._outstanding = None
+        self.responses += 1
+        dbm = payload[3] - 256
+        history = self.channels.get(channel)
+        if history is None:
+            history = self.channels[channel] = NoiseHistory(channel, self.capacity)
+        history.append(time.time(), dbm)
+        return True
+
+    def floor(self, channel=None):
+        history = self.channels.get(self.node.offset_freq if channel is None else channel)
+        return history.floor() if history is not None else None
+
+    def summary(self):
+        out = []
+        for channel, history in sorted(self.channels.items()):
+            entry = history.summary()
+            entry['freq'] = self.node.start_freq + channel
+            out.append(entry)
+        return out
+
+    def history(self, channel, since=None):
+        history = self.channels.get(channel)
+        if history is None:
+            return None
+        t, dbm = history.ordered()
+        if since is not None:
+            keep = t > since
+            t, dbm = t[keep], dbm[keep]
+        return {'timestamp': t.tolist(), 'noise_dbm': json_floats(dbm)}
+
+    def stats(self):
+        return {'requests': self.requests, 'responses': self.responses,
+                'missed': self.missed, 'channels': self.summary()}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._outstanding is not None:
+                if time.monotonic() - self._outstanding[1] < self.timeout:
+                    continue
+                self.missed += 1
+                self._outstanding = None
+            while not self.idle():
+                await asyncio.sleep(self.poll)
+            self._outstanding = (self.node.offset_freq, time.monotonic())
+            self.requests += 1
+            try:
+                self.node.send(NOISE_CMD)
+            except Exception as e:
+                print(f"Noise floor request failed: {e}")
+                self._outstanding = None
@@ -0,0 +1,218 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+
+# What to do when the queue in front of a stage or sink is full:
+#   block        wait for room (backpressure on the stage before it)
+#   drop_new     discard the item being offered
+#   drop_oldest  discard the oldest queued item to make room
+POLICIES = ('block', 'drop_new', 'drop_oldest')
+
+class Stage:
+    #
+    # One step of the pipeline: a bounded queue in front of `fn`.
+    #
+    # fn(item) returns the item for the next stage, None to drop it, or with
+    # many=True an iterable of items. With executor='thread' or 'process' fn
+    # runs on a pool of `workers` so CPU heavy work stays off the event loop
+    # (a process pool needs fn and the items to be picklable). More than one
+    # worker means items can leave the stage out of order.
+    #
+    def __init__(self, name, fn, maxsize=256, policy='block', many=False,
+                 executor=None, workers=1):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy: {policy}")
+        if executor not in (None, 'thread', 'process'):
+            raise ValueError(f"unknown executor: {executor}")
+        self.name = name
+        self.fn = fn
+        self.maxsize = maxsize
+        self.policy = policy
+        self.many = many
+        self.executor = executor
+        self.workers = workers
+        self.queue = None
+        self.received = 0
+        self.processed = 0
+        self.emitted = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy = 0.0
+        self._pool = None
+        self._timer = metrics.stage_seconds.labels(name)
+        self._until_sample = 0
+        self._rate = metrics.RateMeter()
+
+    def offer_nowait(self, item):
+        # Enqueue without waiting, 'block' falls back to dropping the item
+        queue = self.queue
+        self.received += 1
+        if queue.full():
+            if self.policy == 'drop_oldest':
+                queue.get_nowait()
+                queue.task_done()
+            else:
+                self.dropped += 1
+                return False
+            self.dropped += 1
+        queue.put_nowait(item)
+        return True
+
+    async def offer(self, item):
+        if self.policy == 'block':
+            self.received += 1
+            await self.queue.put(item)
+            return True
+        return self.offer_nowait(item)
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize() if self.queue is not None else 0,
+            'maxsize': self.maxsize,
+            'policy': self.policy,
+            'received': self.received,
+            'processed': self.processed,
+            'emitted': self.emitted,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'busy_seconds': round(self.busy, 6),
+            # items per second over the last RateMeter window
+            'rate': round(self._rate.rate(), 3),
+        }
+
+class Pipeline:
+    #
+    # receive -> stage -> stage ... -> fan-out to sinks
+    #
+    # Every stage and every sink has its own bounded queue and task(s) on the
+    # event loop, so a slow sink only fills its own queue and, depending on
+    # its policy, drops or pushes back instead of setting the pace for the
+    # whole chain. stats() shows depth and throughput per stage, the stage
+    # whose queue stays full is the one limiting the packet rate.
+    #
+    # With sample_every set every Nth item per stage is also timed into the
+    # stage_seconds histogram on /metrics (METRICS_STAGE_SAMPLE by default).
+    #
+    # start()/stop() match the service hooks in web_server, drain() lets
+    # what is still queued reach the sinks before stop() cancels the tasks.
+    #
+    def __init__(self, stages=(), sinks=(), sample_every=None, drain_timeout=2.0):
+        self.stages = list(stages)
+        self.sinks = list(sinks)
+        self.sample_every = metrics.STAGE_SAMPLE if sample_every is None else sample_every
+        self.drain_timeout = drain_timeout
+        self._tasks = []
+
+    def all_stages(self):
+        return self.stages + self.sinks
+
+    def start(self):
+        for stage in self.all_stages():
+            stage.queue = asyncio.Queue(stage.maxsize)
+            if stage.executor == 'thread':
+                stage._pool = ThreadPoolExecutor(stage.workers, thread_name_prefix=stage.name)
+            elif stage.executor == 'process':
+                stage._pool = ProcessPoolExecutor(stage.workers)
+        for i, stage in enumerate(self.stages):
+            targets = [self.stages[i + 1]] if i + 1 < len(self.stages) else self.sinks
+            for _ in range(stage.workers):
+                self._tasks.append(asyncio.create_task(self._work(stage, targets)))
+        for sink in self.sinks:
+            for _ in range(sink.workers):
+                self._tasks.append(asyncio.create_task(self._work(sink, ())))
+
+    async def drain(self, timeout=None):
+        # Wait until every queue, stage by stage down to the sinks, is empty
+        # and its items handled, for at most `timeout` seconds (drain_timeout
+        # by default). True when everything made it through.
+        if not self._tasks:
+            return True
+        async def joined():
+            for stage in self.all_stages():
+                await stage.queue.join()
+        try:
+            await asyncio.wait_for(joined(), self.drain_timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            left = {s.name: s.queue.qsize() for s in self.all_stages() if s.queue.qsize()}
+            print(f"Pipeline stopped with items still queued: {left}")
+            return False
+        return True
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for stage in self.all_stages():
+            if stage._pool is not None:
+                stage._pool.shutdown(wait=False, cancel_futures=True)
+                stage._pool = None
+
+    def submit_nowait(self, item):
+        # Entry point for callbacks that can't wait (the serial reader)
+        return self.stages[0].offer_nowait(item)
+
+    async def submit(self, item):
+        return await self.stages[0].offer(item)
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.all_stages()}
+
+    def register_metrics(self, registry=metrics.registry):
+        # Queue depth and item counts per stage, read when /metrics is scraped
+        def per_stage(attr):
+            return lambda: {(s.name,): attr(s) for s in self.all_stages()}
+        for name, help, kind, attr in (
+                ('stage_queue_depth', "Items waiting in front of a pipeline stage", 'gauge',
+                 lambda s: s.queue.qsize() if s.queue is not None else 0),
+                ('stage_processed', "Items processed by a pipeline stage", 'counter',
+                 lambda s: s.processed),
+                ('stage_dropped', "Items dropped because a stage queue was full", 'counter',
+                 lambda s: s.dropped),
+                ('stage_errors', "Items whose stage function raised", 'counter',
+                 lambda s: s.errors),
+                ('stage_busy_seconds', "Time spent in a pipeline stage function", 'counter',
+                 lambda s: s.busy)):
+            registry.register_collector(name, help, kind, per_stage(attr), ('stage',))
+
+    async def _work(self, stage, targets):
+        loop = asyncio.get_running_loop()
+        queue = stage.queue
+        sample_every = self.sample_every
+        while True:
+            item = await queue.get()
+            # task_done() on every way out, drain() joins the queues
+            try:
+                start = time.perf_counter()
+                try:
+                    if stage._pool is None:
+                        result = stage.fn(item)
+                        if stage.many:
+                            result = list(result)
+                    else:
+                        result = await loop.run_in_executor(stage._pool, stage.fn, item)
+                        if stage.many:
+                            result = list(result)
+                except Exception as e:
+                    stage.errors += 1
+                    print(f"Pipeline stage {stage.name} failed: {e}")
+                    continue
+                finally:
+                    elapsed = time.perf_counter() - start
+                    stage.busy += elapsed
+                    if sample_every:
+                        stage._until_sample -= 1
+                        if stage._until_sample <= 0:
+                            stage._until_sample = sample_every
+                            stage._timer.observe(elapsed)
+                stage.processed += 1
+                stage._rate.add()
+                if result is None:
+                    continue
+                for out in (result if stage.many else (result,)):
+                    stage.emitted += 1
+                    for target in targets:
+                        await target.offer(out)
+            finally:
+                queue.task_done()
@@ -0,0 +1,246 @@
+import json
+import os
+from collections import deque
+
+import metrics
+from framer import FrameReader
+from noise import NoiseSampler
+from receiver import AsyncReceiver
+from transmitter import TransmitQueue
+
+#
+# Radio modules the base station runs, read from a JSON file like
+# radios.example.json:
+#
+#   {
+#     "duplicate_window": 0.5,
+#     "radios": [
+#       {"name": "433", "port": "/dev/ttyACM0", "freq": 433, "m0": 22, "m1": 27},
+#       {"name": "440", "port": "/dev/ttyACM1", "freq": 440, "net_id": 1,
+#        "m0": 23, "m1": 24}
+#     ]
+#   }
+#
+# Every key but port is optional, see RADIO_DEFAULTS. Without a config file
+# one radio runs on LORA_PORT (or /dev/ttyACM0) with the defaults.
+#
+RADIO_DEFAULTS = {
+    'freq': 433,
+    'addr': 0,
+    'net_id': 0,
+    'power': 22,
+    'rssi': True,
+    'air_speed': 2400,
+    'buffer_size': 240,
+    'm0': 22,
+    'm1': 27,
+    'duty_cycle': 0.1,
+    'noise_interval': 5.0,
+}
+
+# Same node and payload heard by another radio within this many seconds
+# counts as one packet
+DUPLICATE_WINDOW = 0.5
+
+def load_config(path=None):
+    #
+    # (radio settings list, duplicate window). `path` defaults to
+    # LORA_CONFIG, then radios.json in the working directory.
+    #
+    if path is None:
+        path = os.environ.get('LORA_CONFIG')
+        if path is None and os.path.exists('radios.json'):
+            path = 'radios.json'
+    if path is None:
+        config = {'radios': [{'name': 'radio0',
+                              'port': os.environ.get('LORA_PORT', '/dev/ttyACM0')}]}
+    else:
+        with open(path) as f:
+            config = json.load(f)
+
+    radios = []
+    for i, entry in enumerate(config.get('radios', ())):
+        if 'port' not in entry:
+            raise ValueError(f"radio {i} in {path} has no port")
+        unknown = set(entry) - set(RADIO_DEFAULTS) - {'name', 'port'}
+        if unknown:
+            raise ValueError(f"radio {i} in {path}: unknown keys {sorted(unknown)}")
+        radios.append(dict(RADIO_DEFAULTS, name=f"radio{i}") | entry)
+    if not radios:
+        raise ValueError(f"no radios configured in {path}")
+    for key in ('name', 'port'):
+        values = [r[key] for r in radios]
+        if len(set(values)) != len(values):
+            raise ValueError(f"radios must not share a {key}")
+    pins = [r[key] for r in radios for key in ('m0', 'm1')]
+    if len(set(pins)) != len(pins):
+        raise ValueError("radios must not share GPIO pins")
+    return radios, config.get('duplicate_window', DUPLICATE_WINDOW)
+
+class DuplicateFilter:
+    #
+    # Remembers (node, payload) and the radio that heard it for `window`
+    # seconds. A node heard by two radios yields the same pair twice, only
+    # the first copy goes on. The same pair again from the same radio is a
+    # new reading (a node whose values didn't change) and goes on too.
+    # Entries expire in arrival order, so the cost per packet is a dict
+    # lookup plus popping whatever has aged out.
+    #
+    def __init__(self, window=DUPLICATE_WINDOW, maxlen=4096):
+        self.window = window
+        self.maxlen = maxlen
+        self._seen = {}
+        self._order = deque()
+        self.duplicates = 0
+
+    def seen(self, key, now, source=None):
+        order = self._order
+        seen = self._seen
+        while order and (order[0][0] <= now - self.window or len(order) >= self.maxlen):
+            t, old = order.popleft()
+            entry = seen.get(old)
+            if entry is not None and entry[0] == t:
+                del seen[old]
+        entry = seen.get(key)
+        if entry is not None and entry[1] != source:
+            self.duplicates += 1
+            return True
+        seen[key] = (now, source)
+        order.append((now, key))
+        return False
+
+class Radio:
+    #
+    # One module with everything that is per module: its framer (the byte
+    # stream of each port has to be framed on its own), serial reader,
+    # transmit queue and noise sampler, plus counters for /stats.
+    #
+    # Chunks go to the shared pipeline as (radio, data, arrived), the frame
+    # stage calls feed() on the radio they came from. Frames leave it as
+    # (radio name, frame), plain data a process pool can take; the stages
+    # after decode look the radio up again by name.
+    #
+    def __init__(self, name, node, duty_cycle=0.1, noise_interval=5.0):
+        self.name = name
+        self.node = node
+        self.framer = FrameReader(rssi=node.rssi, channel=node.offset_freq)
+        self.receiver = None
+        self.transmitter = TransmitQueue(node, receiving=self.receiving, duty_cycle=duty_cycle)
+        self.noise = NoiseSampler(node, idle=self.idle, interval=noise_interval)
+        self.decoded = 0
+        self.decode_errors = 0
+        self.duplicates = 0
+        self.rate = metrics.RateMeter()
+
+    def attach(self, submit):
+        # Reader that passes every chunk to submit((radio, data, arrived))
+        self.receiver = AsyncReceiver(self.node.ser,
+                                      lambda data, arrived: submit((self, data, arrived)))
+        return self.receiver
+
+    def services(self):
+        return [self.receiver, self.transmitter, self.noise]
+
+    def feed(self, data, arrived):
+        for frame in self.framer.feed(data, arrived):
+            yield self.name, frame
+
+    def receiving(self):
+        return self.receiver.receiving() or self.framer.pending() > 0
+
+    def idle(self):
+        return not (self.receiving() or self.transmitter.busy())
+
+    def stats(self):
+        config = self.node.config
+        return {
+            'port': self.node.serial_n,
+            'freq': config.freq if config else self.node.freq,
+            'channel': self.node.offset_freq,
+            'net_id': config.net_id if config else None,
+            'bytes': self.receiver.bytes if self.receiver else 0,
+            'frames': self.framer.frames,
+            'framer_dropped_bytes': self.framer.dropped,
+            'decoded': self.decoded,
+            'decode_errors': self.decode_errors,
+            'duplicates': self.duplicates,
+            # decoded packets per second over the last RateMeter window
+            'rate': round(self.rate.rate(), 3),
+            'noise_floor_dbm': self.noise.floor(),
+            'transmit': self.transmitter.stats(),
+        }
+
+class RadioGroup:
+    #
+    # The radios of one base station behind the interfaces web_server uses
+    # for a single radio: send() for the transmit queue, floor()/summary()/
+    # history() for the noise sampler. Radios can be added while running,
+    # as each one finishes configuring.
+    #
+    def __init__(self, radios=()):
+        self.radios = []
+        self.by_name = {}
+        # node address -> radio that last decoded a packet from it
+        self.heard = {}
+        for radio in radios:
+            self.add(radio)
+
+    def add(self, radio):
+        self.radios.append(radio)
+        self.by_name[radio.name] = radio
+
+    def route(self, addr):
+        return self.by_name.get(self.heard.get(addr), self.radios[0])
+
+    def send(self, addr, payload, channel=None):
+        # To the radio that last heard the node, the first one otherwise
+        return self.route(addr).transmitter.send(addr, payload, channel)
+
+    def floor(self, radio=None):
+        radio = self.by_name.get(radio, self.radios[0] if self.radios else None)
+        return radio.noise.floor() if radio is not None else None
+
+    def summary(self):
+        out = []
+        for radio in self.radios:
+            for entry in radio.noise.summary():
+                entry['radio'] = radio.name
+                out.append(entry)
+        return out
+
+    def history(self, channel, since=None, radio=None):
+        radios = [self.by_name[radio]] if radio in self.by_name else self.radios
+        for r in radios:
+            history = r.noise.history(channel, since)
+            if history is not None:
+                history['radio'] = r.name
+                return history
+        return None
+
+    def stats(self):
+        return {radio.name: radio.stats() for radio in self.radios}
+
+    def register_metrics(self, registry=metrics.registry):
+        def per_radio(attr):
+            return lambda: {(r.name,): attr(r) for r in self.radios}
+        for name, help, attr in (
+                ('serial_bytes', "Bytes read from the LoRa module",
+                 lambda r: r.receiver.bytes if r.receiver else 0),
+                ('serial_reads', "Reads from the serial port",
+                 lambda r: r.receiver.chunks if r.receiver else 0),
+                ('frames', "Frames cut from the serial stream", lambda r: r.framer.frames),
+                ('framer_dropped_bytes', "Bytes skipped while resynchronising",
+                 lambda r: r.framer.dropped),
+                ('radio_decoded', "Packets decoded per radio", lambda r: r.decoded),
+                ('radio_duplicates', "Packets dropped as duplicates of one already seen",
+                 lambda r: r.duplicates),
+                ('noise_requests', "Noise floor requests sent to the module",
+                 lambda r: r.noise.requests),
+                ('noise_missed', "Noise floor requests that got no answer",
+                 lambda r: r.noise.missed)):
+            registry.register_collector(name, help, 'counter', per_radio(attr), ('radio',))
+        registry.register_collector(
+            'noise_floor_dbm', "Median channel noise floor over the sampler's history", 'gauge',
+            lambda: {(r.name, str(c)): h.floor()
+                     for r in self.radios for c, h in r.noise.channels.items()},
+            ('radio', 'channel'))
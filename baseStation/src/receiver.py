@@ -0,0 +1,61 @@
+import asyncio
+import datetime
+import time
+
+import serial
+
+class AsyncReceiver:
+    #
+    # Serial transport for an asyncio loop. The port's fd is registered with
+    # loop.add_reader, and every time it turns readable whatever is waiting
+    # is read (without blocking) and passed to `on_chunk(data, arrived)`.
+    # Chunk boundaries carry no meaning here, the framer puts packets back
+    # together, so there is no idle gap timing.
+    #
+    # start() and stop() match the service hooks in web_server, so the
+    # receiver runs inside uvicorn's loop next to the HTTP handlers.
+    #
+    # receiving() tells the transmit side whether the module is in the
+    # middle of handing over a packet, bytes arrived less than `guard`
+    # seconds ago.
+    #
+    def __init__(self, ser, on_chunk, guard=0.05):
+        self.ser = ser
+        self.on_chunk = on_chunk
+        self.guard = guard
+        self.chunks = 0
+        self.bytes = 0
+        self.last_read = 0.0
+        self._loop = None
+        self._fd = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._fd = self.ser.fileno()
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop = None
+
+    def receiving(self):
+        return time.monotonic() - self.last_read < self.guard
+
+    def _on_readable(self):
+        arrived = time.monotonic()
+        try:
+            # readable, so at least one byte is there and this returns at once
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except serial.SerialException as e:
+            print(f"Serial port failed, receiver stopped: {e}")
+            self.stop()
+            return
+        self.chunks += 1
+        self.bytes += len(data)
+        self.last_read = arrived
+        self.on_chunk(data, arrived)
+
+def monotonic_to_wall(arrived):
+    # Convert a time.monotonic() stamp to a wall clock datetime
+    return datetime.datetime.fromtimestamp(time.time() - (time.monotonic() - arrived))
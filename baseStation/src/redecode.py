@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#
+# Run a raw capture (testRead.py --capture, see capture.py) through the
+# framer and decoder again, as fast as they go.
+#
+#   python redecode.py run.pncp                       counts and throughput
+#   python redecode.py run.pncp --csv out.csv         samples as base station CSV
+#   python redecode.py run.pncp --ndjson out.ndjson   samples as /data JSON lines
+#   python redecode.py run.pncp --repeat 5            best of 5, for benchmarking
+#
+# Chunks are fed to a FrameReader exactly as they were read from the port,
+# so a framer or codec change can be checked against recorded traffic, and
+# samples get the wall clock of the chunk their packet started in. The
+# decode is the base station's (codec.decode_row into a Sample) minus the
+# console output, which would dominate the timing.
+#
+
+import argparse
+import csv
+import sys
+import time
+
+import codec
+from capture import CaptureReader
+from framer import FrameReader
+from log_sink import CSV_HEADER
+from sample import Sample
+
+def redecode(reader, on_sample=None, verbose=False):
+    #
+    # Returns the counts for one pass over the capture. on_sample gets every
+    # decoded Sample in order.
+    #
+    info = reader.info
+    framer = FrameReader(rssi=info.rssi, channel=info.channel)
+    decode_row = codec.decode_row
+    first_ns = last_ns = None
+    chunks = nbytes = samples = errors = 0
+    started = time.perf_counter()
+    for chunk in reader:
+        chunks += 1
+        nbytes += len(chunk.data)
+        if first_ns is None:
+            first_ns = chunk.mono_ns
+        last_ns = chunk.mono_ns
+        # frames carry the wall clock of the chunk they started in
+        for frame in framer.feed(chunk.data, chunk.wall_ns * 1e-9):
+            if frame.addr is None:
+                continue
+            try:
+                values = decode_row(frame.payload)
+            except ValueError as e:
+                errors += 1
+                if verbose:
+                    print(f"Undecodable data from node 0x{frame.addr:04X}: {e}", file=sys.stderr)
+                continue
+            samples += 1
+            if on_sample is not None:
+                if frame.rssi is not None:
+                    values[-1] = frame.rssi - 256
+                on_sample(Sample(frame.addr, frame.arrived, values))
+    elapsed = time.perf_counter() - started
+    return dict(chunks=chunks, bytes=nbytes, frames=framer.frames, samples=samples,
+                responses=framer.responses, decode_errors=errors,
+                dropped_bytes=framer.dropped, pending_bytes=framer.pending(),
+                truncated=reader.truncated,
+                captured_s=(last_ns - first_ns) * 1e-9 if first_ns is not None else 0.0,
+                seconds=elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame and decode a raw capture again")
+    parser.add_argument('capture', help="capture file from testRead.py --capture")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('--csv', metavar='FILE', help="write samples as base station CSV")
+    output.add_argument('--ndjson', metavar='FILE', help="write samples as JSON lines")
+    parser.add_argument('--repeat', type=int, default=1, help="passes, the fastest is reported")
+    parser.add_argument('--verbose', action='store_true', help="print undecodable payloads")
+    args = parser.parse_args()
+
+    try:
+        reader = CaptureReader(args.capture)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read {args.capture}: {e}")
+        return 1
+    info = reader.info
+    print(f"{args.capture}: {info.baudrate} baud, packet RSSI {'on' if info.rssi else 'off'}, "
+          f"channel {'unknown' if info.channel is None else info.channel}, started "
+          f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(info.wall_ns * 1e-9))}")
+
+    out = None
+    on_sample = None
+    if args.csv:
+        out = open(args.csv, 'w', newline='')
+        writer = csv.writer(out)
+        writer.writerow(CSV_HEADER)
+        on_sample = lambda sample: writer.writerow(sample.csv_row())
+    elif args.ndjson:
+        out = open(args.ndjson, 'wb')
+        write = out.write
+        on_sample = lambda sample: write(sample.json() + b'\n')
+
+    try:
+        best = None
+        for i in range(max(1, args.repeat)):
+            # samples are written once, later passes only time the decode
+            counts = redecode(reader, on_sample if i == 0 else None, args.verbose)
+            if best is None or counts['seconds'] < best['seconds']:
+                best = counts
+    finally:
+        if out is not None:
+            out.close()
+
+    seconds = best['seconds'] or 1e-9
+    print(f"{best['chunks']} chunks, {best['bytes']} bytes over {best['captured_s']:.1f} s of capture")
+    print(f"{best['frames']} frames: {best['samples']} samples, {best['responses']} module responses, "
+          f"{best['decode_errors']} undecodable; {best['dropped_bytes']} bytes dropped by the framer, "
+          f"{best['pending_bytes']} left incomplete")
+    if best['truncated']:
+        print("The capture ends inside a record, the partial chunk was skipped")
+    print(f"{seconds * 1000:.1f} ms: {best['samples'] / seconds:,.0f} packets/s, "
+          f"{best['bytes'] / seconds / 1e6:.1f} MB/s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+#
+# Drive a virtual sx126x with recorded or synthetic traffic.
+#
+#   python replay.py --csv logs/sensor_data_*.csv --speed 10
+#   python replay.py --synthetic --nodes 4 --rate 20 --duration 60
+#   python replay.py --synthetic --nodes 4 --ramp 5:60:5 --local
+#
+# Without --local the pty path is printed and the script keeps emitting, so
+# a base station can be started on it (LORA_PORT=/dev/pts/N). With --local
+# the receive path (AsyncReceiver -> FrameReader -> decode) runs in this
+# process and every step reports how many packets made it through. --ramp
+# raises the rate step by step until packets start getting lost.
+#
+
+import argparse
+import asyncio
+import csv
+import glob
+import json
+import random
+import time
+
+import codec
+from store import parse_time
+from virtual_sx126x import VirtualSX126x
+
+def synthetic_readings(n, seed=1):
+    rnd = random.Random(seed)
+    readings = []
+    for _ in range(n):
+        reading = {}
+        for name, span in (('orientation', 180.0), ('gyro', 250.0),
+                           ('accel', 20.0), ('linear_accel', 5.0),
+                           ('gravity', 9.81), ('mag', 60.0)):
+            reading[name] = {axis: round(rnd.uniform(-span, span), 4) for axis in 'xyz'}
+        reading['temp'] = rnd.randint(-10, 40)
+        reading['cal'] = {k: rnd.randint(0, 3) for k in ('sys', 'gyro', 'accel', 'mag')}
+        readings.append(reading)
+    return readings
+
+def json_payload(reading):
+    # Same layout and precision as the String() concatenation in main.cpp
+    def vec(v):
+        return '{"x":%.4f,"y":%.4f,"z":%.4f}' % (v['x'], v['y'], v['z'])
+    cal = reading['cal']
+    return ('{"orientation":%s,"gyro":%s,"accel":%s,"linear_accel":%s,'
+            '"gravity":%s,"mag":%s,"temp":%d,'
+            '"cal":{"sys":%d,"gyro":%d,"accel":%d,"mag":%d}}' % (
+                vec(reading['orientation']), vec(reading['gyro']),
+                vec(reading['accel']), vec(reading['linear_accel']),
+                vec(reading['gravity']), vec(reading['mag']), reading['temp'],
+                cal['sys'], cal['gyro'], cal['accel'], cal['mag'])).encode()
+
+def encode(reading, fmt):
+    return codec.encode_v1(reading) if fmt == 'binary' else json_payload(reading)
+
+def csv_traffic(paths, node=0):
+    #
+    # (t, node, reading, rssi_dbm) from base station CSV logs. The logs have
+    # no linear_accel, gravity or temp columns, those replay as zero, and
+    # neither do the empty cells Sample.csv_row writes for readings a
+    # packet didn't carry.
+    #
+    zero = {'x': 0.0, 'y': 0.0, 'z': 0.0}
+    def number(cell):
+        return float(cell) if cell else 0.0
+    for path in paths:
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                def vec(prefix):
+                    return {axis: number(row[f"{prefix}_{axis.upper()}"]) for axis in 'xyz'}
+                reading = {
+                    'orientation': vec('Orient'),
+                    'gyro': vec('Gyro'),
+                    'accel': vec('Accel'),
+                    'linear_accel': zero,
+                    'gravity': zero,
+                    'mag': vec('Mag'),
+                    'temp': 0,
+                    'cal': {k: int(number(row[f"Cal_{k.capitalize()}"]))
+                            for k in ('sys', 'gyro', 'accel', 'mag')},
+                }
+                rssi = row['RSSI']
+                rssi_dbm = int(rssi[:-3]) if rssi.endswith('dBm') else -80
+                t = parse_time(row['Timestamp'])
+                yield t, node, reading, rssi_dbm
+
+def synthetic_traffic(nodes, rate, duration, seed=1):
+    # (t, node, reading, rssi_dbm), `rate` packets per second in total,
+    # round robin over the nodes
+    rnd = random.Random(seed)
+    readings = synthetic_readings(256, seed)
+    count = int(rate * duration)
+    for i in range(count):
+        yield i / rate, i % nodes, readings[i % len(readings)], rnd.randint(-120, -40)
+
+def replay(device, traffic, speed=1.0, fmt='binary'):
+    # Emit traffic on the device, `speed` times real time (0 = flat out)
+    sent = 0
+    t0 = None
+    start = time.monotonic()
+    for t, node, reading, rssi in traffic:
+        if speed:
+            if t0 is None:
+                t0 = t
+            delay = start + (t - t0) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        device.emit(node, encode(reading, fmt), rssi)
+        sent += 1
+    device.flush()
+    return sent
+
+async def local_receive(port, rssi, channel, done, written):
+    #
+    # Run the base station receive path on `port` until the producer has
+    # set `done` and every byte the device wrote (`written()`) has been
+    # read, so a quiet spell in slow or bursty traffic is not taken for the
+    # end of it. Returns (frames decoded, framer).
+    #
+    import serial
+    from framer import FrameReader
+    from receiver import AsyncReceiver
+
+    ser = serial.Serial(port, 9600)
+    framer = FrameReader(rssi=rssi, channel=channel)
+    decoded = 0
+
+    def on_chunk(data, arrived):
+        nonlocal decoded
+        for frame in framer.feed(data, arrived):
+            if codec.decode_frame(frame) is not None:
+                decoded += 1
+
+    receiver = AsyncReceiver(ser, on_chunk)
+    receiver.start()
+    try:
+        while not (done.is_set() and receiver.bytes >= written()):
+            await asyncio.sleep(0.05)
+    finally:
+        receiver.stop()
+        ser.close()
+    return decoded, framer
+
+def run_local(device, traffic, speed, fmt):
+    import threading
+    result = {}
+    done = threading.Event()
+    # the device's byte count runs on across ramp steps
+    start_bytes = device.bytes
+
+    def produce():
+        try:
+            result['sent'] = replay(device, traffic, speed, fmt)
+        finally:
+            done.set()
+
+    async def main():
+        producer = threading.Thread(target=produce)
+        receive = asyncio.create_task(local_receive(
+            device.port, device.rssi_enabled, device.channel, done,
+            lambda: device.bytes - start_bytes))
+        await asyncio.sleep(0.1)
+        producer.start()
+        decoded, framer = await receive
+        producer.join()
+        result.update(received=decoded, dropped_bytes=framer.dropped)
+
+    asyncio.run(main())
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay traffic into a virtual sx126x")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--csv', nargs='+', help="base station CSV logs to replay")
+    source.add_argument('--synthetic', action='store_true', help="generate traffic")
+    parser.add_argument('--nodes', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=10.0, help="packets per second")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per run or ramp step")
+    parser.add_argument('--speed', type=float, default=1.0, help="N x real time, 0 = as fast as possible")
+    parser.add_argument('--format', choices=('binary', 'json'), default='binary')
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--no-pace', action='store_true', help="don't limit to the UART baud rate")
+    parser.add_argument('--corrupt', type=float, default=0.0, help="fraction of packets with a flipped bit")
+    parser.add_argument('--truncate', type=float, default=0.0, help="fraction of packets cut short")
+    parser.add_argument('--merge', type=float, default=0.0, help="fraction of packets glued to the next")
+    parser.add_argument('--ramp', help="START:STOP:STEP packet rates, needs --synthetic")
+    parser.add_argument('--local', action='store_true', help="receive in this process and count losses")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    device = VirtualSX126x(baudrate=args.baud, pace=not args.no_pace, seed=args.seed)
+    device.corrupt_rate = args.corrupt
+    device.truncate_rate = args.truncate
+    device.merge_rate = args.merge
+
+    def traffic(rate):
+        if args.csv:
+            paths = sorted(p for pattern in args.csv for p in glob.glob(pattern))
+            return csv_traffic(paths)
+        return synthetic_traffic(args.nodes, rate, args.duration, args.seed)
+
+    try:
+        if args.ramp:
+            if not args.synthetic or not args.local:
+                parser.error("--ramp needs --synthetic and --local")
+            start, stop, step = (float(x) for x in args.ramp.split(':'))
+            rate = start
+            while rate <= stop:
+                result = run_local(device, traffic(rate), 1.0, args.format)
+                loss = 1 - result['received'] / result['sent'] if result['sent'] else 0.0
+                print(json.dumps({'rate': rate, **result, 'loss': round(loss, 4)}))
+                if loss > 0.01:
+                    print(f"Losing packets above {rate} packets/s")
+                    break
+                rate += step
+        elif args.local:
+            result = run_local(device, traffic(args.rate), args.speed, args.format)
+            print(json.dumps(result))
+        else:
+            print(f"Virtual sx126x on {device.port}")
+            input("Start the base station on that port, then press Enter to replay ")
+            sent = replay(device, traffic(args.rate), args.speed, args.format)
+            print(f"Sent {sent} packets, {device.bytes} bytes")
+    finally:
+        device.close()
+
+if __name__ == '__main__':
+    main()
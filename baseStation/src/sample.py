@@ -0,0 +1,108 @@
+import datetime
+import json
+
+from store import CAL_FIELDS, FIELD_INDEX, VECTOR_FIELDS, flatten, parse_time
+
+#
+# One decoded sensor sample as it travels from the decode stage to the CSV
+# log, the archive, the store and the dashboard.
+#
+# The readings are a flat list of floats in store.FIELDS order (the same
+# row the store and the archive keep, NaN where a value is missing), so
+# the sinks take what they need without walking nested dicts. The nested
+# dict the dashboard and /data have always served is only built when the
+# sample is first serialized, and that JSON is cached on the sample: every
+# /data poll and every WebSocket batch reuses it.
+#
+# seq is the sample's place in the web server's feed (see SampleFeed in
+# web_server.py), set when the sample is stored and before it is first
+# serialized.
+#
+
+_RSSI = FIELD_INDEX['rssi']
+_CSV_COLUMNS = ([FIELD_INDEX[f"{name}_{axis}"]
+                 for name in ('orientation', 'gyro', 'accel', 'mag') for axis in 'xyz']
+                + [FIELD_INDEX[f"cal_{name}"] for name in CAL_FIELDS])
+
+def _value(v):
+    return None if v != v else v
+
+class Sample:
+    __slots__ = ('node', 't', 'values', 'radio', 'seq', '_json')
+
+    def __init__(self, node, t, values, radio=None):
+        self.node = node
+        # wall clock epoch seconds the packet arrived
+        self.t = t
+        self.values = values
+        self.radio = radio
+        self.seq = None
+        self._json = None
+
+    @classmethod
+    def from_dict(cls, data):
+        # From the nested dict shape (JSON payloads, POST /update)
+        t = parse_time(data.get('timestamp'))
+        if t is None:
+            t = datetime.datetime.now().timestamp()
+        return cls(data.get('node', 0), t, flatten(data), data.get('radio'))
+
+    @property
+    def timestamp(self):
+        return datetime.datetime.fromtimestamp(self.t).isoformat()
+
+    @property
+    def rssi(self):
+        # dBm, None when the module didn't report it
+        return _value(self.values[_RSSI])
+
+    @property
+    def rssi_text(self):
+        rssi = self.values[_RSSI]
+        return "N/A" if rssi != rssi else f"{rssi:.0f}dBm"
+
+    def to_dict(self):
+        # Readings the node didn't send are left out rather than null
+        values = self.values
+        out = {}
+        i = 0
+        for name in VECTOR_FIELDS:
+            vec = {axis: v for axis, v in zip('xyz', values[i:i + 3]) if v == v}
+            i += 3
+            if vec:
+                out[name] = vec
+        if values[i] == values[i]:
+            out['temp'] = values[i]
+        cal = {name: int(v) for name, v in zip(CAL_FIELDS, values[i + 1:i + 5]) if v == v}
+        if cal:
+            out['cal'] = cal
+        out['timestamp'] = self.timestamp
+        out['rssi'] = self.rssi_text
+        out['node'] = self.node
+        out['radio'] = self.radio
+        if self.seq is not None:
+            out['seq'] = self.seq
+        return out
+
+    def json(self):
+        # Serialized once, then shared by every reader
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), separators=(',', ':')).encode()
+        return self._json
+
+    def csv_row(self):
+        # timestamp, orientation, gyro, accel, mag, calibration, rssi
+        values = self.values
+        row = [self.timestamp]
+        for i in _CSV_COLUMNS[:12]:
+            v = values[i]
+            row.append('' if v != v else v)
+        for i in _CSV_COLUMNS[12:]:
+            v = values[i]
+            row.append('' if v != v else int(v))
+        row.append(self.rssi_text)
+        return row
+
+def json_array(samples):
+    # JSON array text of samples from their cached serializations
+    return b'[' + b','.join(sample.json() for sample in samples) + b']'
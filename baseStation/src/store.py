@@ -0,0 +1,213 @@
+import datetime
+
+import numpy as np
+
+# Numeric columns kept for every sample, in storage order
+VECTOR_FIELDS = ('orientation', 'gyro', 'accel', 'linear_accel', 'gravity', 'mag')
+CAL_FIELDS = ('sys', 'gyro', 'accel', 'mag')
+FIELDS = ([f"{name}_{axis}" for name in VECTOR_FIELDS for axis in 'xyz']
+          + ['temp'] + [f"cal_{name}" for name in CAL_FIELDS] + ['rssi'])
+FIELD_INDEX = {name: i for i, name in enumerate(FIELDS)}
+
+def parse_time(value):
+    # Epoch seconds from a float, a numeric string or an ISO 8601 string
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+def parse_rssi(value):
+    # "-87dBm" (as the receiver formats it) or a number, NaN when unknown
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str) and value.endswith('dBm'):
+        try:
+            return float(value[:-3])
+        except ValueError:
+            pass
+    return float('nan')
+
+def flatten(sample):
+    # Sample dict -> list of floats in FIELDS order, missing values are NaN
+    row = []
+    nan = float('nan')
+    for name in VECTOR_FIELDS:
+        vec = sample.get(name)
+        if vec:
+            row.append(vec.get('x', nan))
+            row.append(vec.get('y', nan))
+            row.append(vec.get('z', nan))
+        else:
+            row.extend((nan, nan, nan))
+    row.append(sample.get('temp', nan))
+    cal = sample.get('cal') or {}
+    for name in CAL_FIELDS:
+        row.append(cal.get(name, nan))
+    row.append(parse_rssi(sample.get('rssi')))
+    return row
+
+# (bucket seconds, buckets kept): 30 min of 1 s, 6 h of 10 s, 24 h of 1 min
+DEFAULT_ROLLUPS = ((1, 1800), (10, 2160), (60, 1440))
+
+def ring_order(arrays, count, capacity):
+    # Arrays of a ring buffer oldest first, views when it has not wrapped
+    if count <= capacity:
+        return [a[:count] for a in arrays]
+    i = count % capacity
+    return [np.concatenate((a[i:], a[:i])) for a in arrays]
+
+class Rollup:
+    #
+    # Fixed time bucket aggregate (count, sum, min, max per field) kept in a
+    # ring buffer. Updated in place as samples arrive, so a long range can be
+    # answered from a few thousand buckets instead of every raw sample.
+    # Buckets only exist for intervals that had samples. Missing (NaN)
+    # values are left out of a field's count and sum, so the mean is over
+    # the values the bucket has.
+    #
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.capacity = capacity
+        nfields = len(FIELDS)
+        self.t = np.zeros(capacity, dtype=np.float64)
+        self.n = np.zeros((capacity, nfields), dtype=np.int32)
+        self.sum = np.zeros((capacity, nfields), dtype=np.float32)
+        self.min = np.zeros((capacity, nfields), dtype=np.float32)
+        self.max = np.zeros((capacity, nfields), dtype=np.float32)
+        self.count = 0
+        self._key = None
+
+    @property
+    def name(self):
+        return f"{self.resolution}s"
+
+    def add(self, t, row):
+        key = int(t // self.resolution)
+        if self._key is None or key > self._key:
+            i = self.count % self.capacity
+            self.count += 1
+            self._key = key
+            self.t[i] = key * self.resolution
+            self.n[i] = row == row
+            self.sum[i] = np.nan_to_num(row, nan=0.0)
+            self.min[i] = row
+            self.max[i] = row
+        else:
+            # same bucket, or a late sample which is folded into the open one
+            i = (self.count - 1) % self.capacity
+            self.n[i] += row == row
+            self.sum[i] += np.nan_to_num(row, nan=0.0)
+            np.fmin(self.min[i], row, out=self.min[i])
+            np.fmax(self.max[i], row, out=self.max[i])
+
+    def ordered(self):
+        # (t, n, sum, min, max) oldest first, n and sum per field
+        return ring_order((self.t, self.n, self.sum, self.min, self.max),
+                           self.count, self.capacity)
+
+class NodeHistory:
+    #
+    # Fixed capacity ring buffer of one node's samples plus its rollups.
+    # Storage is allocated up front (a float64 time column and a float32 row
+    # per sample or bucket), so memory does not change with the number of
+    # packets received.
+    #
+    def __init__(self, node, capacity, rollups=DEFAULT_ROLLUPS):
+        self.node = node
+        self.capacity = capacity
+        self.t = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros((capacity, len(FIELDS)), dtype=np.float32)
+        self.rollups = [Rollup(resolution, size) for resolution, size in rollups]
+        self.count = 0
+        self.latest = None
+
+    def append(self, t, sample):
+        i = self.count % self.capacity
+        row = self.values[i]
+        row[:] = sample.values
+        self.t[i] = t
+        for rollup in self.rollups:
+            rollup.add(t, row)
+        self.count += 1
+        self.latest = sample
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def last_time(self):
+        return self.t[(self.count - 1) % self.capacity] if self.count else None
+
+    def ordered(self):
+        # (t, values) oldest first, as views when the buffer has not wrapped
+        return ring_order((self.t, self.values), self.count, self.capacity)
+
+    def history(self, since=None, limit=None):
+        t, values = self.ordered()
+        if since is not None:
+            keep = t > since
+            t, values = t[keep], values[keep]
+        if limit is not None and len(t) > limit:
+            t, values = t[-limit:], values[-limit:]
+        return t, values
+
+class SampleStore:
+    #
+    # Latest sample and recent history per node address. At most `max_nodes`
+    # nodes are tracked, samples from further nodes are counted and dropped,
+    # so memory is bounded by max_nodes * (capacity + rollup buckets).
+    #
+    def __init__(self, capacity=3600, max_nodes=32, rollups=DEFAULT_ROLLUPS):
+        self.capacity = capacity
+        self.max_nodes = max_nodes
+        self.rollups = rollups
+        self.nodes = {}
+        self.rejected = 0
+
+    def add(self, sample, node=None):
+        # sample.Sample
+        if node is None:
+            node = sample.node
+        history = self.nodes.get(node)
+        if history is None:
+            if len(self.nodes) >= self.max_nodes:
+                self.rejected += 1
+                return None
+            history = self.nodes[node] = NodeHistory(node, self.capacity, self.rollups)
+        history.append(sample.t, sample)
+        return history
+
+    def get(self, node):
+        return self.nodes.get(node)
+
+    def summary(self):
+        out = []
+        for node, history in sorted(self.nodes.items()):
+            latest = history.latest
+            out.append({
+                'node': node,
+                'samples': history.count,
+                'stored': len(history),
+                'timestamp': latest.timestamp if latest else None,
+                'rssi': latest.rssi_text if latest else None,
+                'radio': latest.radio if latest else None,
+            })
+        return out
+
+def json_floats(column):
+    # List of floats rounded to the 4 decimals the nodes send (so float32
+    # noise does not leak into JSON), NaN becomes None
+    column = np.asarray(column, dtype=np.float64).round(4)
+    if np.isnan(column).any():
+        return [None if v != v else v for v in column.tolist()]
+    return column.tolist()
+
+def columns(t, values, fields=None):
+    # Columnar JSON friendly view: {'timestamp': [...], field: [...], ...}
+    out = {'timestamp': t.tolist()}
+    for name in fields or FIELDS:
+        out[name] = json_floats(values[:, FIELD_INDEX[name]])
+    return out
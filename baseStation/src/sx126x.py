@@ -1,6 +1,64 @@
-import RPi.GPIO as GPIO
 import serial
 import time
+from collections import namedtuple
+
+import gpio as gpio_backends
+
+class ConfigError(Exception):
+    #
+    # The module did not take a configuration. expected and actual are the
+    # register blocks written and read back (actual is whatever arrived
+    # before the deadline when there was no response), mismatch the offsets
+    # that differ.
+    #
+    def __init__(self, message, expected=None, actual=None):
+        self.expected = expected
+        self.actual = actual
+        self.mismatch = []
+        if expected is not None and actual is not None:
+            self.mismatch = [i for i, (a, b) in enumerate(zip(expected, actual)) if a != b]
+            message += f" (registers {self.mismatch} differ: wrote {expected.hex(' ')}, read {actual.hex(' ')})"
+        super().__init__(message)
+
+# Register fields, see the E22-xxxT22S manual
+UART_BAUDRATES = {0x00: 1200, 0x20: 2400, 0x40: 4800, 0x60: 9600,
+                  0x80: 19200, 0xA0: 38400, 0xC0: 57600, 0xE0: 115200}
+AIR_SPEEDS = {0x00: 2400, 0x01: 2400, 0x02: 2400, 0x03: 4800, 0x04: 9600,
+              0x05: 19200, 0x06: 38400, 0x07: 62500}
+BUFFER_SIZES = {0x00: 240, 0x40: 128, 0x80: 64, 0xC0: 32}
+POWERS = {0x00: 22, 0x01: 17, 0x02: 13, 0x03: 10}
+
+class ModuleConfig(namedtuple('ModuleConfig', 'addr net_id uart_baudrate air_speed buffer_size '
+                              'power noise_rssi channel freq packet_rssi fixed relay lbt '
+                              'wor_cycle_ms registers')):
+    #
+    # Parsed register block 00H..08H:
+    #   ADDH ADDL NETID REG0 REG1 REG2(channel) REG3 CRYPT_H CRYPT_L
+    #
+    __slots__ = ()
+
+    @classmethod
+    def from_registers(cls, regs, start_freq=850):
+        regs = bytes(regs)
+        if len(regs) < 7:
+            raise ValueError(f"need at least 7 register bytes, got {len(regs)}")
+        return cls(
+            addr=regs[0] << 8 | regs[1],
+            net_id=regs[2],
+            uart_baudrate=UART_BAUDRATES[regs[3] & 0xE0],
+            air_speed=AIR_SPEEDS[regs[3] & 0x07],
+            buffer_size=BUFFER_SIZES[regs[4] & 0xC0],
+            power=POWERS[regs[4] & 0x03],
+            noise_rssi=bool(regs[4] & 0x20),
+            channel=regs[5],
+            freq=start_freq + regs[5],
+            packet_rssi=bool(regs[6] & 0x80),
+            fixed=bool(regs[6] & 0x40),
+            relay=bool(regs[6] & 0x20),
+            lbt=bool(regs[6] & 0x10),
+            wor_cycle_ms=((regs[6] & 0x07) + 1) * 500,
+            registers=regs,
+        )
 
 class sx126x:
 
@@ -75,21 +133,26 @@ class sx126x:
         32:SX126X_PACKAGE_SIZE_32_BYTE
     }
 
+    # m0/m1 are the BCM pins wired to the module's M0/M1, so several modules
+    # can run side by side. gpio is the backend driving them (see gpio.py),
+    # the default one when not given.
     def __init__(self,serial_num,freq,addr,power,rssi,air_speed=2400,\
-                 net_id=0,buffer_size = 240,crypt=0,\
-                 relay=False,lbt=False,wor=False):
+                 net_id=0,buffer_size = 240,crypt=None,\
+                 relay=False,lbt=False,wor=False,m0=M0,m1=M1,gpio=None):
+        self.gpio = gpio if gpio is not None else gpio_backends.backend()
+        self.M0 = m0
+        self.M1 = m1
+        # per module copy, set() fills it in
+        self.cfg_reg = list(self.cfg_reg)
         self.rssi = rssi
         self.addr = addr
         self.freq = freq
         self.serial_n = serial_num
         self.power = power
         # Initial the GPIO for M0 and M1 Pin
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
-        GPIO.setup(self.M0,GPIO.OUT)
-        GPIO.setup(self.M1,GPIO.OUT)
-        GPIO.output(self.M0,GPIO.LOW)
-        GPIO.output(self.M1,GPIO.HIGH)
+        self.gpio.setup(self.M0)
+        self.gpio.setup(self.M1)
+        self._config_mode()
 
         # The hardware UART of Pi3B+,Pi4B is /dev/ttyACM0
         self.ser = serial.Serial(serial_num,9600)
@@ -97,14 +160,10 @@ class sx126x:
         self.set(freq,addr,power,rssi,air_speed,net_id,buffer_size,crypt,relay,lbt,wor)
 
     def set(self,freq,addr,power,rssi,air_speed=2400,\
-            net_id=0,buffer_size = 240,crypt=0,\
+            net_id=0,buffer_size = 240,crypt=None,\
             relay=False,lbt=False,wor=False):
         self.send_to = addr
         self.addr = addr
-        # We should pull up the M1 pin when sets the module
-        GPIO.output(self.M0,GPIO.LOW)
-        GPIO.output(self.M1,GPIO.HIGH)
-        time.sleep(0.1)
 
         low_addr = addr & 0xff
         high_addr = addr >> 8 & 0xff
@@ -117,15 +176,15 @@ class sx126x:
             freq_temp = freq - 410
             self.start_freq  = 410
             self.offset_freq = freq_temp
-        
+        else:
+            raise ValueError(f"frequency {freq} MHz is outside 410~493 and 850~930 MHz")
+
         air_speed_temp = self.lora_air_speed_dic.get(air_speed,None)
-        # if air_speed_temp != None
-        
         buffer_size_temp = self.lora_buffer_size_dic.get(buffer_size,None)
-        # if air_speed_temp != None:
-        
         power_temp = self.lora_power_dic.get(power,None)
-        #if power_temp != None:
+        if air_speed_temp is None or buffer_size_temp is None or power_temp is None:
+            raise ValueError(f"unsupported air speed {air_speed}, buffer size {buffer_size} "
+                             f"or power {power}")
 
         if rssi:
             # enable print rssi value 
@@ -134,9 +193,9 @@ class sx126x:
             # disable print rssi value
             rssi_temp = 0x00        
 
-        # get crypt
-        l_crypt = crypt & 0xff
-        h_crypt = crypt >> 8 & 0xff
+        # get crypt, None leaves the module's key as it is
+        l_crypt = (crypt or 0) & 0xff
+        h_crypt = (crypt or 0) >> 8 & 0xff
         
         if relay==False:
             self.cfg_reg[3] = high_addr
@@ -172,81 +231,135 @@ class sx126x:
             self.cfg_reg[9] = 0x03 + rssi_temp
             self.cfg_reg[10] = h_crypt
             self.cfg_reg[11] = l_crypt
-        self.ser.flushInput()
 
-        for i in range(2):
-            self.ser.write(bytes(self.cfg_reg))
-            r_buff = 0
-            time.sleep(0.2)
-            if self.ser.inWaiting() > 0:
-                time.sleep(0.1)
-                r_buff = self.ser.read(self.ser.inWaiting())
-                if r_buff[0] == 0xC1:
-                    pass
-                    # print("parameters setting is :",end='')
-                    # for i in self.cfg_reg:
-                        # print(hex(i),end=' ')
-                        
-                    # print('\r\n')
-                    # print("parameters return is  :",end='')
-                    # for i in r_buff:
-                        # print(hex(i),end=' ')
-                    # print('\r\n')
-                else:
-                    pass
-                    #print("parameters setting fail :",r_buff)
-                break
+        #
+        # Read the registers back first and only write when they differ, a
+        # restart with unchanged settings then costs one register read. The
+        # crypt key can't be read back (the module returns zeros), so a key
+        # that is asked for, 0 to clear it included, is written unless this
+        # object wrote that key already. With crypt None only registers
+        # 0x00..0x06 are written and the key stays whatever it was.
+        #
+        wanted = bytes(self.cfg_reg[3:])
+        try:
+            current = self._regs if self._regs is not None else self._read_registers()
+            if current[:7] == wanted[:7] and (crypt is None or crypt == self._crypt):
+                self.config = ModuleConfig.from_registers(wanted, self.start_freq)
+                self.config_written = False
+                return self.config
+            if crypt is None:
+                command = bytes([self.cfg_reg[0], 0x00, 0x07]) + wanted[:7]
             else:
-                print("setting fail,setting again")
-                self.ser.flushInput()
-                time.sleep(0.2)
-                print('\x1b[1A',end='\r')
-                if i == 1:
-                    print("setting fail,Press Esc to Exit and run again")
-                    # time.sleep(2)
-                    # print('\x1b[1A',end='\r')
-
-        GPIO.output(self.M0,GPIO.LOW)
-        GPIO.output(self.M1,GPIO.LOW)
-        time.sleep(0.1)
+                command = bytes(self.cfg_reg)
+            self._config_mode()
+            for attempt in range(self.config_retries):
+                self.ser.reset_input_buffer()
+                self.ser.write(command)
+                try:
+                    written = self._read_response(0x00, command[2])
+                    break
+                except ConfigError:
+                    if attempt + 1 == self.config_retries:
+                        raise
+            if written[:7] != wanted[:7]:
+                raise ConfigError("module did not accept the settings", wanted, written)
+            self._regs = wanted
+            if crypt is not None:
+                self._crypt = crypt
+            self.config = ModuleConfig.from_registers(wanted, self.start_freq)
+            self.config_written = True
+            return self.config
+        finally:
+            self._normal_mode()
+
+    #
+    # Register access. The module answers every command in configuration
+    # mode (M0 low, M1 high) with C1 <start> <length> <registers>, which is
+    # what these wait for, up to `response_timeout` seconds, instead of
+    # sleeping a fixed time and hoping the answer is there.
+    #
+
+    # Seconds the module needs after M0/M1 change before it takes commands
+    # (it has no AUX line wired to the Pi to tell us)
+    mode_switch_delay = 0.04
+    response_timeout = 0.5
+    config_retries = 2
+
+    _mode = None
+    _regs = None
+    # key this object wrote, the module won't tell
+    _crypt = None
+    config = None
+    config_written = False
+
+    def _config_mode(self):
+        if self._mode != 'config':
+            self.gpio.output(self.M0,False)
+            self.gpio.output(self.M1,True)
+            self._mode = 'config'
+            time.sleep(self.mode_switch_delay)
+
+    def _normal_mode(self):
+        if self._mode != 'normal':
+            self.gpio.output(self.M0,False)
+            self.gpio.output(self.M1,False)
+            self._mode = 'normal'
+            time.sleep(self.mode_switch_delay)
+
+    def _read_response(self, start, length):
+        # Wait for C1 <start> <length> and its registers, bytes before the
+        # response header are skipped
+        deadline = time.monotonic() + self.response_timeout
+        timeout = self.ser.timeout
+        buf = bytearray()
+        header = bytes([0xC1, start, length])
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConfigError(f"no response to register command within "
+                                      f"{self.response_timeout} s", actual=bytes(buf))
+                self.ser.timeout = remaining
+                i = buf.find(header)
+                need = (i + 3 + length if i >= 0 else len(header)) - len(buf)
+                chunk = self.ser.read(max(need, 1))
+                buf += chunk
+                i = buf.find(header)
+                if i >= 0 and len(buf) >= i + 3 + length:
+                    return bytes(buf[i + 3:i + 3 + length])
+        finally:
+            self.ser.timeout = timeout
+
+    def _read_registers(self):
+        self._config_mode()
+        for attempt in range(self.config_retries):
+            self.ser.reset_input_buffer()
+            self.ser.write(bytes([0xC1,0x00,0x09]))
+            try:
+                self._regs = self._read_response(0x00, 0x09)
+                return self._regs
+            except ConfigError:
+                if attempt + 1 == self.config_retries:
+                    raise
 
     def get_settings(self):
-        # the pin M1 of lora HAT must be high when enter setting mode and get parameters
-        GPIO.output(M1,GPIO.HIGH)
-        time.sleep(0.1)
-        
-        # send command to get setting parameters
-        self.ser.write(bytes([0xC1,0x00,0x09]))
-        if self.ser.inWaiting() > 0:
-            time.sleep(0.1)
-            self.get_reg = self.ser.read(self.ser.inWaiting())
-        
-        # check the return characters from hat and print the setting parameters
-        if self.get_reg[0] == 0xC1 and self.get_reg[2] == 0x09:
-            fre_temp = self.get_reg[8]
-            addr_temp = self.get_reg[3] + self.get_reg[4]
-            air_speed_temp = self.get_reg[6] & 0x03
-            power_temp = self.get_reg[7] & 0x03
-            
-            print("Frequence is {0}.125MHz.",fre_temp)
-            print("Node address is {0}.",addr_temp)
-            print("Air speed is {0} bps"+ lora_air_speed_dic.get(None,air_speed_temp))
-            print("Power is {0} dBm" + lora_power_dic.get(None,power_temp))
-            GPIO.output(M1,GPIO.LOW)
+        # Registers as the module reports them right now, as a ModuleConfig
+        try:
+            regs = self._read_registers()
+        finally:
+            self._normal_mode()
+        return ModuleConfig.from_registers(regs, self.start_freq)
 
 #
 # the data format like as following
 # "node address,frequence,payload"
 # "20,868,Hello World"
+    # Hands the bytes to the module and returns, the mode pins are only
+    # switched when the module is not in normal mode already. Pacing to the
+    # air rate is up to the caller, see transmitter.TransmitQueue.
     def send(self,data):
-        GPIO.output(self.M1,GPIO.LOW)
-        GPIO.output(self.M0,GPIO.LOW)
-        time.sleep(0.1)
-
+        self._normal_mode()
         self.ser.write(data)
-        # if self.rssi == True:
-            # self.get_channel_rssi()
-        time.sleep(0.1)
 
 
     def receive(self):
@@ -261,26 +374,27 @@ class sx126x:
             if self.rssi:
                 # print('\x1b[3A',end='\r')
                 print("the packet rssi value: -{0}dBm".format(256-r_buff[-1:][0]))
-                self.get_channel_rssi()
             else:
                 pass
                 #print('\x1b[2A',end='\r')
 
+    # Noise floor and last packet RSSI, C0 C1 C2 C3 <start> <length> in
+    # normal mode (REG1 bit 5 enables it)
+    NOISE_RSSI_CMD = bytes([0xC0,0xC1,0xC2,0xC3,0x00,0x02])
+
+    #
+    # Blocking one-off read for interactive use. It consumes the serial
+    # stream while it waits, so a packet arriving meanwhile is lost; the
+    # base station samples through noise.NoiseSampler instead, which lets
+    # the response come in through the receive path.
+    #
     def get_channel_rssi(self):
-        GPIO.output(self.M1,GPIO.LOW)
-        GPIO.output(self.M0,GPIO.LOW)
-        time.sleep(0.1)
-        self.ser.flushInput()
-        self.ser.write(bytes([0xC0,0xC1,0xC2,0xC3,0x00,0x02]))
-        time.sleep(0.5)
-        re_temp = bytes(5)
-        if self.ser.inWaiting() > 0:
-            time.sleep(0.1)
-            re_temp = self.ser.read(self.ser.inWaiting())
-        if re_temp[0] == 0xC1 and re_temp[1] == 0x00 and re_temp[2] == 0x02:
-            print("the current noise rssi value: -{0}dBm".format(256-re_temp[3]))
-            # print("the last receive packet rssi value: -{0}dBm".format(256-re_temp[4]))
-        else:
-            # pass
+        self._normal_mode()
+        self.ser.write(self.NOISE_RSSI_CMD)
+        try:
+            re_temp = self._read_response(0x00, 0x02)
+        except ConfigError:
             print("receive rssi value fail")
-            # print("receive rssi value fail: ",re_temp)
+            return None
+        print("the current noise rssi value: -{0}dBm".format(256-re_temp[0]))
+        return re_temp[0] - 256
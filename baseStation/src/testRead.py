@@ -1,22 +1,40 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
 
-import serial
+#
+# Look at what the module sends, or record it.
+#
+#   python testRead.py                          hex dump of whatever arrives
+#   python testRead.py --capture run.pncp       raw capture, see capture.py
+#
+# In capture mode every read is written as it came off the port, with the
+# monotonic and wall clock in ns taken as soon as the port was readable, so
+# redecode.py can run the framer and decoder over it again later. The port
+# is watched with select() instead of polling, chunking and timing stay as
+# close to what the base station sees as possible.
+#
+
+import argparse
+import selectors
+import sys
 import time
 
-# Open serial port
-ser = serial.Serial(
-    port='/dev/ttyACM0',
-    baudrate=9600,
-    bytesize=serial.EIGHTBITS,
-    parity=serial.PARITY_NONE,
-    stopbits=serial.STOPBITS_ONE,
-    timeout=1
-)
+import serial
 
-print("Waiting for data... Press Ctrl+C to exit")
+from capture import CaptureWriter
 
-try:
+def open_port(port, baudrate):
+    return serial.Serial(
+        port=port,
+        baudrate=baudrate,
+        bytesize=serial.EIGHTBITS,
+        parity=serial.PARITY_NONE,
+        stopbits=serial.STOPBITS_ONE,
+        timeout=1
+    )
+
+def dump(ser):
+    print("Waiting for data... Press Ctrl+C to exit")
     while True:
         if ser.in_waiting:
             # Read all available bytes
@@ -24,11 +42,63 @@ try:
             print("Raw data received:", [hex(x) for x in data])
             try:
                 print("As string:", data.decode('utf-8'))
-            except:
+            except UnicodeDecodeError:
                 print("Could not decode as UTF-8")
         time.sleep(0.1)
 
-except KeyboardInterrupt:
-    print("\nExiting...")
-finally:
-    ser.close()
\ No newline at end of file
+def capture(ser, writer, report_interval=10.0):
+    print(f"Capturing to {writer.path}... Press Ctrl+C to stop")
+    selector = selectors.DefaultSelector()
+    selector.register(ser.fileno(), selectors.EVENT_READ)
+    monotonic_ns = time.monotonic_ns
+    time_ns = time.time_ns
+    reported = time.monotonic()
+    while True:
+        if selector.select(timeout=1.0):
+            mono_ns = monotonic_ns()
+            wall_ns = time_ns()
+            data = ser.read(ser.in_waiting or 1)
+            if data:
+                writer.write(data, mono_ns, wall_ns)
+        now = time.monotonic()
+        if now - reported >= report_interval:
+            print(f"{writer.chunks} chunks, {writer.bytes} bytes")
+            reported = now
+
+def main():
+    parser = argparse.ArgumentParser(description="Dump or capture raw module output")
+    parser.add_argument('--port', default='/dev/ttyACM0')
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--capture', metavar='FILE', help="append raw chunks to this capture file")
+    parser.add_argument('--no-rssi', action='store_true',
+                        help="the module does not append an RSSI byte to packets")
+    parser.add_argument('--channel', type=int, help="module channel, stored in the capture")
+    args = parser.parse_args()
+
+    writer = None
+    if args.capture:
+        try:
+            writer = CaptureWriter(args.capture, rssi=not args.no_rssi,
+                                   channel=args.channel, baudrate=args.baud)
+        except (OSError, ValueError) as e:
+            print(f"Cannot capture to {args.capture}: {e}")
+            return 1
+
+    # Open serial port
+    ser = open_port(args.port, args.baud)
+    try:
+        if writer is not None:
+            capture(ser, writer)
+        else:
+            dump(ser)
+    except KeyboardInterrupt:
+        print("\nExiting...")
+    finally:
+        if writer is not None:
+            writer.close()
+            print(f"Captured {writer.chunks} chunks, {writer.bytes} bytes to {writer.path}")
+        ser.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
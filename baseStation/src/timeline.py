@@ -0,0 +1,25 @@
+import time
+
+class Timeline:
+    #
+    # Startup steps with the milliseconds since the timeline was created,
+    # printed as they happen and served under /stats as 'startup'. Create
+    # it before the heavy imports so they are part of the timeline.
+    #
+    def __init__(self, budget=None):
+        self.start = time.monotonic()
+        # seconds the web API should be up within, None for no budget
+        self.budget = budget
+        self.steps = []
+
+    def mark(self, step):
+        ms = (time.monotonic() - self.start) * 1000
+        self.steps.append((step, ms))
+        print(f"[{ms:8.1f} ms] {step}")
+        return ms
+
+    def stats(self):
+        return {
+            'budget_ms': self.budget * 1000 if self.budget is not None else None,
+            'steps': [{'step': name, 'ms': round(ms, 1)} for name, ms in self.steps],
+        }
@@ -0,0 +1,207 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+# Every message goes out behind a one byte length, [len][message] records
+# back to back, so a node can split a packet that carries several messages
+# (see checkIncomingMessages in sensor/src/main.cpp)
+MAX_MESSAGE = 0xFF
+
+# Bytes on air besides the payload: preamble, sync word, LoRa header and
+# CRC, expressed at the air data rate
+AIR_OVERHEAD_BYTES = 12
+
+def time_on_air(nbytes, air_speed):
+    #
+    # Estimated seconds a packet of `nbytes` payload bytes occupies the
+    # channel at the module's air data rate (bits per second). The module
+    # only exposes the data rate, not spreading factor and bandwidth, so
+    # this is rate based rather than the full LoRa symbol formula.
+    #
+    return (nbytes + AIR_OVERHEAD_BYTES) * 8 / air_speed
+
+def uart_time(nbytes, baudrate):
+    # Seconds to move nbytes over the UART to the module (8N1)
+    return nbytes * 10 / baudrate
+
+class TransmitQueue:
+    #
+    # Non-blocking send queue in front of sx126x.send, run on the event loop.
+    #
+    # send() only queues the message. The queue task then, per packet:
+    #
+    #   - packs queued messages for the same destination into one packet
+    #     of at most the module's buffer_size, so many small commands or
+    #     acks cost one preamble instead of one each; every message is
+    #     length prefixed, packed or not, so the node can split them again
+    #   - waits until the previous packet has left the UART and the air
+    #   - waits while receiving() says a packet is coming in from the module
+    #   - keeps the airtime of the last `window` seconds under
+    #     duty_cycle * window
+    #
+    # Destinations are served round robin, so one chatty node can't hold up
+    # the rest. Messages to one destination keep their order.
+    #
+    # start()/stop() match the service hooks in web_server.
+    #
+    def __init__(self, node, receiving=None, duty_cycle=0.1, window=3600.0,
+                 maxsize=256, pack=True, poll=0.01):
+        self.node = node
+        self.receiving = receiving or (lambda: False)
+        self.duty_cycle = duty_cycle
+        self.window = window
+        self.maxsize = maxsize
+        self.pack = pack
+        self.poll = poll
+        self.queued = 0
+        self.packets = 0
+        self.messages = 0
+        self.dropped = 0
+        self.deferred = 0
+        self.airtime = 0.0
+        self._queues = OrderedDict()
+        self._depth = 0
+        self._history = deque()
+        self._used = 0.0
+        self._free_at = 0.0
+        self._wake = None
+        self._task = None
+
+    @property
+    def buffer_size(self):
+        return self.node.config.buffer_size if self.node.config else 240
+
+    @property
+    def air_speed(self):
+        return self.node.config.air_speed if self.node.config else 2400
+
+    def budget(self):
+        return self.duty_cycle * self.window
+
+    def send(self, addr, payload, channel=None):
+        # Queue payload for node `addr`, False when the queue is full
+        limit = min(self.buffer_size - 1, MAX_MESSAGE)
+        if len(payload) > limit:
+            raise ValueError(f"payload of {len(payload)} bytes exceeds the {limit} bytes "
+                             f"a message can carry")
+        if time_on_air(len(payload) + 1, self.air_speed) > self.budget():
+            raise ValueError("payload needs more airtime than the duty cycle allows")
+        if self._depth >= self.maxsize:
+            self.dropped += 1
+            return False
+        if channel is None:
+            channel = self.node.offset_freq
+        key = (addr, channel)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append(bytes((len(payload),)) + payload)
+        self._depth += 1
+        self.queued += 1
+        if self._wake is not None:
+            self._wake.set()
+        return True
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def busy(self):
+        # Something queued, or the last packet still on the UART or the air
+        return self._depth > 0 or time.monotonic() < self._free_at
+
+    def duty_used(self):
+        # Airtime spent in the current window, as a fraction of the window
+        self._expire(time.monotonic())
+        return self._used / self.window
+
+    def stats(self):
+        return {
+            'depth': self._depth,
+            'queued': self.queued,
+            'packets': self.packets,
+            'messages': self.messages,
+            'dropped': self.dropped,
+            'deferred_for_receive': self.deferred,
+            'airtime_seconds': round(self.airtime, 3),
+            'duty_used': round(self.duty_used(), 5),
+            'duty_cycle': self.duty_cycle,
+        }
+
+    def _expire(self, now):
+        history = self._history
+        while history and history[0][0] <= now - self.window:
+            self._used -= history.popleft()[1]
+
+    def _next_packet(self):
+        # Pop the first destination's (length prefixed) messages that fit one packet
+        (addr, channel), queue = next(iter(self._queues.items()))
+        payload = queue.popleft()
+        count = 1
+        if self.pack:
+            limit = self.buffer_size
+            while queue and len(payload) + len(queue[0]) <= limit:
+                payload += queue.popleft()
+                count += 1
+        del self._queues[(addr, channel)]
+        if queue:
+            # back of the line for the rest
+            self._queues[(addr, channel)] = queue
+        self._depth -= count
+        return addr, channel, payload, count
+
+    def _wait_time(self, airtime):
+        # Seconds until the next packet may go out, 0 when it can go now
+        now = time.monotonic()
+        if now < self._free_at:
+            return self._free_at - now
+        if self.receiving():
+            self.deferred += 1
+            return self.poll
+        self._expire(now)
+        over = self._used + airtime - self.budget()
+        if over > 0:
+            # wait for enough old packets to fall out of the window
+            freed = 0.0
+            for t, spent in self._history:
+                freed += spent
+                if freed >= over:
+                    return t + self.window - now
+        return 0.0
+
+    async def _run(self):
+        while True:
+            if not self._depth:
+                await self._wake.wait()
+                self._wake.clear()
+                continue
+            # size of the packet as it stands, messages queued while
+            # waiting can still join it
+            addr, channel = next(iter(self._queues))
+            queue = self._queues[(addr, channel)]
+            estimate = time_on_air(min(sum(map(len, queue)), self.buffer_size), self.air_speed)
+            delay = self._wait_time(estimate)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            addr, channel, payload, count = self._next_packet()
+            airtime = time_on_air(len(payload), self.air_speed)
+            data = bytes((addr >> 8 & 0xFF, addr & 0xFF, channel)) + payload
+            try:
+                self.node.send(data)
+            except Exception as e:
+                print(f"Transmit to node 0x{addr:04X} failed: {e}")
+                self.dropped += count
+                continue
+            now = time.monotonic()
+            self._free_at = now + uart_time(len(data), self.node.ser.baudrate) + airtime
+            self._history.append((now, airtime))
+            self._used += airtime
+            self.airtime += airtime
+            self.packets += 1
+            self.messages += count
@@ -0,0 +1,161 @@
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+
+# Register block as read back with 0xC1 0x00 0x09, matches sx126x.cfg_reg
+# after set(433 MHz, addr 0, 22 dBm, rssi on, 2400 bps)
+#   ADDH ADDL NETID REG0 REG1 REG2(channel) REG3 CRYPT_H CRYPT_L
+DEFAULT_REGS = bytes([0x00, 0x00, 0x00, 0x62, 0x20, 0x17, 0xC3, 0x00, 0x00])
+
+NOISE_CMD = bytes([0xC0, 0xC1, 0xC2, 0xC3])
+
+class VirtualSX126x:
+    #
+    # Software stand-in for an E22 module in receive mode, exposed as a
+    # pseudo terminal. Open `port` with pyserial (or hand it to sx126x) and
+    # it behaves like the module's UART:
+    #
+    #   - 0xC0/0xC2 writes set the registers and are answered with 0xC1 ...
+    #   - 0xC1 start len reads registers back
+    #   - C0 C1 C2 C3 start len reads the noise / last packet RSSI
+    #   - anything else is counted as data to transmit
+    #
+    # emit() writes a received packet the way the module does: sender
+    # address, channel, payload and, when REG3 bit 7 is set, an RSSI byte.
+    # With pace on, bytes leave no faster than the UART baud rate allows,
+    # so the pty saturates where the real serial link would.
+    #
+    # corrupt_rate, truncate_rate and merge_rate inject flipped bytes, cut
+    # off packets and packets glued to the next one in a single write.
+    #
+    def __init__(self, baudrate=9600, pace=True, regs=DEFAULT_REGS,
+                 noise_dbm=-110, seed=None):
+        self.baudrate = baudrate
+        self.pace = pace
+        self.regs = bytearray(regs)
+        self.noise_dbm = noise_dbm
+        self.last_rssi = 0
+        self.corrupt_rate = 0.0
+        self.truncate_rate = 0.0
+        self.merge_rate = 0.0
+        self.packets = 0
+        self.bytes = 0
+        self.commands = 0
+        self.transmitted = 0
+        self._rng = random.Random(seed)
+        self._held = bytearray()
+        self._busy_until = 0.0
+        self._write_lock = threading.Lock()
+        self.master, self._slave = pty.openpty()
+        # no echo or newline translation, the pty must pass bytes untouched
+        tty.setraw(self._slave)
+        tty.setraw(self.master)
+        self.port = os.ttyname(self._slave)
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = threading.Thread(target=self._serve, name="virtual-sx126x",
+                                        daemon=True)
+        self._thread.start()
+
+    @property
+    def rssi_enabled(self):
+        return bool(self.regs[6] & 0x80)
+
+    @property
+    def channel(self):
+        return self.regs[5]
+
+    def close(self):
+        os.write(self._stop_w, b"x")
+        self._thread.join()
+        for fd in (self.master, self._slave, self._stop_r, self._stop_w):
+            os.close(fd)
+
+    def frame(self, addr, payload, rssi_dbm=-80):
+        # Bytes the module would put on its UART for one received packet
+        out = bytearray((addr >> 8 & 0xFF, addr & 0xFF, self.channel))
+        out += payload
+        if self.rssi_enabled:
+            out.append((256 + rssi_dbm) & 0xFF)
+        self.last_rssi = rssi_dbm
+        return out
+
+    def emit(self, addr, payload, rssi_dbm=-80):
+        data = self.frame(addr, payload, rssi_dbm)
+        rng = self._rng
+        if self.corrupt_rate and rng.random() < self.corrupt_rate:
+            i = rng.randrange(len(data))
+            data[i] ^= 1 << rng.randrange(8)
+        if self.truncate_rate and rng.random() < self.truncate_rate:
+            del data[rng.randrange(1, len(data)):]
+        self.packets += 1
+        self._held += data
+        if self.merge_rate and rng.random() < self.merge_rate:
+            # goes out together with the next packet
+            return
+        self.flush()
+
+    def flush(self):
+        if not self._held:
+            return
+        data, self._held = bytes(self._held), bytearray()
+        self._write(data)
+
+    def _write(self, data):
+        with self._write_lock:
+            if self.pace:
+                # the UART sends one character per 10 bit times
+                now = time.monotonic()
+                start = max(now, self._busy_until)
+                self._busy_until = start + len(data) * 10 / self.baudrate
+                if start > now:
+                    time.sleep(start - now)
+            view = memoryview(data)
+            while view:
+                n = os.write(self.master, view)
+                view = view[n:]
+            self.bytes += len(data)
+
+    def _serve(self):
+        buf = bytearray()
+        while True:
+            ready, _, _ = select.select([self.master, self._stop_r], [], [])
+            if self._stop_r in ready:
+                return
+            try:
+                buf += os.read(self.master, 1024)
+            except OSError:
+                return
+            self._handle(buf)
+
+    def _handle(self, buf):
+        while buf:
+            if buf[:4] == NOISE_CMD:
+                if len(buf) < 6:
+                    return
+                start, length = buf[4], buf[5]
+                values = bytes(((256 + self.noise_dbm) & 0xFF, (256 + self.last_rssi) & 0xFF))
+                self.commands += 1
+                self._write(bytes((0xC1, start, length)) + values[start:start + length])
+                del buf[:6]
+            elif buf[0] in (0xC0, 0xC2):
+                if len(buf) < 3 or len(buf) < 3 + buf[2]:
+                    return
+                start, length = buf[1], buf[2]
+                self.regs[start:start + length] = buf[3:3 + length]
+                self.commands += 1
+                self._write(bytes((0xC1, start, length)) + bytes(self.regs[start:start + length]))
+                del buf[:3 + length]
+            elif buf[0] == 0xC1:
+                if len(buf) < 3:
+                    return
+                start, length = buf[1], buf[2]
+                self.commands += 1
+                self._write(bytes((0xC1, start, length)) + bytes(self.regs[start:start + length]))
+                del buf[:3]
+            else:
+                self.transmitted += len(buf)
+                del buf[:]
@@ -1,10 +1,68 @@
-from fastapi import FastAPI, WebSocket
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket
+from fastapi.responses import (HTMLResponse, JSONResponse, PlainTextResponse, Response,
+                               StreamingResponse)
 from fastapi.middleware.cors import CORSMiddleware
-import json
+from contextlib import asynccontextmanager
+from typing import Optional, Union
+from pydantic import BaseModel
+import asyncio
+import time
+from collections import deque
 from datetime import datetime
 
-app = FastAPI()
+from bus import bus
+import metrics
+from store import SampleStore, columns, json_floats, parse_rssi, parse_time, FIELDS
+import downsample
+import export
+from sample import Sample, json_array
+from analytics import SERIES, SERIES_INDEX
+
+# Objects with start()/stop() run inside the server's event loop, started
+# after the web server's own tasks and stopped in reverse order on shutdown
+# (baseStation.py adds the radio receiver here). One with an async drain()
+# has it awaited before its stop(), to finish what it has queued for the
+# services stopped after it.
+services = []
+
+# name -> callable returning a JSON-able dict, served under /stats
+stats = {}
+
+# radios.RadioGroup when radios are attached. POST /nodes/{node}/send queues
+# messages on it (as transmitter), /noise serves its noise floor readings
+# and /nodes the link margin against them (as noise).
+transmitter = None
+noise = None
+
+# archive.ColumnStore with the long term history, /nodes/{node}/archive
+archive = None
+
+# analytics.Analytics with the derived motion series, /nodes/{node}/analytics
+analytics = None
+
+# alerts.AlertEngine evaluating the alert rules, /alerts
+alerts = None
+
+@asynccontextmanager
+async def lifespan(app):
+    tasks = [asyncio.create_task(consume_samples()),
+             asyncio.create_task(broadcaster.run())]
+    started = []
+    try:
+        for service in services:
+            service.start()
+            started.append(service)
+        yield
+    finally:
+        for service in reversed(started):
+            drain = getattr(service, 'drain', None)
+            if drain is not None:
+                await drain()
+            service.stop()
+        for task in tasks:
+            task.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS for all origins
 app.add_middleware(
@@ -15,8 +73,180 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Store the latest sensor data
-latest_data = {}
+# Latest sample.Sample from any node, served (pre-serialized) by /data
+latest_data = None
+
+# Latest sample and recent history for every node, keyed by node address
+store = SampleStore(capacity=3600, max_nodes=32)
+
+class SampleFeed:
+    #
+    # Every sample the web server stores gets the next sequence number and
+    # is kept in a ring of the last `capacity`, so HTTP clients can ask for
+    # everything after the last number they saw (/data?after=) and know how
+    # many they missed when they fell further behind than the ring reaches.
+    # Numbers restart with the server, `epoch` (its start time) tells runs
+    # apart: a cursor given with another run's epoch, or beyond the current
+    # number, is from an earlier run and counts as 0.
+    #
+    # wait() parks a long-poll until a sample after the cursor arrives. The
+    # waiters share one event, set and replaced on the next append, so an
+    # idle feed costs nothing and an append costs the same however many
+    # clients are waiting.
+    #
+    def __init__(self, capacity=4096):
+        self.epoch = int(time.time())
+        self.seq = 0
+        self.samples = deque(maxlen=capacity)
+        self.waiting = 0
+        self._changed = None
+
+    def append(self, sample):
+        self.seq += 1
+        sample.seq = self.seq
+        self.samples.append(sample)
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def cursor(self, after, epoch=None):
+        if after > self.seq or (epoch is not None and epoch != self.epoch):
+            return 0
+        return after
+
+    def since(self, after, limit, epoch=None):
+        # (samples after the cursor oldest first, at most limit, missed count)
+        after = self.cursor(after, epoch)
+        out = []
+        for sample in reversed(self.samples):
+            if sample.seq <= after:
+                break
+            out.append(sample)
+        out.reverse()
+        missed = out[0].seq - after - 1 if out else 0
+        return out[:limit], missed
+
+    async def wait(self, after, timeout, epoch=None):
+        if self.cursor(after, epoch) < self.seq or timeout <= 0:
+            return
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        changed = self._changed
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.waiting -= 1
+
+    def etag(self):
+        return f'"{self.epoch}-{self.seq}"'
+
+feed = SampleFeed()
+
+# Longest /data?wait= the server holds a request for, and the most samples
+# one long-poll response carries
+LONG_POLL_MAX_WAIT = 60.0
+LONG_POLL_MAX_SAMPLES = 1000
+
+# Upper bound on WebSocket messages per second, samples arriving faster
+# than this are coalesced into one batch
+WS_MAX_RATE = 20.0
+
+class WebSocketClient:
+    # Outgoing messages for one socket. The queue is bounded, when a client
+    # can't keep up its oldest batches are dropped rather than buffered.
+    def __init__(self, websocket, maxlen):
+        self.websocket = websocket
+        self.queue = deque(maxlen=maxlen)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def offer(self, message):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(message)
+        self.ready.set()
+
+    async def send_loop(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                await self.websocket.send_text(self.queue.popleft())
+
+class Broadcaster:
+    #
+    # Single fan-out point for all dashboard sockets. Samples are collected
+    # and sent as one JSON array at most `max_rate` times per second, each
+    # batch is serialized once and the same text goes to every client.
+    #
+    def __init__(self, max_rate=WS_MAX_RATE, client_queue=16):
+        self.interval = 1.0 / max_rate if max_rate else 0.0
+        self.client_queue = client_queue
+        self.clients = set()
+        # batches dropped for clients that have disconnected since
+        self.dropped = 0
+        self._pending = []
+        self._wake = None
+
+    def publish(self, sample):
+        self._pending.append(sample)
+        if self._wake is not None:
+            self._wake.set()
+
+    async def run(self):
+        # the event is made here so it belongs to the server's loop
+        self._wake = asyncio.Event()
+        self._wake.set()
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            batch, self._pending = self._pending, []
+            if self.clients:
+                message = json_array(batch).decode()
+                for client in self.clients:
+                    client.offer(message)
+            if self.interval:
+                await asyncio.sleep(self.interval)
+
+    async def serve(self, websocket):
+        await websocket.accept()
+        client = WebSocketClient(websocket, self.client_queue)
+        if latest_data is not None:
+            client.offer(json_array([latest_data]).decode())
+        self.clients.add(client)
+        sender = asyncio.create_task(client.send_loop())
+        try:
+            # the dashboard never sends anything, this only waits for it to go
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+        finally:
+            self.clients.discard(client)
+            self.dropped += client.dropped
+            sender.cancel()
+
+broadcaster = Broadcaster()
+
+async def consume_samples():
+    # Samples decoded by the receiver in this process arrive over the bus,
+    # the receive thread wakes this task only when the queue was drained
+    global latest_data
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    samples = bus.subscribe(maxlen=256, notify=lambda: loop.call_soon_threadsafe(wake.set))
+    try:
+        while True:
+            await wake.wait()
+            wake.clear()
+            for sample in samples.drain():
+                latest_data = sample
+                feed.append(sample)
+                store.add(sample)
+                broadcaster.publish(sample)
+    finally:
+        samples.close()
 
 # Simplified HTML template
 html = """
@@ -65,6 +295,13 @@ html = """
             
             <div class="card">
                 <h2>Linear Acceleration Graph</h2>
+                <select id="range">
+                    <option value="0">Live</option>
+                    <option value="900">15 minutes</option>
+                    <option value="3600">1 hour</option>
+                    <option value="21600">6 hours</option>
+                    <option value="86400">24 hours</option>
+                </select>
                 <canvas id="linearAccelChart"></canvas>
             </div>
 
@@ -148,63 +385,193 @@ html = """
                 }
             });
 
-            function updateData() {
-                fetch('/data')
+            // Live mode appends every sample, a history range shows at most
+            // historyPoints server side downsampled buckets instead
+            const historyPoints = 500;
+            const axes = ["linear_accel_x", "linear_accel_y", "linear_accel_z"];
+            let rangeSeconds = 0;
+            let currentNode = null;
+
+            function loadHistory() {
+                if (currentNode === null) {
+                    return;
+                }
+                const params = new URLSearchParams({
+                    since: Date.now() / 1000 - rangeSeconds,
+                    points: historyPoints,
+                    fields: axes.join(",")
+                });
+                fetch(`/nodes/${currentNode}/history?` + params)
                     .then(response => response.json())
-                    .then(data => {
-                        const timestamp = new Date().toLocaleTimeString();
-                        document.getElementById("timestamp").textContent = timestamp;
-                        
-                        // Update temperature
-                        if (data.temp !== undefined) {
-                            document.getElementById("temperature").textContent = data.temp.toFixed(1);
-                        }
-                        
-                        // Update orientation
-                        if (data.orientation) {
-                            document.getElementById("orientation_x").textContent = data.orientation.x.toFixed(2);
-                            document.getElementById("orientation_y").textContent = data.orientation.y.toFixed(2);
-                            document.getElementById("orientation_z").textContent = data.orientation.z.toFixed(2);
+                    .then(result => {
+                        const first = result.series[axes[0]];
+                        linearAccelChart.data.labels = first
+                            ? first.timestamp.map(t => new Date(t * 1000).toLocaleTimeString())
+                            : [];
+                        axes.forEach((axis, i) => {
+                            linearAccelChart.data.datasets[i].data = result.series[axis]
+                                ? result.series[axis].mean : [];
+                        });
+                        linearAccelChart.update();
+                    })
+                    .catch(console.error);
+            }
+
+            document.getElementById("range").addEventListener("change", event => {
+                rangeSeconds = Number(event.target.value);
+                linearAccelChart.data.labels = [];
+                linearAccelChart.data.datasets.forEach(dataset => dataset.data = []);
+                if (rangeSeconds) {
+                    loadHistory();
+                } else {
+                    linearAccelChart.update();
+                }
+            });
+            setInterval(() => { if (rangeSeconds) loadHistory(); }, 10000);
+
+            // Readings a node didn't send are left out of the sample
+            function fixed(value, digits) {
+                return value != null ? value.toFixed(digits) : "-";
+            }
+
+            function render(data, chartUpdate) {
+                if (data.node !== undefined) {
+                    currentNode = data.node;
+                }
+                const timestamp = data.timestamp ? new Date(data.timestamp).toLocaleTimeString()
+                                                 : new Date().toLocaleTimeString();
+                document.getElementById("timestamp").textContent = timestamp;
+                
+                // Update temperature
+                if (data.temp != null) {
+                    document.getElementById("temperature").textContent = data.temp.toFixed(1);
+                }
+                
+                // Update orientation
+                if (data.orientation != null) {
+                    document.getElementById("orientation_x").textContent = fixed(data.orientation.x, 2);
+                    document.getElementById("orientation_y").textContent = fixed(data.orientation.y, 2);
+                    document.getElementById("orientation_z").textContent = fixed(data.orientation.z, 2);
+                }
+                
+                // Update accelerometer
+                if (data.accel != null) {
+                    document.getElementById("accel_x").textContent = fixed(data.accel.x, 2);
+                    document.getElementById("accel_y").textContent = fixed(data.accel.y, 2);
+                    document.getElementById("accel_z").textContent = fixed(data.accel.z, 2);
+                }
+                
+                // Update status
+                document.getElementById("rssi").textContent = data.rssi || "-";
+                document.getElementById("cal_sys").textContent = data.cal && data.cal.sys != null ? data.cal.sys : "-";
+
+                // Update linear acceleration values
+                if (data.linear_accel != null) {
+                    document.getElementById("linear_accel_x").textContent = fixed(data.linear_accel.x, 2);
+                    document.getElementById("linear_accel_y").textContent = fixed(data.linear_accel.y, 2);
+                    document.getElementById("linear_accel_z").textContent = fixed(data.linear_accel.z, 2);
+
+                    if (rangeSeconds) {
+                        return;
+                    }
+
+                    // Update chart
+                    linearAccelChart.data.labels.push(timestamp);
+                    linearAccelChart.data.datasets[0].data.push(data.linear_accel.x);
+                    linearAccelChart.data.datasets[1].data.push(data.linear_accel.y);
+                    linearAccelChart.data.datasets[2].data.push(data.linear_accel.z);
+
+                    // Remove old data points if we have too many
+                    if (linearAccelChart.data.labels.length > maxDataPoints) {
+                        linearAccelChart.data.labels.shift();
+                        linearAccelChart.data.datasets.forEach(dataset => dataset.data.shift());
+                    }
+
+                    if (chartUpdate) {
+                        linearAccelChart.update();
+                    }
+                }
+            }
+
+            // Fallback when the WebSocket is unavailable: long-polls /data
+            // from the last sequence number seen, so no sample is skipped
+            // and an idle link costs one request per 25 seconds. The epoch
+            // goes along so a cursor from before a server restart is not
+            // taken for a position in the new run
+            let pollRun = 0;
+
+            async function pollLoop(run) {
+                let cursor = null;
+                let epoch = null;
+                while (run === pollRun) {
+                    try {
+                        if (cursor === null) {
+                            const response = await fetch('/data');
+                            // ETag is "epoch-seq"
+                            const tag = (response.headers.get('ETag') || '').match(/(\d+)-\d+/);
+                            const latest = await response.json();
+                            if (latest.seq !== undefined) {
+                                render(latest, true);
+                            }
+                            cursor = latest.seq || 0;
+                            epoch = tag ? tag[1] : null;
+                            continue;
                         }
-                        
-                        // Update accelerometer
-                        if (data.accel) {
-                            document.getElementById("accel_x").textContent = data.accel.x.toFixed(2);
-                            document.getElementById("accel_y").textContent = data.accel.y.toFixed(2);
-                            document.getElementById("accel_z").textContent = data.accel.z.toFixed(2);
+                        const since = epoch === null ? '' : `&epoch=${epoch}`;
+                        const page = await (await fetch(`/data?after=${cursor}${since}&wait=25`)).json();
+                        if (run !== pollRun) {
+                            break;
                         }
-                        
-                        // Update status
-                        document.getElementById("rssi").textContent = data.rssi || "-";
-                        document.getElementById("cal_sys").textContent = data.cal ? data.cal.sys : "-";
-
-                        // Update linear acceleration values
-                        if (data.linear_accel) {
-                            document.getElementById("linear_accel_x").textContent = data.linear_accel.x.toFixed(2);
-                            document.getElementById("linear_accel_y").textContent = data.linear_accel.y.toFixed(2);
-                            document.getElementById("linear_accel_z").textContent = data.linear_accel.z.toFixed(2);
-
-                            // Update chart
-                            linearAccelChart.data.labels.push(timestamp);
-                            linearAccelChart.data.datasets[0].data.push(data.linear_accel.x);
-                            linearAccelChart.data.datasets[1].data.push(data.linear_accel.y);
-                            linearAccelChart.data.datasets[2].data.push(data.linear_accel.z);
-
-                            // Remove old data points if we have too many
-                            if (linearAccelChart.data.labels.length > maxDataPoints) {
-                                linearAccelChart.data.labels.shift();
-                                linearAccelChart.data.datasets.forEach(dataset => dataset.data.shift());
-                            }
-
+                        epoch = page.epoch;
+                        page.samples.forEach(sample => render(sample, false));
+                        if (page.samples.length && !rangeSeconds) {
                             linearAccelChart.update();
                         }
-                    })
-                    .catch(console.error);
+                        cursor = page.seq;
+                    } catch (error) {
+                        console.error(error);
+                        await new Promise(resolve => setTimeout(resolve, 1000));
+                    }
+                }
+            }
+
+            function startPolling() {
+                if (pollRun % 2 === 0) {
+                    pollRun++;
+                    pollLoop(pollRun);
+                }
+            }
+
+            function stopPolling() {
+                if (pollRun % 2 === 1) {
+                    pollRun++;
+                }
             }
 
-            // Update every second
-            setInterval(updateData, 1000);
-            updateData();  // Initial update
+            // Every message is a batch of samples, oldest first, the chart
+            // is redrawn once per batch
+            function connect() {
+                if (!("WebSocket" in window)) {
+                    startPolling();
+                    return;
+                }
+                const scheme = location.protocol === "https:" ? "wss://" : "ws://";
+                const socket = new WebSocket(scheme + location.host + "/ws");
+                socket.onopen = stopPolling;
+                socket.onmessage = event => {
+                    const batch = JSON.parse(event.data);
+                    batch.forEach(sample => render(sample, false));
+                    if (!rangeSeconds) {
+                        linearAccelChart.update();
+                    }
+                };
+                socket.onclose = () => {
+                    startPolling();
+                    setTimeout(connect, 5000);
+                };
+            }
+
+            connect();
         </script>
     </body>
 </html>
@@ -214,16 +581,299 @@ html = """
 async def get():
     return HTMLResponse(html)
 
+# The sample's JSON is built once, polls only copy the cached bytes.
+#
+# Without `after` the latest sample, with an ETag of the feed position
+# ("epoch-seq"): a poll sending it back as If-None-Match, weak or not, gets
+# an empty 304 until a new sample arrives.
+#
+# With `after` (a seq from an earlier response) every sample since, oldest
+# first, as {"epoch", "seq", "missed", "samples"}. If there is none yet the
+# request is held up to `wait` seconds and answered as soon as one arrives.
+# seq is the cursor for the next request, missed the samples that had
+# already left the feed's ring; following seq from response to response
+# sees every sample exactly once. `epoch` is the run the cursor came from,
+# after a restart it no longer matches and the feed is read from its start,
+# with whatever the ring no longer holds counted as missed.
 @app.get("/data")
-async def get_data():
-    return JSONResponse(latest_data)
+async def get_data(request: Request, after: Optional[int] = Query(None, ge=0),
+                   wait: float = Query(0.0, ge=0, le=LONG_POLL_MAX_WAIT),
+                   limit: int = Query(LONG_POLL_MAX_SAMPLES, ge=1, le=LONG_POLL_MAX_SAMPLES),
+                   epoch: Optional[int] = Query(None)):
+    if after is None:
+        etag = feed.etag()
+        headers = {'ETag': etag}
+        match = request.headers.get('if-none-match')
+        if match is not None and (match.strip() == '*' or etag in
+                                  (tag.strip().removeprefix('W/') for tag in match.split(','))):
+            return Response(status_code=304, headers=headers)
+        body = latest_data.json() if latest_data is not None else b'{}'
+        return Response(body, media_type="application/json", headers=headers)
+    await feed.wait(after, wait, epoch)
+    samples, missed = feed.since(after, limit, epoch)
+    seq = samples[-1].seq if samples else feed.cursor(after, epoch)
+    body = b'{"epoch":%d,"seq":%d,"missed":%d,"samples":%s}' % (
+        feed.epoch, seq, missed, json_array(samples))
+    return Response(body, media_type="application/json", headers={'Cache-Control': 'no-store'})
+
+# Body of POST /update, the same shape /data serves
+class Vector(BaseModel):
+    x: Optional[float] = None
+    y: Optional[float] = None
+    z: Optional[float] = None
 
+class Calibration(BaseModel):
+    sys: Optional[int] = None
+    gyro: Optional[int] = None
+    accel: Optional[int] = None
+    mag: Optional[int] = None
+
+class SampleIn(BaseModel):
+    node: int = 0
+    timestamp: Union[float, str, None] = None
+    rssi: Union[float, str, None] = None
+    radio: Optional[str] = None
+    orientation: Optional[Vector] = None
+    gyro: Optional[Vector] = None
+    accel: Optional[Vector] = None
+    linear_accel: Optional[Vector] = None
+    gravity: Optional[Vector] = None
+    mag: Optional[Vector] = None
+    temp: Optional[float] = None
+    cal: Optional[Calibration] = None
+
+# For producers outside this process, the receiver publishes on the bus
 @app.post("/update")
-async def update_data(data: dict):
+async def update_data(data: SampleIn):
     global latest_data
-    latest_data = data
-    return {"status": "ok"}
+    try:
+        sample = Sample.from_dict(data.model_dump(exclude_none=True))
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"bad timestamp: {data.timestamp}")
+    latest_data = sample
+    feed.append(sample)
+    store.add(sample)
+    broadcaster.publish(sample)
+    return {"status": "ok", "seq": sample.seq}
+
+def node_history(node):
+    history = store.get(node)
+    if history is None:
+        raise HTTPException(status_code=404, detail=f"unknown node {node}")
+    return history
+
+@app.get("/nodes")
+async def get_nodes():
+    nodes = store.summary()
+    for entry in nodes:
+        # packet RSSI above the noise floor of the radio that heard it
+        floor = noise.floor(entry['radio']) if noise is not None else None
+        rssi = parse_rssi(entry['rssi'])
+        entry['noise_floor_dbm'] = floor
+        entry['margin_db'] = (round(rssi - floor, 1)
+                              if floor is not None and rssi == rssi else None)
+    return nodes
+
+@app.get("/nodes/{node}/latest")
+async def get_node_latest(node: int):
+    return Response(node_history(node).latest.json(), media_type="application/json")
+
+# since/until are epoch seconds or ISO 8601 times, fields a comma separated
+# subset. With points set the range is downsampled (method minmax or lttb)
+# to at most that many points per field.
+@app.get("/nodes/{node}/history")
+async def get_node_history(node: int, since: str = None, until: str = None,
+                           limit: int = None, fields: str = None,
+                           points: int = None, method: str = "minmax"):
+    history = node_history(node)
+    try:
+        since_t = parse_time(since)
+        until_t = parse_time(until)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"bad time range: {since}..{until}")
+    selected = fields.split(',') if fields else None
+    if selected and not set(selected) <= set(FIELDS):
+        raise HTTPException(status_code=400, detail=f"unknown fields: {fields}")
+    if points is None:
+        t, values = history.history(since_t, limit)
+        if until_t is not None:
+            keep = t < until_t
+            t, values = t[keep], values[keep]
+        return JSONResponse(columns(t, values, selected))
+
+    if points < 3 or method not in ("minmax", "lttb"):
+        raise HTTPException(status_code=400, detail="points must be >= 3, method minmax or lttb")
+    if until_t is None:
+        until_t = history.last_time() + 1e-3 if history.count else 0.0
+    if since_t is None:
+        since_t = until_t - 3600
+    result = downsample.series(history, selected or FIELDS, since_t, until_t,
+                               points, method)
+    result['node'] = node
+    return JSONResponse(result)
+
+@app.get("/noise")
+async def get_noise():
+    return noise.summary() if noise is not None else []
+
+@app.get("/noise/{channel}/history")
+async def get_noise_history(channel: int, since: str = None, radio: str = None):
+    try:
+        since_t = parse_time(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"bad time: {since}")
+    history = noise.history(channel, since_t, radio) if noise is not None else None
+    if history is None:
+        raise HTTPException(status_code=404, detail=f"no noise samples for channel {channel}")
+    return JSONResponse(history)
+
+# The request body is sent to the node as is
+@app.post("/nodes/{node}/send")
+async def send_to_node(node: int, request: Request):
+    if transmitter is None:
+        raise HTTPException(status_code=503, detail="no radio attached")
+    if not 0 <= node <= 0xFFFF:
+        raise HTTPException(status_code=400, detail=f"bad node address {node}")
+    try:
+        queued = transmitter.send(node, await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not queued:
+        raise HTTPException(status_code=429, detail="transmit queue full")
+    return {"status": "queued"}
+
+# Rows from the on-disk archive, newest `limit` rows of [since, until)
+@app.get("/nodes/{node}/archive")
+async def get_node_archive(node: int, since: str = None, until: str = None,
+                           fields: str = None, limit: int = 10000):
+    if archive is None:
+        raise HTTPException(status_code=503, detail="no archive configured")
+    if archive.node(node) is None:
+        raise HTTPException(status_code=404, detail=f"unknown node {node}")
+    try:
+        since_t = parse_time(since)
+        until_t = parse_time(until)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"bad time range: {since}..{until}")
+    selected = fields.split(',') if fields else None
+    if selected and not set(selected) <= set(FIELDS):
+        raise HTTPException(status_code=400, detail=f"unknown fields: {fields}")
+    t, cols = archive.query(node, since_t, until_t, selected, limit)
+    out = {'timestamp': t.tolist()}
+    for name, column in cols.items():
+        out[name] = json_floats(column)
+    return JSONResponse(out)
+
+# Alerts firing now and the latest notifications sent
+@app.get("/alerts")
+async def get_alerts():
+    if alerts is None:
+        raise HTTPException(status_code=503, detail="no alert rules configured")
+    return {'active': alerts.active(), 'recent': list(alerts.notifier.recent)}
+
+# Latest derived motion figures of every node
+@app.get("/analytics")
+async def get_analytics():
+    if analytics is None:
+        raise HTTPException(status_code=503, detail="no analytics configured")
+    return analytics.summary()
+
+# Derived series of one node (see analytics.SERIES), fields a comma
+# separated subset of them
+@app.get("/nodes/{node}/analytics")
+async def get_node_analytics(node: int, since: str = None, until: str = None,
+                             limit: int = None, fields: str = None):
+    if analytics is None:
+        raise HTTPException(status_code=503, detail="no analytics configured")
+    series = analytics.get(node)
+    if series is None:
+        raise HTTPException(status_code=404, detail=f"unknown node {node}")
+    try:
+        since_t = parse_time(since)
+        until_t = parse_time(until)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"bad time range: {since}..{until}")
+    selected = fields.split(',') if fields else SERIES
+    if not set(selected) <= set(SERIES):
+        raise HTTPException(status_code=400, detail=f"unknown fields: {fields}")
+    t, values = series.history(since_t, until_t, limit)
+    out = {'timestamp': t.tolist()}
+    for name in selected:
+        out[name] = json_floats(values[:, SERIES_INDEX[name]])
+    return JSONResponse(out)
+
+# Streams [since, until) of the selected nodes (comma separated, all by
+# default) as csv, ndjson or binary, see export.py. Gzipped when the client
+# accepts it; cursor=<node>:<timestamp> resumes after that row.
+@app.get("/export")
+def get_export(request: Request, nodes: str = None, since: str = None, until: str = None,
+               fields: str = None, format: str = 'csv', cursor: str = None):
+    if archive is None:
+        raise HTTPException(status_code=503, detail="no archive configured")
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"unknown format: {format}")
+    try:
+        since_t = parse_time(since)
+        until_t = parse_time(until)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"bad time range: {since}..{until}")
+    try:
+        selected_nodes = ([int(n, 0) for n in nodes.split(',')] if nodes
+                          else list(archive.nodes))
+        if cursor:
+            export.parse_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    selected = fields.split(',') if fields else list(FIELDS)
+    if not set(selected) <= set(FIELDS):
+        raise HTTPException(status_code=400, detail=f"unknown fields: {fields}")
+    gzip = export.accepts_gzip(request.headers.get('accept-encoding', ''))
+    headers = {'Vary': 'Accept-Encoding'}
+    if gzip:
+        headers['Content-Encoding'] = 'gzip'
+    # a plain generator, Starlette iterates it in a worker thread
+    return StreamingResponse(
+        export.export(archive, selected_nodes, since_t, until_t, selected, format, cursor, gzip),
+        media_type=export.FORMATS[format], headers=headers)
+
+@app.get("/stats")
+async def get_stats():
+    return {name: source() for name, source in stats.items()}
+
+for name, help, kind, collect in (
+        ('bus_published', "Samples published on the bus", 'counter', lambda: bus.published),
+        ('bus_dropped', "Samples dropped by slow bus subscribers", 'counter',
+         lambda: sum(sub.dropped for sub in bus.subscribers())),
+        ('websocket_clients', "Connected dashboard sockets", 'gauge',
+         lambda: len(broadcaster.clients)),
+        ('websocket_dropped', "Batches dropped for dashboard sockets that fell behind", 'counter',
+         lambda: broadcaster.dropped + sum(c.dropped for c in list(broadcaster.clients))),
+        ('store_rejected', "Samples from nodes beyond the store's node limit", 'counter',
+         lambda: store.rejected),
+        ('feed_seq', "Sequence number of the latest sample", 'counter', lambda: feed.seq),
+        ('long_poll_waiting', "/data long-polls waiting for a sample", 'gauge',
+         lambda: feed.waiting)):
+    metrics.registry.register_collector(name, help, kind, collect)
+
+# Prometheus text exposition format
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.registry.render(),
+                             media_type="text/plain; version=0.0.4")
+
+@app.websocket("/ws")
+async def websocket_stream(websocket: WebSocket):
+    await broadcaster.serve(websocket)
+
+# uvicorn.Server once run() is called, server.started tells when it listens
+server = None
 
-def run():
+def run(host="0.0.0.0", port=8000):
+    global server
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port))
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        # Ctrl+C after the services were stopped, as uvicorn.run() does
+        pass
\ No newline at end of file
@@ -19,6 +19,13 @@ const uint16_t nodeID = 0;     // Address 0
 const uint16_t freq = 433;     // 433MHz (matching the example)
 const uint8_t power = 22;      // 22dBm
 
+// Payload format: 1 sends the compact binary record, 0 the legacy JSON string
+#define PAYLOAD_BINARY 1
+
+// Binary record v1, layout must match baseStation/src/codec.py
+#define RECORD_V1 0xB1
+#define RECORD_V1_SIZE 39
+
 void setup(void) 
 {
   pinMode(LORA_M0_PIN, OUTPUT);
@@ -43,7 +50,7 @@ void setup(void)
   bno.setExtCrystalUse(true);
 }
 
-void sendMessage(const char* msg) {
+void sendMessage(const uint8_t* msg, size_t len) {
     // Calculate frequency offset for 433MHz
     uint8_t offset_frequence = freq - 410;  // For 433MHz band
     
@@ -57,42 +64,77 @@ void sendMessage(const char* msg) {
     LORA_SERIAL.write(nodeID >> 8);    // Own address high byte
     LORA_SERIAL.write(nodeID & 0xFF);  // Own address low byte
     LORA_SERIAL.write(offset_frequence);
-    LORA_SERIAL.print(msg);
+    LORA_SERIAL.write(msg, len);
     
     
     delay(100);
     digitalWrite(LED_PIN, LOW);
 }
 
+void sendMessage(const char* msg) {
+    sendMessage((const uint8_t*)msg, strlen(msg));
+}
+
+// Store v * scale as a saturated little endian int16
+static uint8_t* putScaled(uint8_t* p, float v, float scale) {
+  long x = lroundf(v * scale);
+  if (x > 32767) x = 32767;
+  if (x < -32768) x = -32768;
+  *p++ = x & 0xFF;
+  *p++ = (x >> 8) & 0xFF;
+  return p;
+}
+
+static uint8_t* putVector(uint8_t* p, float x, float y, float z, float scale) {
+  p = putScaled(p, x, scale);
+  p = putScaled(p, y, scale);
+  return putScaled(p, z, scale);
+}
+
+// One message from the base station
+void handleMessage(const uint8_t* msg, size_t len) {
+  Serial.printf("Message, %d bytes (hex): ", len);
+  for (size_t i = 0; i < len; i++) {
+    Serial.printf("0x%02X ", msg[i]);
+  }
+  Serial.println();
+  Serial.print("As ASCII: ");
+  Serial.write(msg, len);
+  Serial.println();
+}
+
+// A packet from the base station is one or more [length][message] records
+// back to back (see TransmitQueue in baseStation/src/transmitter.py). The
+// module hands a packet over in one burst, it ends at the first gap.
 void checkIncomingMessages() {
-  while (LORA_SERIAL.available()) {
-    Serial.println("\n--- Received LoRa packet ---");
-    
-    // Read header bytes
-    byte sender = LORA_SERIAL.read();
-    byte recipient = LORA_SERIAL.read();
-    byte length = LORA_SERIAL.read();
-    
-    Serial.printf("Sender ID: 0x%02X\n", sender);
-    Serial.printf("Recipient ID: 0x%02X\n", recipient);
-    Serial.printf("Data length: %d\n", length);
-    
-    // Read payload
-    Serial.print("Data (hex): ");
-    for (int i = 0; i < length; i++) {
-      byte b = LORA_SERIAL.read();
-      Serial.printf("0x%02X ", b);
+  if (!LORA_SERIAL.available()) {
+    return;
+  }
+  uint8_t packet[256];
+  size_t size = 0;
+  unsigned long last = millis();
+  while (millis() - last < 20) {
+    if (LORA_SERIAL.available()) {
+      uint8_t b = LORA_SERIAL.read();
+      if (size < sizeof(packet)) {
+        packet[size++] = b;
+      }
+      last = millis();
     }
-    Serial.println();
-    
-    // Try to print as ASCII
-    LORA_SERIAL.setTimeout(100);  // Reset position to start of payload
-    String message = LORA_SERIAL.readString();
-    Serial.print("Data (ASCII): ");
-    Serial.println(message);
-    
-    Serial.println("------------------------");
   }
+
+  Serial.printf("\n--- Received LoRa packet, %d bytes ---\n", size);
+  size_t pos = 0;
+  while (pos < size) {
+    size_t len = packet[pos];
+    if (pos + 1 + len > size) {
+      Serial.printf("Incomplete message: %d of %d bytes\n", size - pos - 1, len);
+      break;
+    }
+    handleMessage(packet + pos + 1, len);
+    pos += 1 + len;
+  }
+  Serial.println("------------------------");
 }
 
 void loop(void) 
@@ -118,6 +160,29 @@ void loop(void)
   uint8_t system, gyro, accel, mag = 0;
   bno.getCalibration(&system, &gyro, &accel, &mag);
   
+#if PAYLOAD_BINARY
+  // Fixed layout record, scales are the BNO055's own LSB sizes
+  uint8_t record[RECORD_V1_SIZE];
+  uint8_t* p = record;
+  *p++ = RECORD_V1;
+  p = putVector(p, orientationData.orientation.x, orientationData.orientation.y,
+                orientationData.orientation.z, 16.0f);
+  p = putVector(p, angVelocityData.gyro.x, angVelocityData.gyro.y,
+                angVelocityData.gyro.z, 16.0f);
+  p = putVector(p, accelerometerData.acceleration.x, accelerometerData.acceleration.y,
+                accelerometerData.acceleration.z, 100.0f);
+  p = putVector(p, linearAccelData.acceleration.x, linearAccelData.acceleration.y,
+                linearAccelData.acceleration.z, 100.0f);
+  p = putVector(p, gravityData.acceleration.x, gravityData.acceleration.y,
+                gravityData.acceleration.z, 100.0f);
+  p = putVector(p, magnetometerData.magnetic.x, magnetometerData.magnetic.y,
+                magnetometerData.magnetic.z, 16.0f);
+  *p++ = (uint8_t)temp;
+  *p++ = (system & 3) << 6 | (gyro & 3) << 4 | (accel & 3) << 2 | (mag & 3);
+
+  // Send data over LoRa
+  sendMessage(record, sizeof(record));
+#else
   // Format data as JSON string
   String data = "{\"orientation\":{" 
                 "\"x\":" + String(orientationData.orientation.x, 4) + 
@@ -152,6 +217,7 @@ void loop(void)
   
   // Send data over LoRa
   sendMessage(data.c_str());
+#endif
   
   // Add small delay to allow receiving
   delay(100);